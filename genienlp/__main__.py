@@ -32,6 +32,7 @@ import argparse
 
 from . import (
     arguments,
+    benchmark_checkpointing,
     cache_embeddings,
     calibrate,
     evaluate_file,
@@ -68,6 +69,11 @@ subcommands = {
     'run-paraphrase': ('Run a paraphraser model', run_generation.parse_argv, run_generation.main),
     # calibration commands
     'calibrate': ('Train a confidence calibration model', calibrate.parse_argv, calibrate.main),
+    'benchmark-checkpointing': (
+        'Measure the memory and speed tradeoff of activation checkpointing',
+        benchmark_checkpointing.parse_argv,
+        benchmark_checkpointing.main,
+    ),
     # commands that work with datasets
     'split-dataset': ('Split a dataset file into two files', split_dataset.parse_argv, split_dataset.main),
     # sts commands
@@ -34,6 +34,7 @@ import logging
 import os
 import subprocess
 
+from .model_utils.distributed import is_main_process, world_size_from_env
 from .model_utils.transformers_utils import MODEL_PARALLEL_SUPPORTED_MODELS
 from .tasks.registry import get_tasks
 from .util import have_multilingual
@@ -149,13 +150,77 @@ def parse_argv(parser):
         '--tensorboard_dir', default=None, help='Directory where to save Tensorboard logs (defaults to --save)'
     )
     parser.add_argument('--max_to_keep', default=1, type=int, help='number of checkpoints to keep')
+    parser.add_argument(
+        '--ddp_backend',
+        default=None,
+        choices=['nccl', 'gloo'],
+        help='torch.distributed backend used when training is launched with torchrun (defaults to nccl on GPU, gloo on CPU)',
+    )
+    parser.add_argument(
+        '--ddp_timeout',
+        default=180,
+        type=int,
+        help='minutes a rank waits for the others in a collective operation before failing. Without --async_validation, '
+        'the other ranks wait at a barrier while rank 0 validates and saves, so this must be longer than a validation',
+    )
+    parser.add_argument(
+        '--ddp_bucket_cap_mb',
+        default=25,
+        type=int,
+        help='size in MB of the gradient buckets that DistributedDataParallel all-reduces while backward is running',
+    )
+    parser.add_argument(
+        '--ddp_find_unused_parameters',
+        action='store_true',
+        help='needed for DistributedDataParallel when some parameters do not receive gradients in every step',
+    )
+    parser.add_argument(
+        '--max_inflight_saves',
+        default=1,
+        type=int,
+        help='number of checkpoints (and --async_validation snapshots) that can be written in the background at once '
+        'while training continues; snapshots are held in CPU memory until written. Use 0 to save synchronously',
+    )
+    parser.add_argument(
+        '--prefetch_batches',
+        default=0,
+        type=int,
+        help='number of training batches that a background thread prepares ahead of time for each task. '
+        'Hides data loading time of tasks with expensive examples. 0 prepares batches when they are needed',
+    )
     parser.add_argument('--log_every', default=100, type=int, help='how often to log results in # of iterations')
+    parser.add_argument(
+        '--telemetry',
+        action='store_true',
+        help='Log throughput (tokens and examples per second), padding ratio, time split between data loading, '
+        'forward/backward and optimizer, and peak memory every --log_every iterations to TensorBoard and telemetry.jsonl. '
+        'Synchronizes CUDA around each part of the step',
+    )
+    parser.add_argument(
+        '--profile_iterations',
+        nargs=2,
+        type=int,
+        default=None,
+        metavar=('START', 'END'),
+        help='Save a torch.profiler trace of iterations [START, END) in --save',
+    )
     parser.add_argument('--save_every', default=1000, type=int, help='how often to save a checkpoint in # of iterations')
 
     parser.add_argument(
         '--val_tasks', nargs='+', type=str, dest='val_task_names', help='tasks to collect evaluation metrics for'
     )
     parser.add_argument('--val_every', default=1000, type=int, help='how often to run validation in # of iterations')
+    parser.add_argument(
+        '--async_validation',
+        action='store_true',
+        help='Run validation in a separate process on a snapshot of the weights, so that training does not wait for it',
+    )
+    parser.add_argument(
+        '--async_validation_device',
+        default=-1,
+        type=int,
+        help='GPU used by the asynchronous validation process; -1 means CPU',
+    )
     parser.add_argument(
         '--val_after', default=0, type=int, help='start validating model (at or) after certain # of iterations'
     )
@@ -212,6 +277,18 @@ def parse_argv(parser):
     parser.add_argument(
         '--allow_OOM', action='store_true', help='Issue a warning for OOM errors during training instead of crashing'
     )
+    parser.add_argument(
+        '--split_OOM_batches',
+        action='store_true',
+        help='Split batches that run out of GPU memory in halves (recursively) and process them one after the other, '
+        'and build smaller batches for examples of similar length afterwards',
+    )
+    parser.add_argument(
+        '--simulate_OOM_tokens',
+        default=None,
+        type=int,
+        help='For testing: raise an out of memory error for every batch with more than this many padded tokens',
+    )
     parser.add_argument(
         '--filter_long_inputs',
         action='store_true',
@@ -324,6 +401,21 @@ def parse_argv(parser):
         'default is None meaning we distribute evenly on all available gpus',
     )
 
+    parser.add_argument(
+        '--checkpoint_every_n_layers',
+        default=0,
+        type=int,
+        help='Recompute the activations of every N-th transformer layer during backward instead of storing them, '
+        'trading compute for memory. 1 checkpoints all layers; 0 disables activation checkpointing',
+    )
+    parser.add_argument(
+        '--checkpoint_decoder_steps',
+        default=0,
+        type=int,
+        help='Recompute the activations of the LSTM decoder of TransformerLSTM models in blocks of this many decoding steps '
+        'during backward. 0 disables it',
+    )
+
     parser.add_argument('--warmup', default=40, type=int, help='warmup for learning rate. setting it to 1 disables warmup.')
     parser.add_argument('--grad_clip', default=1.0, type=float, help='gradient clipping')
     parser.add_argument(
@@ -372,6 +464,20 @@ def parse_argv(parser):
         type=int,
         help='Number of accumulation steps. Useful to effectively get larger batch sizes.',
     )
+    parser.add_argument(
+        '--sequence_packing',
+        action='store_true',
+        help='Pack several short examples into each row of a training batch, with attention masks that keep them apart. '
+        'Training batches are then filled up to --train_batch_tokens real (non-padding) tokens. '
+        'Only supported for TransformerSeq2Seq with BART, mBART and Marian models',
+    )
+    parser.add_argument(
+        '--amp_dtype',
+        default=None,
+        choices=['fp16', 'bf16'],
+        help='Train with automatic mixed precision in the given dtype. fp16 uses dynamic loss scaling and requires a GPU;'
+        ' bf16 also works on CPU',
+    )
 
     # Loss Truncation; introduced in https://arxiv.org/abs/2004.14589
     parser.add_argument(
@@ -423,6 +529,18 @@ def parse_argv(parser):
         action='store_true',
         help='Ignore all conditions and use fast version of huggingface tokenizer',
     )
+    parser.add_argument(
+        '--pad_to_multiple_of',
+        default=None,
+        type=int,
+        help='round padded lengths up to a multiple of this value (e.g. 8 or 16), so that batches come in fewer shapes',
+    )
+    parser.add_argument(
+        '--max_padding_buckets',
+        default=None,
+        type=int,
+        help='maximum number of distinct padded lengths; longer sequences grow the largest bucket instead of adding a new one',
+    )
 
     parser.add_argument('--use_curriculum', action='store_true', help='Use curriculum learning')
     parser.add_argument(
@@ -699,12 +817,29 @@ def post_parse_train_specific(args):
         ):
             raise ValueError('For now we only support single language training and evaluation with mbart models')
 
+    if args.sequence_packing and args.model != 'TransformerSeq2Seq':
+        raise ValueError('Sequence packing is only supported for TransformerSeq2Seq models')
+
     if args.model_parallel:
         if args.model == 'TransformerLSTM':
             raise ValueError('Model parallel is not supported for TransformerLSTM models')
         elif args.model == 'TransformerSeq2Seq' and args.pretrained_model not in MODEL_PARALLEL_SUPPORTED_MODELS:
             raise ValueError('Only the following models have model_parallel support: ', MODEL_PARALLEL_SUPPORTED_MODELS)
 
+    if args.checkpoint_every_n_layers < 0 or args.checkpoint_decoder_steps < 0:
+        raise ValueError('checkpoint_every_n_layers and checkpoint_decoder_steps cannot be negative')
+    if args.checkpoint_decoder_steps > 0 and (args.model != 'TransformerLSTM' or args.rnn_layers == 0):
+        raise ValueError('checkpoint_decoder_steps is only supported for TransformerLSTM models with rnn_layers > 0')
+
+    if args.prefetch_batches < 0:
+        raise ValueError('prefetch_batches cannot be negative')
+
+    if args.split_OOM_batches and world_size_from_env() > 1:
+        raise ValueError('split_OOM_batches cannot be combined with distributed training')
+
+    if args.model_parallel and world_size_from_env() > 1:
+        raise ValueError('Model parallel cannot be combined with distributed training')
+
     if args.mp_device_ratio is not None:
         if len(args.mp_device_ratio) != len(args.devices):
             raise ValueError('When using model_parallel number of provided devices must match the number of mp_device_ratio')
@@ -737,7 +872,9 @@ def post_parse_train_specific(args):
     for x in ['embeddings']:
         setattr(args, x, os.path.join(args.root, getattr(args, x)))
 
-    save_args(args, force_overwrite=True)
+    # all ranks parse the same arguments, so only rank 0 needs to write them
+    if is_main_process():
+        save_args(args, force_overwrite=True)
 
     args = check_and_update_generation_args(args)
     return args
@@ -0,0 +1,170 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Measure the memory/throughput tradeoff of activation checkpointing on tiny random models, on CPU.
+
+Activation memory is measured as the total size of the tensors that autograd saves for backward,
+which is what checkpointing reduces and does not depend on the allocator of the device.
+"""
+
+import json
+import logging
+import time
+
+import torch
+from transformers import BartConfig, BartForConditionalGeneration
+
+from .model_utils.checkpointing import enable_activation_checkpointing
+from .models.mqan_decoder import LSTMDecoder
+
+logger = logging.getLogger(__name__)
+
+
+def parse_argv(parser):
+    parser.add_argument('--layers', default=12, type=int, help='Number of encoder and decoder layers of the BART model')
+    parser.add_argument('--dimension', default=64, type=int, help='Hidden size of the models')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--context_length', default=64, type=int)
+    parser.add_argument('--answer_length', default=48, type=int)
+    parser.add_argument(
+        '--every_n_layers', nargs='+', default=[1, 2, 4], type=int, help='Transformer layer granularities to benchmark'
+    )
+    parser.add_argument(
+        '--decoder_steps', nargs='+', default=[1, 8, 16], type=int, help='LSTM decoder block sizes to benchmark'
+    )
+    parser.add_argument('--iterations', default=5, type=int, help='Number of timed training steps per configuration')
+    parser.add_argument('--output', default=None, type=str, help='Also write the report to this JSON file')
+    parser.add_argument('--seed', default=123, type=int, help='Random seed.')
+
+
+def _saved_activation_bytes(step):
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.storage() if hasattr(tensor, 'storage') else tensor.untyped_storage()
+        storages[storage.data_ptr()] = (
+            storage.nbytes() if hasattr(storage, 'nbytes') else storage.size() * tensor.element_size()
+        )
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+    return sum(storages.values())
+
+
+def _measure(step, iterations):
+    step()  # warm up
+    activation_bytes = _saved_activation_bytes(step)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        step()
+    return activation_bytes, (time.perf_counter() - start) / iterations
+
+
+def _bart_step(model, args):
+    context = torch.randint(4, model.config.vocab_size, (args.batch_size, args.context_length))
+    answer = torch.randint(4, model.config.vocab_size, (args.batch_size, args.answer_length))
+
+    def step():
+        model.zero_grad()
+        model(context, labels=answer).loss.backward()
+
+    return step
+
+
+def _lstm_step(decoder, args):
+    answer_embedded = torch.randn(args.batch_size, args.answer_length, args.dimension, requires_grad=True)
+    context = torch.randn(args.batch_size, args.context_length, args.dimension, requires_grad=True)
+    hidden = (torch.zeros(1, args.batch_size, args.dimension), torch.zeros(1, args.batch_size, args.dimension))
+    decoder.applyMasks(torch.zeros(args.batch_size, args.context_length, dtype=torch.bool))
+
+    def step():
+        decoder.zero_grad()
+        outputs = decoder(answer_embedded, context, hidden=hidden)
+        sum(output.sum() for output in outputs[:3]).backward()
+
+    return step
+
+
+def _report_row(name, activation_bytes, seconds, baseline):
+    return {
+        'configuration': name,
+        'activation_mb': activation_bytes / 2**20,
+        'sec_per_step': seconds,
+        'activation_ratio': activation_bytes / baseline[0],
+        'throughput_ratio': baseline[1] / seconds,
+    }
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    report = {'transformer': [], 'lstm_decoder': []}
+
+    config = BartConfig(
+        vocab_size=1000,
+        d_model=args.dimension,
+        encoder_layers=args.layers,
+        decoder_layers=args.layers,
+        encoder_attention_heads=4,
+        decoder_attention_heads=4,
+        encoder_ffn_dim=4 * args.dimension,
+        decoder_ffn_dim=4 * args.dimension,
+        max_position_embeddings=max(args.context_length, args.answer_length) + 2,
+    )
+    for every_n_layers in [0] + args.every_n_layers:
+        model = BartForConditionalGeneration(config).train()
+        if every_n_layers > 0:
+            enable_activation_checkpointing(model, every_n_layers=every_n_layers)
+        measurement = _measure(_bart_step(model, args), args.iterations)
+        if every_n_layers == 0:
+            baseline = measurement
+        name = f'every {every_n_layers} layers' if every_n_layers > 0 else 'no checkpointing'
+        report['transformer'].append(_report_row(name, *measurement, baseline))
+
+    for decoder_steps in [0] + args.decoder_steps:
+        decoder = LSTMDecoder(args.dimension, args.dimension, dropout=0.2).train()
+        decoder.checkpoint_steps = decoder_steps
+        measurement = _measure(_lstm_step(decoder, args), args.iterations)
+        if decoder_steps == 0:
+            baseline = measurement
+        name = f'blocks of {decoder_steps} steps' if decoder_steps > 0 else 'no checkpointing'
+        report['lstm_decoder'].append(_report_row(name, *measurement, baseline))
+
+    for model_name, rows in report.items():
+        print(f'{model_name}:')
+        print(f'{"configuration":>24} {"activations (MB)":>17} {"s/step":>8} {"memory":>7} {"speed":>6}')
+        for row in rows:
+            print(
+                f'{row["configuration"]:>24} {row["activation_mb"]:>17.1f} {row["sec_per_step"]:>8.3f}'
+                f' {row["activation_ratio"]:>7.2f} {row["throughput_ratio"]:>6.2f}'
+            )
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2)
@@ -48,7 +48,8 @@ def parse_argv(parser):
         '--confidence_path',
         required=True,
         type=str,
-        help='The path to the pickle file where the list of ConfidenceFeatures objects is saved',
+        help='The path where predict.py saved confidence features with --save_confidence_features. Older pickle files are '
+        'supported too.',
     )
     parser.add_argument(
         '--eval_metric',
@@ -837,10 +838,19 @@ def main(args):
     if args.plot:
         from matplotlib import pyplot  # lazy import
 
-    confidences = torch.load(args.confidence_path, map_location=torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+    from .confidence_store import ConfidenceFeatureReader, load_confidence_features  # avoid a circular import
+
+    confidences = load_confidence_features(args.confidence_path)
 
     all_estimators = []
-    train_confidences, dev_confidences = train_test_split(confidences, test_size=args.dev_split, random_state=args.seed)
+    if isinstance(confidences, ConfidenceFeatureReader):
+        # split the indices, so that examples stay on disk until the estimators go through them
+        train_indices, dev_indices = train_test_split(
+            np.arange(len(confidences)), test_size=args.dev_split, random_state=args.seed
+        )
+        train_confidences, dev_confidences = confidences.view(train_indices), confidences.view(dev_indices)
+    else:
+        train_confidences, dev_confidences = train_test_split(confidences, test_size=args.dev_split, random_state=args.seed)
 
     feature_sets = fast_feature_sets
     if not args.fast:
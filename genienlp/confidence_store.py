@@ -0,0 +1,344 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import logging
+import os
+from typing import List, Optional, Sequence
+
+import numpy as np
+import torch
+
+from .calibrate import ConfidenceFeatures
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+METADATA_FILE = 'metadata.json'
+
+# per-token features of an output, one value per generated token
+TOKEN_COLUMNS = ('nodrop_logits', 'nodrop_probs', 'nodrop_entropies', 'nodrop_top1_probs', 'nodrop_top2_probs')
+# per-token features of an output for every MC dropout sample, stored sample by sample
+DROPOUT_COLUMNS = ('drop_logits', 'drop_probs', 'drop_top1_probs', 'drop_top2_probs')
+# token ids, one sequence per example (gold_answer, context) or per output (prediction)
+ID_COLUMNS = ('gold_answer', 'context', 'prediction')
+# one value per example, and one value per output, which among other things say where the sequences of each of them
+# start in the columns above
+EXAMPLE_INDEX_COLUMNS = ('position', 'num_outputs', 'gold_answer_length', 'context_length')
+# labels are stored rather than derived from first_mistake, since predict.py can override them
+OUTPUT_INDEX_COLUMNS = ('prediction_length', 'token_length', 'first_mistake', 'label')
+INDEX_COLUMNS = EXAMPLE_INDEX_COLUMNS + OUTPUT_INDEX_COLUMNS
+
+COLUMN_DTYPES = {
+    **{name: np.float32 for name in TOKEN_COLUMNS + DROPOUT_COLUMNS},
+    **{name: np.int32 for name in ID_COLUMNS},
+    **{name: np.int64 for name in INDEX_COLUMNS},
+    'label': np.int8,
+}
+
+
+def _column_file(path, name):
+    return os.path.join(path, name + '.bin')
+
+
+def clear_confidence_features(path):
+    """
+    Removes the confidence features that an earlier run stored at `path`, so that new ones can be stored there.
+    Anything else is left alone: `path` has to be missing, an empty directory, or a directory with the metadata of
+    this format, whose files are the only ones removed.
+    """
+    if not os.path.exists(path):
+        return
+    if not os.path.isdir(path):
+        raise ValueError(
+            f'{path} is a file, but confidence features are saved in a directory (one binary file per kind of feature) '
+            'instead of a single pickle. Choose another path.'
+        )
+    metadata_path = os.path.join(path, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        if os.listdir(path):
+            raise ValueError(f'{path} is not empty and does not hold confidence features, refusing to overwrite it')
+        return
+    for name in INDEX_COLUMNS + ID_COLUMNS + TOKEN_COLUMNS + DROPOUT_COLUMNS:
+        if os.path.exists(_column_file(path, name)):
+            os.remove(_column_file(path, name))
+    if os.path.exists(metadata_path + '.tmp'):
+        os.remove(metadata_path + '.tmp')
+    # last, so that a store that was only partly removed is still recognized as one
+    os.remove(metadata_path)
+
+
+class ConfidenceFeatureWriter(object):
+    """
+    Writes the confidence features of a prediction run into a directory, with one flat binary file per kind of feature
+    instead of one pickle of many small tensors. Examples can be appended as soon as their batch is generated, in any
+    order: each one is stored with its position in the dataset, and ConfidenceFeatureReader returns them in that order.
+
+    The metadata file says how many examples are complete, so a run that stops halfway leaves a readable store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.num_examples = 0
+        self.num_outputs = 0
+        self.mc_dropout_num = None
+        self.columns = None  # the feature columns that are not None, decided by the first output
+        self._files = {}
+        clear_confidence_features(path)
+        os.makedirs(path, exist_ok=True)
+        self.flush()
+
+    def _open_columns(self, features: ConfidenceFeatures):
+        self.columns = [name for name in TOKEN_COLUMNS + DROPOUT_COLUMNS if getattr(features, name) is not None]
+        self.mc_dropout_num = features.mc_dropout_num
+        for name in list(INDEX_COLUMNS) + list(ID_COLUMNS) + self.columns:
+            self._files[name] = open(_column_file(self.path, name), 'wb')
+
+    def _write(self, name, values):
+        self._files[name].write(np.ascontiguousarray(values, dtype=COLUMN_DTYPES[name]).tobytes())
+
+    def append(self, confidence_features: List[List[ConfidenceFeatures]], positions: Optional[Sequence[int]] = None):
+        """
+        Adds examples, each with the list of ConfidenceFeatures of its outputs. `positions` are the positions of the
+        examples in the dataset, and default to the order in which they are appended.
+        """
+        if positions is None:
+            positions = range(self.num_examples, self.num_examples + len(confidence_features))
+        if len(positions) != len(confidence_features):
+            raise ValueError(f'Got {len(positions)} positions for {len(confidence_features)} examples')
+
+        for position, example in zip(positions, confidence_features):
+            if len(example) == 0:
+                raise ValueError(f'Example at position {position} has no confidence features')
+            if self.columns is None:
+                self._open_columns(example[0])
+            self._write('position', [position])
+            self._write('num_outputs', [len(example)])
+            # the gold answer and the context are the same for all outputs of an example
+            for name in ('gold_answer', 'context'):
+                values = getattr(example[0], name).cpu().numpy()
+                self._write(name + '_length', [len(values)])
+                self._write(name, values)
+
+            for features in example:
+                self._append_output(features)
+            self.num_examples += 1
+            self.num_outputs += len(example)
+        self.flush()
+
+    def _append_output(self, features: ConfidenceFeatures):
+        prediction = features.prediction.cpu().numpy()
+        self._write('prediction_length', [len(prediction)])
+        self._write('prediction', prediction)
+        self._write('first_mistake', [features.first_mistake])
+        self._write('label', [features.label])
+
+        if features.mc_dropout_num != self.mc_dropout_num:
+            raise ValueError(
+                f'All outputs should have the same number of MC dropout samples, got {features.mc_dropout_num} '
+                f'instead of {self.mc_dropout_num}'
+            )
+        token_length = None
+        for name in TOKEN_COLUMNS + DROPOUT_COLUMNS:
+            values = getattr(features, name)
+            if (values is not None) != (name in self.columns):
+                raise ValueError(f'All outputs should have the same confidence features, but {name} is not always set')
+            if values is None:
+                continue
+            values = values.float().cpu().numpy()
+            length = values.shape[-1]
+            if token_length is None:
+                token_length = length
+            elif length != token_length:
+                raise ValueError(f'{name} has {length} tokens instead of {token_length}')
+            self._write(name, values.reshape(-1))
+        self._write('token_length', [token_length or 0])
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+        metadata = {
+            'format_version': FORMAT_VERSION,
+            'num_examples': self.num_examples,
+            'num_outputs': self.num_outputs,
+            'mc_dropout_num': self.mc_dropout_num,
+            'columns': self.columns or [],
+        }
+        # replace the metadata in one step, so that it never describes data that is not on disk yet
+        tmp_path = os.path.join(self.path, METADATA_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, os.path.join(self.path, METADATA_FILE))
+
+    def close(self):
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ConfidenceFeatureReader(object):
+    """
+    Reads a directory written by ConfidenceFeatureWriter. Columns are memory-mapped, so opening the store is cheap
+    and an example is only read from disk when it is accessed. Behaves like a list of examples in dataset order,
+    each a list of ConfidenceFeatures, and iterates over them `chunk_size` examples at a time.
+    """
+
+    def __init__(self, path, chunk_size=1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            metadata = json.load(f)
+        if metadata['format_version'] != FORMAT_VERSION:
+            raise ValueError(f'{path} has version {metadata["format_version"]} of the confidence feature format')
+        self.num_examples = metadata['num_examples']
+        self.num_outputs = metadata['num_outputs']
+        self.mc_dropout_num = metadata['mc_dropout_num']
+        self.columns = metadata['columns']
+
+        self._columns = {name: self._map_column(name) for name in list(ID_COLUMNS) + self.columns}
+        index = {name: self._map_column(name)[: self.num_examples] for name in EXAMPLE_INDEX_COLUMNS}
+        index.update({name: self._map_column(name)[: self.num_outputs] for name in OUTPUT_INDEX_COLUMNS})
+
+        def offsets(lengths):
+            return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+        self._output_offsets = offsets(index['num_outputs'])
+        self._gold_answer_offsets = offsets(index['gold_answer_length'])
+        self._context_offsets = offsets(index['context_length'])
+        self._prediction_offsets = offsets(index['prediction_length'])
+        self._token_offsets = offsets(index['token_length'])
+        self._first_mistake = np.array(index['first_mistake'])
+        self._label = np.array(index['label']).astype(bool)
+        # row in the store of the example at every position of the dataset
+        self._rows = np.argsort(index['position'], kind='stable')
+
+    def _map_column(self, name):
+        file_name = _column_file(self.path, name)
+        if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+            # nothing was written, and empty files cannot be memory-mapped
+            return np.zeros(0, dtype=COLUMN_DTYPES[name])
+        return np.memmap(file_name, dtype=COLUMN_DTYPES[name], mode='r')
+
+    def __len__(self):
+        return self.num_examples
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_examples
+        if not 0 <= index < self.num_examples:
+            raise IndexError(f'Example {index} is out of range for {self.num_examples} examples')
+        return self._read_example(self._rows[index])
+
+    def __iter__(self):
+        return iter(self.view(range(self.num_examples)))
+
+    def view(self, indices: Sequence[int]):
+        """
+        Returns the examples at `indices` as a lazily read list, e.g. for the training and dev splits of calibration
+        """
+        return ConfidenceFeatureView(self, indices)
+
+    def _read(self, name, start, end):
+        # copy out of the memory map, so that the tensors own their (writable) memory
+        values = np.array(self._columns[name][start:end])
+        if name in ID_COLUMNS:
+            return torch.from_numpy(values.astype(np.int64))
+        return torch.from_numpy(values)
+
+    def _read_example(self, row):
+        gold_answer = self._read('gold_answer', self._gold_answer_offsets[row], self._gold_answer_offsets[row + 1])
+        context = self._read('context', self._context_offsets[row], self._context_offsets[row + 1])
+        example = []
+        for output in range(self._output_offsets[row], self._output_offsets[row + 1]):
+            token_start, token_end = self._token_offsets[output], self._token_offsets[output + 1]
+            values = {name: None for name in TOKEN_COLUMNS + DROPOUT_COLUMNS}
+            for name in self.columns:
+                if name in DROPOUT_COLUMNS:
+                    values[name] = self._read(name, token_start * self.mc_dropout_num, token_end * self.mc_dropout_num)
+                    values[name] = values[name].view(self.mc_dropout_num, -1)
+                else:
+                    values[name] = self._read(name, token_start, token_end)
+            # the features are stored already computed, so the object is filled in directly instead of through __init__
+            features = ConfidenceFeatures.__new__(ConfidenceFeatures)
+            vars(features).update(
+                values,
+                prediction=self._read('prediction', self._prediction_offsets[output], self._prediction_offsets[output + 1]),
+                gold_answer=gold_answer,
+                first_mistake=int(self._first_mistake[output]),
+                label=bool(self._label[output]),
+                context=context,
+            )
+            example.append(features)
+        return example
+
+
+class ConfidenceFeatureView(object):
+    """
+    The examples of a ConfidenceFeatureReader at some indices. Iterating reads them a chunk at a time, in the order
+    they are stored in, so that only one chunk of features is in memory at once.
+    """
+
+    def __init__(self, reader: ConfidenceFeatureReader, indices: Sequence[int]):
+        self.reader = reader
+        self.indices = list(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.reader[self.indices[index]]
+
+    def iter_chunks(self):
+        chunk_size = self.reader.chunk_size
+        for start in range(0, len(self.indices), chunk_size):
+            rows = self.reader._rows[self.indices[start : start + chunk_size]]
+            examples = {row: self.reader._read_example(row) for row in sorted(set(rows.tolist()))}
+            yield [examples[row] for row in rows.tolist()]
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+
+def load_confidence_features(path):
+    """
+    Opens the confidence features saved by predict.py: a directory written by ConfidenceFeatureWriter, or a pickle
+    file of a list of lists of ConfidenceFeatures as saved by older versions
+    """
+    if os.path.isdir(path):
+        return ConfidenceFeatureReader(path)
+    logger.warning('%s is in the old pickle format, which is loaded into memory all at once', path)
+    return torch.load(path, map_location=torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
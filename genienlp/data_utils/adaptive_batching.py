@@ -0,0 +1,316 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import contextlib
+import logging
+import math
+import os
+import sys
+import threading
+
+import torch
+
+from .example import NumericalizedExamples, SequentialField
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedOOMError(RuntimeError):
+    """
+    Raised instead of a real CUDA out-of-memory error by `run_with_oom_splitting` when `simulate_oom_tokens` is set,
+    so that OOM recovery can be tested on machines with any amount of memory
+    """
+
+
+def is_oom_error(error):
+    # CUDA reports that it is out of memory, and the CPU allocator that it can't allocate memory
+    return isinstance(error, RuntimeError) and ('out of memory' in str(error) or "can't allocate memory" in str(error))
+
+
+def batch_num_rows(batch):
+    return len(batch.example_id)
+
+
+def batch_row_length(batch):
+    """
+    Per-row length of a collated batch after padding to its longest context and answer, excluding padding buckets
+    """
+    return int(batch.context.length.max()) + int(batch.answer.length.max())
+
+
+def _slice_field(field, start, end):
+    return SequentialField(
+        value=field.value[start:end],
+        length=field.length[start:end],
+        limited=field.limited[start:end],
+        # features are an empty list when the dataset has none
+        feature=field.feature[start:end] if isinstance(field.feature, torch.Tensor) else field.feature,
+    )
+
+
+def split_batch(batch):
+    """
+    Split a collated batch into two halves along the batch dimension. Padding is kept as is, so the halves produce
+    the same per-example outputs as the full batch.
+    """
+    middle = (batch_num_rows(batch) + 1) // 2
+    return [
+        NumericalizedExamples(
+            example_id=batch.example_id[start:end],
+            context=_slice_field(batch.context, start, end),
+            answer=_slice_field(batch.answer, start, end),
+        )
+        for start, end in ((0, middle), (middle, batch_num_rows(batch)))
+    ]
+
+
+class TokenBudget(object):
+    """
+    Learns, for buckets of example lengths, how many padded tokens fit in a batch without running out of memory.
+
+    A budget is only introduced for a bucket after an OOM error there, and it also applies to all longer buckets, since
+    memory per token grows with length. The data iterator consults `fits()` while building batches, so that later
+    batches of similar length are built small enough in the first place.
+    """
+
+    def __init__(self, shrink_factor=0.8):
+        # the budget becomes this fraction of the size of the batch that ran out of memory
+        self.shrink_factor = shrink_factor
+        # maps log2 of the bucket length to the maximum number of padded tokens in a batch
+        self.budgets = {}
+
+    @staticmethod
+    def bucket(row_length):
+        return math.ceil(math.log2(max(row_length, 1)))
+
+    def limit(self, row_length):
+        bucket = self.bucket(row_length)
+        limits = [budget for b, budget in self.budgets.items() if b <= bucket]
+        return min(limits) if limits else None
+
+    def fits(self, num_rows, row_length):
+        limit = self.limit(row_length)
+        return limit is None or num_rows * row_length <= limit
+
+    def measure(self, num_rows, row_length):
+        """
+        Context manager around processing a batch of this size; subclasses use it to learn from batches that fit
+        """
+        return contextlib.nullcontext()
+
+    def record_oom(self, num_rows, row_length):
+        bucket = self.bucket(row_length)
+        budget = max(int(num_rows * row_length * self.shrink_factor), row_length)
+        if budget < self.budgets.get(bucket, math.inf):
+            # replace instead of updating in place, since the data iterator may read it from a prefetching thread
+            self.budgets = {**self.budgets, bucket: budget}
+            logger.info(f'Limiting batches of examples up to {2 ** bucket} tokens long to {budget} tokens')
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, or None if it cannot be read (outside of Linux)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def peak_rss():
+    """
+    Largest resident set size this process has had so far, in bytes
+    """
+    import resource  # not available on Windows
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class MemoryMonitor(object):
+    """
+    Measures the peak memory used by a piece of work: memory allocated for tensors on CUDA devices, and the resident
+    set size (RSS) of the process on the CPU.
+
+    On the CPU, a thread samples the RSS every `sample_interval` seconds while the work runs, since the high-water
+    mark of a process cannot be reset: evaluation batches come longest first, so later batches would hardly ever set
+    a new one. Where the RSS cannot be sampled, a peak is only known for work that sets a new high-water mark.
+    """
+
+    sample_interval = 0.01
+
+    def __init__(self, device, cpu_memory_limit=None):
+        """
+        cpu_memory_limit: in bytes, the RSS that the process should stay under on the CPU. Defaults to the physical memory.
+        """
+        self.device = torch.device(device)
+        if self.device.type == 'cuda':
+            self.capacity = torch.cuda.get_device_properties(self.device).total_memory
+        elif cpu_memory_limit is not None:
+            self.capacity = cpu_memory_limit
+        else:
+            self.capacity = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        self._high_water_mark = None
+        self._sampled_peak = None
+        self._sampler = None
+        self._stop_sampling = None
+
+    def _sample(self, stop_sampling):
+        while not stop_sampling.wait(self.sample_interval):
+            self._sampled_peak = max(self._sampled_peak, current_rss())
+
+    def start(self):
+        """
+        Starts a measurement and returns the memory in use at this point
+        """
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return torch.cuda.memory_allocated(self.device)
+        rss = current_rss()
+        if rss is None:
+            self._high_water_mark = peak_rss()
+            return self._high_water_mark
+        self._sampled_peak = rss
+        self._stop_sampling = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, args=(self._stop_sampling,), daemon=True)
+        self._sampler.start()
+        return rss
+
+    def peak(self):
+        """
+        Returns the peak memory in use since start(), or None if it is not known
+        """
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device)
+        if self._sampler is None:
+            # the high-water mark of a process cannot be reset, so a peak is only known if it set a new one
+            high_water_mark = peak_rss()
+            return high_water_mark if high_water_mark > self._high_water_mark else None
+        self.stop()
+        return max(self._sampled_peak, current_rss())
+
+    def stop(self):
+        """
+        Ends a measurement without reading its peak, stopping the thread that samples the RSS if there is one
+        """
+        if self._sampler is None:
+            return
+        self._stop_sampling.set()
+        self._sampler.join()
+        self._sampler = None
+        self._stop_sampling = None
+
+
+class MemoryAwareTokenBudget(TokenBudget):
+    """
+    A TokenBudget that also sizes batches from measured memory use instead of a fixed batch size.
+
+    The first batch of each length bucket is limited to `initial_budget` tokens. The peak memory it needs per padded
+    token, on top of what was in use before it (the model, mostly), then sets the budget of the bucket to the number
+    of tokens that fit in `memory_fraction` of the memory of the device, up to `max_budget`. Memory per token depends
+    on the model and on decoding options like the number of beams and outputs, which is why it is measured rather
+    than estimated. Batches that run out of memory anyway lower the budget like in TokenBudget.
+    """
+
+    def __init__(self, monitor, initial_budget, max_budget, memory_fraction=0.9, shrink_factor=0.8):
+        super().__init__(shrink_factor)
+        self.monitor = monitor
+        self.initial_budget = initial_budget
+        self.max_budget = max_budget
+        self.memory_fraction = memory_fraction
+        # maps log2 of the bucket length to the most memory per padded token a batch of the bucket needed
+        self.bytes_per_token = {}
+        self.memory_in_use = 0
+
+    def memory_limit(self, row_length):
+        bytes_per_token = self.bytes_per_token.get(self.bucket(row_length))
+        if bytes_per_token is None:
+            return self.initial_budget
+        available = self.monitor.capacity * self.memory_fraction - self.memory_in_use
+        return int(min(max(available / bytes_per_token, row_length), self.max_budget))
+
+    def limit(self, row_length):
+        limit = self.memory_limit(row_length)
+        oom_limit = super().limit(row_length)
+        return limit if oom_limit is None else min(limit, oom_limit)
+
+    @contextlib.contextmanager
+    def measure(self, num_rows, row_length):
+        memory_in_use = self.monitor.start()
+        try:
+            yield
+            peak = self.monitor.peak()
+        finally:
+            # a batch that fails, like one that runs out of memory, must not leave the sampling thread running
+            self.monitor.stop()
+        if peak is None:
+            return
+        self.memory_in_use = memory_in_use
+        bucket = self.bucket(row_length)
+        bytes_per_token = max(peak - memory_in_use, 1) / (num_rows * row_length)
+        if bytes_per_token > self.bytes_per_token.get(bucket, 0):
+            # replace instead of updating in place, since the data iterator may read it from a prefetching thread
+            self.bytes_per_token = {**self.bytes_per_token, bucket: bytes_per_token}
+            logger.info(
+                f'Batches of examples up to {2 ** bucket} tokens long need {bytes_per_token / 1024:.1f} KiB per token; '
+                f'using a budget of {self.memory_limit(row_length)} tokens for them'
+            )
+
+
+def run_with_oom_splitting(fn, batch, token_budget=None, simulate_oom_tokens=None):
+    """
+    Call `fn(batch)`. If it runs out of memory, split the batch in halves and process them recursively, recording
+    the failed batch size in `token_budget`. Reraises the error if a single example does not fit in memory.
+
+    Returns a list of (sub_batch, fn(sub_batch)) covering the rows of `batch` in order.
+    """
+    num_rows, row_length = batch_num_rows(batch), batch_row_length(batch)
+    try:
+        if simulate_oom_tokens is not None and num_rows * row_length > simulate_oom_tokens:
+            raise SimulatedOOMError(f'CUDA out of memory (simulated for a batch of {num_rows * row_length} tokens)')
+        with token_budget.measure(num_rows, row_length) if token_budget is not None else contextlib.nullcontext():
+            output = fn(batch)
+        return [(batch, output)]
+    except RuntimeError as e:
+        if not is_oom_error(e):
+            raise e
+        if token_budget is not None:
+            token_budget.record_oom(num_rows, row_length)
+        if num_rows == 1:
+            raise e
+        logger.warning(f'Out of memory for a batch of {num_rows} examples of length {row_length}; splitting it in halves')
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    outputs = []
+    for half in split_batch(batch):
+        outputs.extend(run_with_oom_splitting(fn, half, token_budget, simulate_oom_tokens))
+    return outputs
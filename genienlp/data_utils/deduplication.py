@@ -0,0 +1,143 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import logging
+
+import numpy as np
+import torch
+
+from .example import NumericalizedExamples, SequentialField
+
+logger = logging.getLogger(__name__)
+
+
+def input_key(example: NumericalizedExamples):
+    """
+    A digest of everything generation sees of a single (uncollated) numericalized example: the ids of its context
+    (which includes the question) and its entity features. Examples with the same key produce the same outputs.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.asarray(example.context.value, dtype=np.int64).tobytes())
+    if example.context.feature:
+        digest.update(repr(example.context.feature).encode())
+    return digest.digest()
+
+
+def group_duplicates(examples):
+    """
+    Returns, for each example, the index of the first example with the same input, and the number of duplicates
+    """
+    first_index = {}
+    groups = []
+    for i, example in enumerate(examples):
+        groups.append(first_index.setdefault(input_key(example), i))
+    return groups, len(examples) - len(first_index)
+
+
+def duplicates_adjacent_sort_key(examples, sort_key_fn):
+    """
+    Wraps sort_key_fn so that examples with the same input end up next to each other after sorting, and thus mostly
+    in the same batch. Every example is sorted as if it were the first example with its input, and ties are broken by
+    the position of that first example.
+    """
+    groups, num_duplicates = group_duplicates(examples)
+    logger.info(f'Found {num_duplicates} examples whose input is a duplicate of another one, out of {len(examples)}')
+    group_of = {id(example): group for example, group in zip(examples, groups)}
+
+    def sort_key(example):
+        group = group_of[id(example)]
+        # sorting is in descending order, so earlier groups get larger keys
+        return sort_key_fn(examples[group]), -group
+
+    return sort_key
+
+
+def unique_rows(batch: NumericalizedExamples):
+    """
+    Finds identical inputs in a collated batch.
+    Returns the indices of the first occurrence of each distinct input, and for every row the position of its
+    input among them.
+    """
+    rows = [batch.context.value]
+    if isinstance(batch.context.feature, torch.Tensor):
+        rows.append(batch.context.feature.flatten(start_dim=1))
+    rows = torch.cat(rows, dim=1).tolist()
+
+    first_index = {}
+    unique_indices, inverse = [], []
+    for i, row in enumerate(rows):
+        row = tuple(row)
+        if row not in first_index:
+            first_index[row] = len(unique_indices)
+            unique_indices.append(i)
+        inverse.append(first_index[row])
+    return unique_indices, inverse
+
+
+def _select_field(field, indices):
+    return SequentialField(
+        value=field.value[indices],
+        length=field.length[indices],
+        limited=field.limited[indices],
+        # features are an empty list when the dataset has none
+        feature=field.feature[indices] if isinstance(field.feature, torch.Tensor) else field.feature,
+    )
+
+
+def select_rows(batch: NumericalizedExamples, indices):
+    index_tensor = torch.tensor(indices, device=batch.context.value.device)
+    return NumericalizedExamples(
+        example_id=[batch.example_id[i] for i in indices],
+        context=_select_field(batch.context, index_tensor),
+        answer=_select_field(batch.answer, index_tensor),
+    )
+
+
+def expand_rows(tensor, inverse):
+    """
+    Undoes select_rows() for a tensor computed from the unique rows, whose first dimension has a fixed number of
+    entries per row (e.g. num_outputs generated sequences, or num_beams attention rows)
+    """
+    num_unique = max(inverse) + 1
+    grouped = tensor.reshape(num_unique, tensor.size(0) // num_unique, *tensor.shape[1:])
+    expanded = grouped[torch.tensor(inverse, device=tensor.device)]
+    return expanded.reshape(-1, *tensor.shape[1:])
+
+
+def expand_generated(generated, inverse):
+    """
+    Expands the output of GenieModel.generate() on the unique rows of a batch back to all rows. Only the fields that
+    are read after generation (sequences and cross attentions) are expanded.
+    """
+    generated.sequences = expand_rows(generated.sequences, inverse)
+    cross_attentions = getattr(generated, 'cross_attentions', None)
+    if cross_attentions is not None:
+        generated.cross_attentions = tuple(tuple(expand_rows(layer, inverse) for layer in step) for step in cross_attentions)
+    return generated
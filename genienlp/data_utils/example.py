@@ -32,6 +32,8 @@ from typing import Iterable, List, NamedTuple, Union
 
 import torch
 
+from ..model_utils.telemetry import stage
+
 
 def identity(x, **kw):
     return x
@@ -103,24 +105,25 @@ class Example(object):
 
     @staticmethod
     def from_raw(example_id: str, context: str, question: str, answer: str, preprocess=identity, lower=False):
-        args = [example_id]
-        answer = unicodedata.normalize('NFD', answer)
+        with stage('preprocess'):
+            args = [example_id]
+            answer = unicodedata.normalize('NFD', answer)
 
-        for argname, arg in (('context', context), ('question', question), ('answer', answer)):
-            arg = unicodedata.normalize('NFD', arg)
-            if lower:
-                arg = arg.lower()
+            for argname, arg in (('context', context), ('question', question), ('answer', answer)):
+                arg = unicodedata.normalize('NFD', arg)
+                if lower:
+                    arg = arg.lower()
 
-            sentence = preprocess(arg.rstrip('\n'), field_name=argname, answer=answer, example_id=example_id)
+                sentence = preprocess(arg.rstrip('\n'), field_name=argname, answer=answer, example_id=example_id)
 
-            args.append(sentence)
+                args.append(sentence)
 
-            if argname != 'answer':
-                # we use a placeholder for features here
-                # the features will be produced and overridden via bootleg or database
-                args.append([])
+                if argname != 'answer':
+                    # we use a placeholder for features here
+                    # the features will be produced and overridden via bootleg or database
+                    args.append([])
 
-        return Example(*args)
+            return Example(*args)
 
 
 class NumericalizedExamples(NamedTuple):
@@ -203,7 +206,7 @@ class NumericalizedExamples(NamedTuple):
                 )
 
         else:
-            tokenized_answers = numericalizer.encode_batch([ex.answer for ex in examples], field_name='answer')
+            tokenized_answers = numericalizer.encode_batch([ex.answer for ex in examples])
 
         for i in range(len(examples)):
             numericalized_examples.append(
@@ -230,15 +233,18 @@ class NumericalizedExamples(NamedTuple):
             answer_lengths.append(torch.tensor(batch.answer.length, device=device))
             answer_limiteds.append(torch.tensor(batch.answer.limited, device=device))
 
-        context_values = numericalizer.pad(context_values, pad_id=numericalizer.pad_id)
-        context_limiteds = numericalizer.pad(context_limiteds, pad_id=numericalizer.decoder_pad_id)
+        # padding buckets are shared with batches built in other threads, so each field asks for its length only once
+        context_length = numericalizer.padded_length(max(len(t) for t in context_values))
+        context_values = numericalizer.pad(context_values, pad_id=numericalizer.pad_id, length=context_length)
+        context_limiteds = numericalizer.pad(context_limiteds, pad_id=numericalizer.decoder_pad_id, length=context_length)
         context_lengths = torch.stack(context_lengths, dim=0)
 
         if context_features:
-            context_features = numericalizer.pad(context_features, pad_id=numericalizer.args.db_unk_id)
+            context_features = numericalizer.pad(context_features, pad_id=numericalizer.args.db_unk_id, length=context_length)
 
-        answer_values = numericalizer.pad(answer_values, pad_id=numericalizer.pad_id)
-        answer_limiteds = numericalizer.pad(answer_limiteds, pad_id=numericalizer.decoder_pad_id)
+        answer_length = numericalizer.padded_length(max(len(t) for t in answer_values))
+        answer_values = numericalizer.pad(answer_values, pad_id=numericalizer.pad_id, length=answer_length)
+        answer_limiteds = numericalizer.pad(answer_limiteds, pad_id=numericalizer.decoder_pad_id, length=answer_length)
         answer_lengths = torch.stack(answer_lengths, dim=0)
 
         context = SequentialField(
@@ -34,6 +34,8 @@ import random
 import numpy as np
 import torch
 
+from ..model_utils.telemetry import stage
+
 logger = logging.getLogger(__name__)
 
 _warned_for_batch_size = False
@@ -52,17 +54,36 @@ class LengthSortedIterator(torch.utils.data.Sampler):
         batch_size_fn,
         groups=1,
         batching_algorithm='sample',
+        num_shards=1,
+        shard_id=0,
+        seed=None,
+        token_budget=None,
     ):
         """
         batch_size: can be number of tokens or number of examples, the type is inferred from batch_size_fn
         sort: if False, disables sorting and uses the original order. Useful for evaluation.
         shuffle_and_repeat: if True, the order of returned examples are semi-shuffled, and there is no end to the iterator
         groups: used for sentence batching
+        num_shards, shard_id: used for distributed training. Every shard builds the same sequence of batches and keeps
+            every num_shards-th one, so that consecutive batches (which have similar lengths and the same token budget)
+            are spread across ranks and all ranks do a similar amount of work per step
+        seed: seed of the random generator used to pick batches; must be the same on all shards
+        token_budget: a TokenBudget learned from out-of-memory errors; batches are kept within it in addition to batch_size
         """
         if groups is None:
             groups = 1
         assert batch_size % groups == 0
         assert len(data_source) % groups == 0
+        if num_shards > 1 and not shuffle_and_repeat:
+            raise ValueError('Sharding is only supported for training iterators')
+        if not 0 <= shard_id < num_shards:
+            raise ValueError(f'shard_id must be between 0 and {num_shards - 1}, got {shard_id}')
+        self.num_shards = num_shards
+        self.shard_id = shard_id
+        # keep the random state of all shards in lockstep, independently of other users of the random module
+        self.random = random.Random(seed) if seed is not None else random
+        # cutting batches short would break groups apart
+        self.token_budget = token_budget if groups == 1 else None
 
         self.sort_key = sort_key_fn
         self.batch_size_fn = batch_size_fn
@@ -107,6 +128,23 @@ class LengthSortedIterator(torch.utils.data.Sampler):
     def __len__(self):
         return self.length
 
+    def state_dict(self):
+        """
+        The position of the iterator, from which it produces the same batches when restored with load_state_dict()
+        """
+        return {
+            'random': self.random.getstate(),
+            'last_batch_start_index': self.last_batch_start_index,
+            'data_source_marked': self.data_source_marked.copy(),
+        }
+
+    def load_state_dict(self, state_dict):
+        if len(state_dict['data_source_marked']) != len(self.data_source):
+            raise ValueError('Cannot restore the position of an iterator over a different dataset')
+        self.random.setstate(state_dict['random'])
+        self.last_batch_start_index = state_dict['last_batch_start_index']
+        self.data_source_marked = state_dict['data_source_marked'].copy()
+
     def __iter__(self):
         self.last_batch_start_index = 0
         self.data_source_marked = np.zeros(shape=(len(self.data_source)))
@@ -114,8 +152,20 @@ class LengthSortedIterator(torch.utils.data.Sampler):
         return self
 
     def __next__(self):
+        with stage('batching'):
+            if self.num_shards == 1:
+                return self._next_batch()
+            shard_batch = None
+            for i in range(self.num_shards):
+                batch = self._next_batch()
+                if i == self.shard_id:
+                    shard_batch = batch
+            return shard_batch
+
+    def _next_batch(self):
         batch_of_indices = []
         current_batch_size = 0
+        max_context_length, max_answer_length = 0, 0
         candidate_index = self._get_next_batch_start_index()
         if candidate_index >= len(self.data_source):
             # This is the end of the iterator
@@ -149,6 +199,14 @@ class LengthSortedIterator(torch.utils.data.Sampler):
             if candidate_batch_size > self.batch_size:
                 # the new example would put us over the batch size limit
                 break
+            if self.token_budget is not None:
+                max_context_length = max(max_context_length, candidate_example.context.length)
+                max_answer_length = max(max_answer_length, candidate_example.answer.length)
+                if batch_of_indices and not self.token_budget.fits(
+                    len(batch_of_indices) + 1, max_context_length + max_answer_length
+                ):
+                    # batches this large ran out of memory before
+                    break
 
             batch_of_indices.append(candidate_index)
             if self.batching_algorithm == 'epoch':
@@ -182,7 +240,7 @@ class LengthSortedIterator(torch.utils.data.Sampler):
                 self.data_source_marked = np.zeros(shape=(len(self.data_source)))
                 examples_left_in_epoch = len(self.data_source)
             # if self.groups > 1, this ensures that the start of each batch is a multiply of self.groups, i.e. where a group starts
-            start_idx = random.randrange(0, examples_left_in_epoch / self.groups) * self.groups
+            start_idx = self.random.randrange(0, examples_left_in_epoch / self.groups) * self.groups
             start_idx = self._unmarked_index_to_datasource_index(start_idx)
             return start_idx
         else:
@@ -0,0 +1,138 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import queue
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class _BatchStream(object):
+    """
+    Batches of one training data loader. With `prefetch` > 0, a background thread keeps up to that many batches ready,
+    each paired with the state of the sampler right after producing it, so that the state of the stream is that of the
+    last batch that was actually consumed.
+    """
+
+    def __init__(self, data_loader, prefetch, state_dict=None):
+        # iter() resets the LengthSortedIterator, so restore its state afterwards
+        self._iterator = iter(data_loader)
+        self._sampler = data_loader.batch_sampler
+        if state_dict is not None:
+            self._sampler.load_state_dict(state_dict)
+        self.prefetch = prefetch
+        self._consumed_state = self._sampler.state_dict()
+
+        if prefetch > 0:
+            self._queue = queue.Queue(maxsize=prefetch)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._produce, daemon=True)
+            self._thread.start()
+
+    def _produce(self):
+        while not self._stop.is_set():
+            try:
+                item = (next(self._iterator), self._sampler.state_dict(), None)
+            except BaseException as e:
+                item = (None, None, e)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item[2] is not None:
+                return
+
+    def next(self):
+        if self.prefetch == 0:
+            return next(self._iterator)
+        batch, state, error = self._queue.get()
+        if error is not None:
+            raise error
+        self._consumed_state = state
+        return batch
+
+    def state_dict(self):
+        if self.prefetch == 0:
+            return self._sampler.state_dict()
+        return self._consumed_state
+
+    def close(self):
+        if self.prefetch > 0:
+            self._stop.set()
+            self._thread.join()
+
+
+class MultiTaskSampler(object):
+    """
+    Hands out training batches for each task. With curriculum learning, each task also has an auxiliary data loader,
+    and the choice between the two is made when a batch is requested, with probability `fraction` for the auxiliary one.
+
+    With `prefetch` > 0, every data loader is run ahead by a background thread, which hides the latency of tasks
+    with expensive batches; data loaders should then use their own random generator instead of the global one.
+    The state of the sampler (positions of all data loaders and the curriculum random generator) can be saved
+    and restored to resume training exactly where it stopped.
+    """
+
+    def __init__(self, data_loaders, aux_data_loaders=None, *, prefetch=0, state_dict=None):
+        """
+        data_loaders, aux_data_loaders: lists of (task, DataLoader) whose batch_sampler is a LengthSortedIterator
+        """
+        self.prefetch = prefetch
+        self._streams = {}
+        self._aux_streams = {}
+        for streams, loaders, key in ((self._streams, data_loaders, 'train'), (self._aux_streams, aux_data_loaders, 'aux')):
+            for task, data_loader in loaders or []:
+                task_state = state_dict[key][task.name] if state_dict is not None else None
+                streams[task] = _BatchStream(data_loader, prefetch, task_state)
+        if state_dict is not None:
+            np.random.set_state(state_dict['curriculum_random'])
+
+    def next_batch(self, task, fraction=None):
+        """
+        fraction: probability of taking the batch from the auxiliary data loader of `task`; None if there is none
+        """
+        if fraction is not None and np.random.uniform() < fraction:
+            return self._aux_streams[task].next()
+        return self._streams[task].next()
+
+    def state_dict(self):
+        return {
+            'train': {task.name: stream.state_dict() for task, stream in self._streams.items()},
+            'aux': {task.name: stream.state_dict() for task, stream in self._aux_streams.items()},
+            'curriculum_random': np.random.get_state(),
+        }
+
+    def close(self):
+        for stream in list(self._streams.values()) + list(self._aux_streams.values()):
+            stream.close()
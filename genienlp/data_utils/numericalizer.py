@@ -28,15 +28,19 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import functools
+import hashlib
+import itertools
 import json
 import logging
 import os
+import pickle
 import re
+import time
 from collections import Counter, defaultdict
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import transformers
 from pathos import multiprocessing
-from torch.nn.utils.rnn import pad_sequence
 from transformers import (
     SPIECE_UNDERLINE,
     T5_PRETRAINED_CONFIG_ARCHIVE_MAP,
@@ -57,6 +61,7 @@ from transformers import (
     MBartTokenizerFast,
     NllbTokenizer,
     NllbTokenizerFast,
+    PreTrainedTokenizerFast,
     T5Tokenizer,
     T5TokenizerFast,
     XGLMTokenizer,
@@ -64,10 +69,14 @@ from transformers import (
     XLMRobertaTokenizer,
     XLMRobertaTokenizerFast,
 )
+from transformers.utils import to_py_obj
 
+from ..model_utils.telemetry import stage
+from ..generation_cache import file_identity
 from ..util import get_devices
 from .decoder_vocab import DecoderVocabulary
 from .example import Entity, SequentialField
+from .padding import PaddingBuckets, pad_batch
 
 logger = logging.getLogger(__name__)
 
@@ -99,6 +108,16 @@ ALLOWED_FAST_TOKENIZERS_IF_PREPROCESSING = {
 # for input batches smaller than this value, multiprocessing will not be used due to its overhead
 MULTIPROCESSING_THRESHOLD = 5000
 
+# number of sentences tokenized at once when counting wordpieces for the decoder vocabulary
+VOCAB_STATS_CHUNK_SIZE = 1000
+VOCAB_STATS_FILE = 'vocab-stats.json'
+
+# a pickled copy of the fully initialized tokenizer, including all added tokens
+# loading it skips slow-to-fast conversion and re-adding tokens one at a time, which is slow for large ThingTalk vocabularies
+TOKENIZER_CACHE_FILE = 'tokenizer-cache.pkl'
+# the cache is ignored if any of these files, or the other files written by save_pretrained, changed since it was written
+TOKENIZER_FILES = ('tokenizer.json', 'tokenizer_config.json', 'special_tokens_map.json', 'added_tokens.json')
+
 
 class TransformerNumericalizer(object):
     """
@@ -107,7 +126,8 @@ class TransformerNumericalizer(object):
 
     _special_tokens_to_word_map: List[Tuple[str, str]]
     _special_tokens_to_word_regexes: List[Tuple[re.Pattern, str]]
-    _words_to_special_token_regexes: List[Tuple[re.Pattern, str]]
+    _words_to_special_token: Dict[str, str]
+    _words_to_special_token_regex: Optional[re.Pattern]
 
     def __init__(
         self, pretrained_tokenizer, args, max_generative_vocab, config, src_lang, tgt_lang, vocab_sets, tasks, save_dir=None
@@ -128,11 +148,18 @@ class TransformerNumericalizer(object):
         self._special_tokens_to_word_map = []
         # same, but the token is a regular expression matching that token using \b
         self._special_tokens_to_word_regexes = []
-        # map a space-separated sequence of words to a special token matching that sequence of words using regex
-        self._words_to_special_token_regexes = []
+        # map a space-separated sequence of words to a special token, and a single regex matching any of those sequences
+        self._words_to_special_token = dict()
+        self._words_to_special_token_regex = None
 
         self.args = args
 
+        # wordpiece frequencies used to build the decoder vocabulary, and a fingerprint of the data they were computed on
+        self._vocab_stats = None
+
+        # shared by all fields, so that fields of the same length (e.g. context values and limiteds) are padded alike
+        self._padding_buckets = PaddingBuckets(args.pad_to_multiple_of, args.max_padding_buckets)
+
         self._init_tokenizer(save_dir, config, src_lang, tgt_lang)
 
         self.update_language_dependent_properties(src_lang, tgt_lang)
@@ -188,7 +215,13 @@ class TransformerNumericalizer(object):
         else:
             tokenizer_args.update({'pretrained_model_name_or_path': self._pretrained_name})
 
-        self._tokenizer = AutoTokenizer.from_pretrained(**tokenizer_args)
+        start_time = time.time()
+        self._tokenizer = None
+        if save_dir is not None:
+            self._tokenizer = self._load_tokenizer_cache(save_dir)
+        if self._tokenizer is None:
+            self._tokenizer = AutoTokenizer.from_pretrained(**tokenizer_args)
+        logger.info(f'Loaded {type(self._tokenizer).__name__} in {time.time() - start_time:.2f} seconds')
 
         # We only include the base tokenizers since `isinstance` checks for inheritance
         if isinstance(self._tokenizer, (BertTokenizer, BertTokenizerFast)):
@@ -223,6 +256,64 @@ class TransformerNumericalizer(object):
         # make sure we assigned is_piece_fn
         assert self._tokenizer.is_piece_fn
 
+        # fast tokenizers that do not customize decoding can decode a whole batch at once, see `reverse()`
+        self._decode_batch_natively = (
+            isinstance(self._tokenizer, PreTrainedTokenizerFast)
+            and type(self._tokenizer)._decode is PreTrainedTokenizerFast._decode
+            and type(self._tokenizer).decode is PreTrainedTokenizerFast.decode
+        )
+
+    def _load_tokenizer_cache(self, save_dir):
+        try:
+            with open(os.path.join(save_dir, TOKENIZER_CACHE_FILE), 'rb') as fp:
+                cache = pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f'Ignoring unreadable {TOKENIZER_CACHE_FILE}: {e}')
+            return None
+
+        # pickles are only valid for the library version that wrote them
+        if cache['transformers_version'] != transformers.__version__ or cache['use_fast'] != self._use_fast():
+            return None
+        # and for the tokenizer files they were made from
+        if 'files' not in cache or cache['files'] != self._tokenizer_files_identity(save_dir, cache['files'].keys()):
+            logger.info(f'Tokenizer files in {save_dir} changed; ignoring {TOKENIZER_CACHE_FILE}')
+            return None
+        return cache['tokenizer']
+
+    @staticmethod
+    def _tokenizer_files_identity(save_dir, file_names):
+        identities = dict()
+        for file_name in file_names:
+            path = os.path.join(save_dir, file_name)
+            identities[file_name] = file_identity(path) if os.path.exists(path) else None
+        return identities
+
+    def _save_tokenizer_cache(self, save_dir, saved_files):
+        """
+        saved_files: the files written by save_pretrained, which the cache is checked against when it is loaded
+        """
+        # is_piece_fn is a lambda, which cannot be pickled; it is set again when loading
+        is_piece_fn = self._tokenizer.is_piece_fn
+        del self._tokenizer.is_piece_fn
+        try:
+            cache = {
+                'transformers_version': transformers.__version__,
+                'use_fast': self._use_fast(),
+                'files': self._tokenizer_files_identity(
+                    save_dir, sorted(set(TOKENIZER_FILES) | {os.path.basename(path) for path in saved_files})
+                ),
+                'tokenizer': self._tokenizer,
+            }
+            # write to a temporary file first, so that a concurrent load never sees a partial file
+            tmp_path = os.path.join(save_dir, TOKENIZER_CACHE_FILE + '.tmp')
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump(cache, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, os.path.join(save_dir, TOKENIZER_CACHE_FILE))
+        finally:
+            self._tokenizer.is_piece_fn = is_piece_fn
+
     def update_language_dependent_properties(self, src_lang, tgt_lang):
         # some tokenizers like Mbart do not set src_lang and tgt_lan when initialized; take care of it here
         self._tokenizer.src_lang = src_lang
@@ -255,16 +346,27 @@ class TransformerNumericalizer(object):
             self._build_special_tokens_regexes()
         except FileNotFoundError:
             pass
+        self._vocab_stats = self._load_vocab_stats(save_dir)
 
-    def pad(self, batch, pad_id):
+    def padded_length(self, length):
         """
-        batch: a List of List of integers
+        The length that a batch whose longest sequence has `length` tokens is padded to
         """
-        # TODO account for left padding models
-        return pad_sequence(batch, padding_value=pad_id, batch_first=True)
+        return self._padding_buckets(length)
+
+    def pad(self, batch, pad_id, length=None):
+        """
+        batch: a List of tensors, one per example
+        length: padded length, from padded_length(); tensors that must have the same shape should share it
+        Padding goes on the right: the encoders build position ids with arange, and answers are shifted to compute the loss.
+        """
+        if length is None:
+            length = self.padded_length(max(len(t) for t in batch))
+        return pad_batch(batch, pad_id, length=length)
 
     def save(self, save_dir):
-        self._tokenizer.save_pretrained(save_dir)
+        saved_files = self._tokenizer.save_pretrained(save_dir)
+        self._save_tokenizer_cache(save_dir, saved_files)
         if self.max_generative_vocab is not None:
             with open(os.path.join(save_dir, 'decoder-vocab.txt'), 'w') as fp:
                 for word, _full_idx in self._decoder_words:
@@ -272,6 +374,74 @@ class TransformerNumericalizer(object):
         if len(self._special_tokens_to_word_map) > 0:
             with open(os.path.join(save_dir, 'special-token-preprocessing.json'), 'w') as fp:
                 json.dump(self._special_tokens_to_word_map, fp)
+        if self._vocab_stats is not None:
+            with open(os.path.join(save_dir, VOCAB_STATS_FILE), 'w') as fp:
+                json.dump(self._vocab_stats, fp, ensure_ascii=False)
+
+    def _load_vocab_stats(self, save_dir):
+        try:
+            with open(os.path.join(save_dir, VOCAB_STATS_FILE)) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+
+    def _vocab_stats_fingerprint(self, vocab_sets):
+        # hashing the raw text is much cheaper than tokenizing it
+        # the added vocabulary is included since it changes how the text is tokenized
+        fingerprint = hashlib.sha1()
+        fingerprint.update(self._pretrained_name.encode('utf-8'))
+        fingerprint.update(json.dumps(self._tokenizer.get_added_vocab(), sort_keys=True).encode('utf-8'))
+        for dataset in vocab_sets:
+            for example in dataset:
+                for sentence in (example.context, example.question, example.answer):
+                    fingerprint.update(sentence.encode('utf-8'))
+                    fingerprint.update(b'\0')
+        return fingerprint.hexdigest()
+
+    def _tokenize_for_vocab_stats(self, sentences):
+        if self._tokenizer.is_fast:
+            # the fast tokenizer encodes the whole chunk in parallel, and `tokenize()` is defined as the tokens of `encode_plus()`
+            encodings = self._tokenizer(sentences, add_special_tokens=False)
+            return [encodings.tokens(i) for i in range(len(sentences))]
+        return [self._tokenizer.tokenize(sentence) for sentence in sentences]
+
+    def _count_chunk(self, examples):
+        # tokenize each field of the chunk in one batch, then count in the original order
+        # so that ties in `Counter.most_common` break the same way as counting one sentence at a time
+        tokenized_fields = [
+            self._tokenize_for_vocab_stats([getattr(example, field) for example in examples])
+            for field in ('context', 'question', 'answer')
+        ]
+        counter = Counter()
+        for tokens in zip(*tokenized_fields):
+            for field_tokens in tokens:
+                counter.update(field_tokens)
+        return counter
+
+    def _count_wordpieces(self, vocab_sets):
+        chunks = []
+        for dataset in vocab_sets:
+            iterator = iter(dataset)
+            while True:
+                chunk = list(itertools.islice(iterator, VOCAB_STATS_CHUNK_SIZE))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+        num_examples = sum(len(chunk) for chunk in chunks)
+        if not self._tokenizer.is_fast and num_examples > MULTIPROCESSING_THRESHOLD:
+            multiprocessing_factor = multiprocessing.cpu_count() // len(get_devices(self.args.devices))
+            logger.info('multiprocessing factor for vocabulary statistics is %d', multiprocessing_factor)
+            with multiprocessing.Pool(multiprocessing_factor) as p:
+                counters = p.map(self._count_chunk, chunks)
+        else:
+            counters = map(self._count_chunk, chunks)
+
+        # counters are merged in order, which preserves the order in which wordpieces were first seen
+        decoder_words = Counter()
+        for counter in counters:
+            decoder_words.update(counter)
+        return decoder_words
 
     def build_vocab(self, vocab_sets, tasks):
         special_tokens = []
@@ -300,12 +470,16 @@ class TransformerNumericalizer(object):
             # in this pass, we
             # 1) tokenize everything, to ensure we account for all added tokens
             # 2) we construct a counter of wordpieces in the answers, for the decoder vocabulary
-            decoder_words = Counter()
-            for dataset in vocab_sets:
-                for example in dataset:
-                    decoder_words.update(self._tokenizer.tokenize(example.context))
-                    decoder_words.update(self._tokenizer.tokenize(example.question))
-                    decoder_words.update(self._tokenizer.tokenize(example.answer))
+            # the counts are saved with the model, so training again on the same data does not need to recount
+            fingerprint = self._vocab_stats_fingerprint(vocab_sets)
+            save_dir = getattr(self.args, 'save', None)
+            vocab_stats = self._load_vocab_stats(save_dir) if save_dir is not None else None
+            if vocab_stats is not None and vocab_stats['fingerprint'] == fingerprint:
+                logger.info(f'Reusing vocabulary statistics from {save_dir}')
+                decoder_words = Counter(dict(vocab_stats['counts']))
+            else:
+                decoder_words = self._count_wordpieces(vocab_sets)
+            self._vocab_stats = {'fingerprint': fingerprint, 'counts': list(decoder_words.items())}
 
             # add the required special tokens, if not present already
             # note: if the tokens are not present, it means they are not used natively
@@ -424,8 +598,19 @@ class TransformerNumericalizer(object):
             # and (at the end of the string or followed by a space (positive lookahead))
             token_re = re.compile("(^|(?<= ))" + re.escape(token) + "(^|(?= ))")
             self._special_tokens_to_word_regexes.append((token_re, words))
-            word_re = re.compile("(^|(?<= ))" + re.escape(words) + "($|(?= ))")
-            self._words_to_special_token_regexes.append((word_re, token))
+            # if two tokens map to the same words, the first one wins
+            self._words_to_special_token.setdefault(words, token)
+
+        if self._special_tokens_to_word_map:
+            # undo the preprocessing of all special tokens in one pass over the sentence
+            # the leftmost match wins, and at the same position the longest sequence of words, since alternatives
+            # are tried longest first; so when one sequence is a prefix of another, the longer one is not cut short
+            alternatives = sorted(
+                self._words_to_special_token, key=lambda words: (len(words.split(' ')), len(words)), reverse=True
+            )
+            self._words_to_special_token_regex = re.compile(
+                "(^|(?<= ))(" + '|'.join(re.escape(words) for words in alternatives) + ")($|(?= ))"
+            )
 
     def _init_token_ids(self):
         self.pad_first = self._tokenizer.padding_side == 'left'
@@ -791,25 +976,29 @@ class TransformerNumericalizer(object):
         if isinstance(self._tokenizer, (T5Tokenizer, T5TokenizerFast)):
             sentence = sentence.replace('%', '^^')
             sentence = sentence.replace('#', '~')
-        for regex, replacement in self._words_to_special_token_regexes:
-            sentence = regex.sub(replacement, sentence)
+        if self._words_to_special_token_regex is not None:
+            sentence = self._words_to_special_token_regex.sub(
+                lambda match: self._words_to_special_token[match.group(2)], sentence
+            )
         return sentence
 
     def reverse(self, batch, field_name, skip_special_tokens=True):
-        output = []
-        use_source_tokenizer = True
-        if field_name == 'answer':
-            use_source_tokenizer = False
-        for x in self._tokenizer.batch_decode(
-            batch,
-            skip_special_tokens=skip_special_tokens,
-            clean_up_tokenization_spaces=False,
-            use_source_tokenizer=use_source_tokenizer,
-        ):
+        with stage('detokenize'):
+            if self._decode_batch_natively:
+                # decode the whole batch with a single call into the Rust tokenizer, which decodes sentences in parallel
+                # this is what batch_decode() does one sentence at a time for fast tokenizers, since we do not clean up spaces
+                # (fast tokenizers do not have a separate source tokenizer either)
+                output = self._tokenizer._tokenizer.decode_batch(to_py_obj(batch), skip_special_tokens=skip_special_tokens)
+            else:
+                output = self._tokenizer.batch_decode(
+                    batch,
+                    skip_special_tokens=skip_special_tokens,
+                    clean_up_tokenization_spaces=False,
+                    use_source_tokenizer=field_name != 'answer',
+                )
             if self._preprocess_special_tokens:
-                x = self._undo_special_token_preprocessing(x)
-            output.append(x)
-        return output
+                output = [self._undo_special_token_preprocessing(x) for x in output]
+            return output
 
     def convert_ids_to_tokens(self, batch, skip_special_tokens):
         output = []
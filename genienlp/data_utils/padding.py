@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import bisect
+import threading
+from typing import List, Optional
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+
+class PaddingBuckets(object):
+    """
+    Decides the padded length of a batch.
+    Lengths are rounded up to a multiple of `multiple`, and at most `max_buckets` distinct padded lengths are used,
+    so that batches come in few shapes. This helps the memory allocator reuse blocks, and lets traced graphs and
+    CPU matrix multiplication kernels see the same shapes again.
+
+    Buckets are shared by the threads that build batches, so the padded length of a batch can change from one call to
+    the next; tensors that must have the same shape should be padded to a length obtained from a single call.
+    """
+
+    def __init__(self, multiple: Optional[int] = None, max_buckets: Optional[int] = None):
+        self.multiple = multiple if multiple is not None else 1
+        self.max_buckets = max_buckets
+        # sorted list of padded lengths used so far
+        self._lengths = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __call__(self, length: int) -> int:
+        padded_length = -(-length // self.multiple) * self.multiple
+        if self.max_buckets is None:
+            return padded_length
+
+        with self._lock:
+            i = bisect.bisect_left(self._lengths, padded_length)
+            if i < len(self._lengths) and (self._lengths[i] == padded_length or len(self._lengths) >= self.max_buckets):
+                # reuse the smallest existing bucket that fits
+                return self._lengths[i]
+            if len(self._lengths) >= self.max_buckets:
+                # longer than all existing buckets; grow the largest one instead of adding a new one
+                self._lengths[-1] = padded_length
+            else:
+                self._lengths.insert(i, padded_length)
+            return padded_length
+
+
+def pad_batch(
+    batch: List[torch.Tensor], padding_value, padding_side: str = 'right', length: Optional[int] = None
+) -> torch.Tensor:
+    """
+    Stacks a list of tensors of shape (sequence_length, *) into a tensor of shape (batch_size, length, *)
+    Inputs:
+        padding_side: 'right' appends padding after each sequence, 'left' prepends it
+        length: padded length; defaults to the length of the longest sequence
+    """
+    if padding_side not in ('right', 'left'):
+        raise ValueError(f'Unknown padding side {padding_side}')
+
+    max_length = max(t.size(0) for t in batch)
+    if length is None:
+        length = max_length
+    elif length < max_length:
+        raise ValueError(f'Cannot pad sequences of length {max_length} to length {length}')
+
+    if padding_side == 'right' and length == max_length:
+        return pad_sequence(batch, padding_value=padding_value, batch_first=True)
+
+    padded = batch[0].new_full((len(batch), length) + tuple(batch[0].shape[1:]), padding_value)
+    for i, t in enumerate(batch):
+        if padding_side == 'left':
+            padded[i, length - t.size(0) :] = t
+        else:
+            padded[i, : t.size(0)] = t
+    return padded
@@ -35,6 +35,8 @@ import torch
 
 from . import models
 from .calibrate import ConfidenceEstimator
+from .data_utils.example import Example, NumericalizedExamples
+from .models.mqan_export import TorchScriptGenerator, export_torchscript
 from .util import load_config_file_to_args
 
 logger = logging.getLogger(__name__)
@@ -47,6 +49,64 @@ def parse_argv(parser):
         '--checkpoint_name', default='best.pth', help='Checkpoint file to use (relative to --path, defaults to best.pth)'
     )
     parser.add_argument('-o', '--output', required=True, help='the directory where to export into')
+    parser.add_argument(
+        '--torchscript',
+        action='store_true',
+        help='also export the encoder and a single decoder step as TorchScript graphs, for fast CPU inference (TransformerLSTM only)',
+    )
+
+
+# used as example inputs for tracing, and to check the traced graphs against the model
+TORCHSCRIPT_EXAMPLE_SENTENCES = [
+    'show me restaurants near me .',
+    'what is the weather like in palo alto tomorrow ?',
+    'play some music',
+]
+
+
+def check_torchscript_parity(model, generator, batch):
+    for num_beams, num_outputs in [(1, 1), (4, 2)]:
+        expected = model.generate(
+            batch,
+            max_output_length=20,
+            min_output_length=2,
+            num_outputs=num_outputs,
+            temperature=1.0,
+            repetition_penalty=1.0,
+            top_k=0,
+            top_p=1.0,
+            num_beams=num_beams,
+            num_beam_groups=1,
+            diversity_penalty=0.0,
+            no_repeat_ngram_size=0,
+            do_sample=False,
+        ).sequences
+        actual = generator.generate(
+            batch, max_output_length=20, min_output_length=2, num_outputs=num_outputs, num_beams=num_beams
+        )
+        if not torch.equal(expected, actual):
+            raise ValueError(f'TorchScript generation does not match the model for num_beams={num_beams}')
+
+
+def export_to_torchscript(model, output):
+    if not isinstance(model, models.TransformerLSTM):
+        raise ValueError('TorchScript export is only supported for TransformerLSTM models')
+
+    examples = [
+        Example.from_raw(f'torchscript-{i}', sentence, '', '') for i, sentence in enumerate(TORCHSCRIPT_EXAMPLE_SENTENCES)
+    ]
+    numericalized_examples = NumericalizedExamples.from_examples(examples, model.numericalizer)
+    trace_batch = NumericalizedExamples.collate_batches(numericalized_examples[:2], model.numericalizer, device='cpu')
+    check_batch = NumericalizedExamples.collate_batches(numericalized_examples, model.numericalizer, device='cpu')
+
+    save_directory = os.path.join(output, 'torchscript')
+    export_torchscript(model, save_directory, trace_batch)
+
+    # traced graphs silently bake in any data-dependent control flow, so check them on inputs of a different shape
+    model.set_generation_output_options([])
+    generator = TorchScriptGenerator.load(save_directory, model.numericalizer)
+    check_torchscript_parity(model, generator, check_batch)
+    logger.info(f'Exported TorchScript graphs to {save_directory}')
 
 
 def main(args):
@@ -75,4 +135,7 @@ def main(args):
         dst = os.path.join(args.output, fn)
         shutil.copyfile(src, dst)
 
+    if args.torchscript:
+        export_to_torchscript(model, args.output)
+
     logger.info(f'Successfully exported model from {args.path} to {args.output}')
@@ -0,0 +1,260 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+
+# arguments that change the outputs of generation for the same model and data. Options that only change how the
+# outputs are scored or written (metrics, calibrators, output format) or how examples are batched are left out.
+GENERATION_ARGS = (
+    'model',
+    'is_hf_model',
+    'checkpoint_name',
+    'pred_src_languages',
+    'pred_tgt_languages',
+    'seed',
+    'num_outputs',
+    'temperature',
+    'repetition_penalty',
+    'top_k',
+    'top_p',
+    'num_beams',
+    'num_beam_groups',
+    'diversity_penalty',
+    'no_repeat_ngram_size',
+    'max_output_length',
+    'min_output_length',
+    'mc_dropout_num',
+    'override_confidence_labels',
+    'mixed_precision',
+    'e2e_dialogue_evaluation',
+    'translate_no_answer',
+    'translate_example_split',
+    'translate_only_entities',
+    'translate_return_raw_outputs',
+    'do_alignment',
+    'align_preserve_input_quotation',
+    'align_remove_output_quotation',
+    'align_span_symbol',
+    'align_helper_file',
+    'database_dir',
+)
+
+
+def hash_file(path, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_identity(path):
+    """
+    A cheap stand-in for hash_file(): the size and modification time of the file
+    """
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def hash_examples(examples):
+    """
+    Hash of the text and features of a list of Examples, as they are after the task has preprocessed them
+    """
+    digest = hashlib.sha256()
+    for ex in examples:
+        fields = [
+            ex.example_id,
+            ex.context,
+            ex.question,
+            ex.answer,
+            [vars(entity) for entity in ex.context_feature],
+            [vars(entity) for entity in ex.question_feature],
+        ]
+        digest.update(json.dumps(fields, default=str).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def model_fingerprint(args, file_hash=hash_file):
+    if args.is_hf_model:
+        # models from the hub are identified by their name
+        return args.path
+    # the checkpoint, and the other files next to it: config, tokenizer and vocabulary files. Other checkpoints and
+    # subdirectories (e.g. evaluation results) do not change the outputs.
+    file_names = sorted(
+        file_name
+        for file_name in os.listdir(args.path)
+        if os.path.isfile(os.path.join(args.path, file_name))
+        and (file_name == args.checkpoint_name or not file_name.endswith('.pth'))
+    )
+    return {file_name: file_hash(os.path.join(args.path, file_name)) for file_name in file_names}
+
+
+def generation_key(args, task, dataset, file_hash=hash_file):
+    """
+    Hash of everything that determines the outputs of generation for `dataset` of `task` with `args`: the files of the
+    model (hashed with `file_hash`), the examples after preprocessing, and the generation arguments
+    """
+    key = {
+        'format_version': CACHE_FORMAT_VERSION,
+        'model': model_fingerprint(args, file_hash),
+        'task': task.name,
+        'data': hash_examples(dataset.examples),
+        'args': {name: getattr(args, name, None) for name in GENERATION_ARGS},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class GenerationCache(object):
+    """
+    A directory of the outputs of generation for a task, keyed by everything that determines them: the files of the
+    model, the examples (after preprocessing), and the generation arguments. Re-running prediction with only
+    different metrics, calibrators or output options reuses these outputs instead of generating again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # hashing a checkpoint takes a while, so hashes are kept for as long as the size and mtime of a file stay the same
+        self._file_hashes_path = os.path.join(path, 'file_hashes.json')
+        self._file_hashes = {}
+        if os.path.exists(self._file_hashes_path):
+            with open(self._file_hashes_path) as f:
+                self._file_hashes = json.load(f)
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        size, mtime, digest = self._file_hashes.get(path, (None, None, None))
+        if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            logger.info(f'Hashing {path}')
+            digest = hash_file(path)
+            self._file_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest)
+            tmp_path = self._file_hashes_path + f'.tmp{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._file_hashes, f)
+            os.replace(tmp_path, self._file_hashes_path)
+        return digest
+
+    def entry(self, args, task, dataset):
+        """
+        Returns the GenerationCacheEntry for generating outputs for `dataset` of `task` with `args`. It may or may not
+        have outputs already.
+        """
+        key = generation_key(args, task, dataset, self.file_hash)
+        return GenerationCacheEntry(os.path.join(self.path, key))
+
+
+class GenerationCacheEntry(object):
+    """
+    The outputs of generation for one task: the ValidationOutput in the original order of the examples (without
+    confidence features and scores), and, if they were computed, the confidence features in a ConfidenceFeatureReader
+    directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def confidence_feature_path(self):
+        return os.path.join(self.path, 'confidence_features')
+
+    def _metadata(self):
+        try:
+            with open(os.path.join(self.path, 'metadata.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def has_outputs(self, need_confidence_features=False):
+        metadata = self._metadata()
+        return metadata is not None and (metadata['confidence_features'] or not need_confidence_features)
+
+    def load_output(self):
+        with open(os.path.join(self.path, 'output.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def copy_confidence_features(self, destination):
+        # the store is flat; `destination` is expected to be cleared of an earlier store, see clear_confidence_features()
+        os.makedirs(destination, exist_ok=True)
+        for file_name in os.listdir(self.confidence_feature_path):
+            shutil.copyfile(os.path.join(self.confidence_feature_path, file_name), os.path.join(destination, file_name))
+
+    def writer(self):
+        return GenerationCacheWriter(self)
+
+
+class GenerationCacheWriter(object):
+    """
+    Fills a GenerationCacheEntry. Confidence features are written to `confidence_feature_path` while generating, and
+    the ValidationOutput is set in `validation_output` at the end. The entry only appears once everything is written,
+    so an interrupted or failed run never leaves a partial entry behind.
+    """
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.path = entry.path + f'.tmp{os.getpid()}'
+        self.validation_output = None
+
+    @property
+    def confidence_feature_path(self):
+        return os.path.join(self.path, 'confidence_features')
+
+    def __enter__(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or self.validation_output is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+        output = copy.copy(self.validation_output)
+        # confidence features have their own files, and confidence scores depend on the calibrators of each run
+        output.confidence_features = None
+        output.confidence_scores = None
+        with open(os.path.join(self.path, 'output.pkl'), 'wb') as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(self.path, 'metadata.json'), 'w') as f:
+            json.dump({'confidence_features': os.path.exists(self.confidence_feature_path)}, f)
+        if os.path.exists(self.entry.path):
+            shutil.rmtree(self.entry.path)
+        os.replace(self.path, self.entry.path)
+        logger.info(f'Saved generation outputs to {self.entry.path}')
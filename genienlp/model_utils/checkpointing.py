@@ -0,0 +1,98 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import inspect
+import logging
+
+import torch
+from torch.utils.checkpoint import checkpoint
+from transformers import PreTrainedModel
+
+logger = logging.getLogger(__name__)
+
+# names that `transformers` models use for their list of transformer layers
+LAYER_LIST_NAMES = ('layers', 'layer', 'block')
+
+_checkpointed_classes = {}
+
+
+class _CheckpointedLayerMixin(object):
+    '''
+    Recomputes the activations of this layer during backward instead of keeping them in memory
+    '''
+
+    def forward(self, *args, **kwargs):
+        if not (self.training and torch.is_grad_enabled()):
+            return super().forward(*args, **kwargs)
+        # tensors have to be explicit inputs of checkpoint() (not captured in a closure) for gradients
+        # to flow back through them, so pass all arguments positionally
+        forward = super().forward
+        bound = inspect.signature(forward).bind(*args, **kwargs)
+        bound.apply_defaults()
+        if bound.kwargs:
+            return checkpoint(lambda *inputs: forward(*inputs, **bound.kwargs), *bound.args)
+        return checkpoint(forward, *bound.args)
+
+
+def _checkpointed_class(cls):
+    if cls not in _checkpointed_classes:
+        _checkpointed_classes[cls] = type(f'Checkpointed{cls.__name__}', (_CheckpointedLayerMixin, cls), {})
+    return _checkpointed_classes[cls]
+
+
+def enable_activation_checkpointing(model, every_n_layers=1, decoder_steps=0):
+    '''
+    Turn on activation checkpointing for every `every_n_layers`-th transformer layer of the `transformers` models
+    inside `model` (every_n_layers=1 checkpoints all layers; higher values trade memory for less recomputation).
+    If decoder_steps > 0, the LSTM decoder of TransformerLSTM models is also checkpointed in blocks of that many steps.
+
+    Layers are switched to a subclass in place, so parameter names and state dicts do not change.
+    Returns the number of checkpointed transformer layers.
+    '''
+    num_checkpointed = 0
+    if every_n_layers > 0:
+        for module in list(model.modules()):
+            if not isinstance(module, PreTrainedModel):
+                continue
+            for name, layers in module.named_modules():
+                if not isinstance(layers, torch.nn.ModuleList) or name.rsplit('.', 1)[-1] not in LAYER_LIST_NAMES:
+                    continue
+                for i, layer in enumerate(layers):
+                    if i % every_n_layers == 0 and not isinstance(layer, (_CheckpointedLayerMixin, torch.nn.RNNCellBase)):
+                        layer.__class__ = _checkpointed_class(type(layer))
+                        num_checkpointed += 1
+
+    if decoder_steps > 0:
+        rnn_decoder = getattr(getattr(model, 'decoder', None), 'rnn_decoder', None)
+        if rnn_decoder is None:
+            raise ValueError('Checkpointing decoder steps is only supported for TransformerLSTM models with rnn_layers > 0')
+        rnn_decoder.checkpoint_steps = decoder_steps
+
+    logger.info(f'Activation checkpointing is enabled for {num_checkpointed} transformer layers')
+    return num_checkpointed
@@ -0,0 +1,147 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import contextlib
+import datetime
+import logging
+import os
+
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+
+def world_size_from_env():
+    '''
+    Number of processes started by torchrun (or torch.distributed.launch --use_env); 1 when not launched that way
+    '''
+    return int(os.environ.get('WORLD_SIZE', 1))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    if is_distributed():
+        return dist.get_rank()
+    return int(os.environ.get('RANK', 0))
+
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def get_world_size():
+    if is_distributed():
+        return dist.get_world_size()
+    return 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=None, timeout=None):
+    '''
+    Join the process group set up by torchrun. The rendezvous information (MASTER_ADDR, MASTER_PORT, RANK, WORLD_SIZE)
+    is read from the environment. Returns the device this rank should use.
+    timeout: minutes to wait in collective operations (including barriers) before failing; defaults to torch's
+    '''
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        if not torch.cuda.is_available():
+            raise ValueError('The nccl backend requires CUDA. Use --ddp_backend gloo to train on CPU')
+        device = torch.device('cuda', get_local_rank())
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cuda', get_local_rank()) if torch.cuda.is_available() else torch.device('cpu')
+
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = datetime.timedelta(minutes=timeout)
+    dist.init_process_group(backend=backend, **kwargs)
+    logger.info(f'Initialized {backend} process group: rank {get_rank()} of {get_world_size()} on {device}')
+    return device
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    '''
+    Let rank 0 run the enclosed block (e.g. preprocessing that writes caches) before the other ranks
+    '''
+    if not is_main_process():
+        barrier()
+    try:
+        yield
+    finally:
+        if is_main_process():
+            barrier()
+
+
+def all_reduce_mean(*values):
+    '''
+    Average python numbers across all ranks. Returns them unchanged when not running distributed.
+    '''
+    if not is_distributed():
+        return values
+    device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    tensor = torch.tensor([float(v) for v in values], dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    tensor /= get_world_size()
+    return tuple(tensor.tolist())
+
+
+def all_reduce_sum(value):
+    if not is_distributed():
+        return value
+    device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    tensor = torch.tensor([float(value)], dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item()
+
+
+def broadcast_object(obj, src=0):
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
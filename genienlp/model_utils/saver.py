@@ -32,24 +32,101 @@ Created on Mar 3, 2019
 @author: gcampagn
 '''
 
+import atexit
 import json
 import logging
 import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
 logger = logging.getLogger(__name__)
 
 
+def _snapshot_to_cpu(obj, pin_memory):
+    '''
+    Recursively copy every tensor in a (nested) state dict to CPU memory, so that training can keep
+    updating the parameters in place while the copy is serialized in the background.
+    Device to host copies are issued as non_blocking into pinned buffers when possible; the caller is
+    responsible for synchronizing before the snapshot is read.
+    '''
+    if isinstance(obj, torch.Tensor):
+        tensor = obj.detach()
+        if tensor.is_cuda and pin_memory:
+            try:
+                copy = torch.empty(tensor.size(), dtype=tensor.dtype, layout=tensor.layout, pin_memory=True)
+            except RuntimeError:
+                copy = torch.empty(tensor.size(), dtype=tensor.dtype, layout=tensor.layout)
+            copy.copy_(tensor, non_blocking=True)
+            return copy
+        return tensor.to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        copy = type(obj)((key, _snapshot_to_cpu(value, pin_memory)) for key, value in obj.items())
+        # nn.Module.state_dict() stores version information in an attribute
+        if hasattr(obj, '_metadata'):
+            copy._metadata = obj._metadata
+        return copy
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot_to_cpu(value, pin_memory) for value in obj)
+    else:
+        return obj
+
+
+def _atomic_torch_save(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        torch.save(obj, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_link(src, path):
+    '''
+    Make path refer to the same content as src, with a hard link if the file system supports it and a copy otherwise
+    '''
+    tmp_path = path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def decascore_path(model_path):
+    '''
+    Side file that records the best_decascore of a model file that does not store it itself
+    '''
+    return os.path.splitext(model_path)[0] + '_decascore.json'
+
+
+def _atomic_json_dump(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(obj, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
 class Saver(object):
     '''
     Wrap pytorch's save functionality into an interface similar to tensorflow.train.Saver
 
     In particular, this class takes care of automatically cleaning up old checkpoints,
     and creating checkpoint files to keep track of which saves are valid and which are not.
+
+    If max_inflight_saves > 0, state dicts are snapshotted to CPU and written by a background thread,
+    with at most max_inflight_saves snapshots held in memory at once. checkpoint.json is only updated,
+    and old checkpoints only deleted, after the new checkpoint is fully on disk. Call flush() to wait
+    for pending writes; this also happens automatically at exit.
     '''
 
-    def __init__(self, savedir, max_to_keep=5):
+    def __init__(self, savedir, max_to_keep=5, max_inflight_saves=0):
         self._savedir = savedir
         self._max_to_keep = max_to_keep
         assert max_to_keep >= 1
@@ -58,6 +135,17 @@ class Saver(object):
         self._latest_checkpoint = None
         self._all_checkpoints = None
 
+        self._max_inflight_saves = max_inflight_saves
+        self._executor = None
+        self._inflight = None
+        self._pending = []
+        self._error = None
+        if max_inflight_saves > 0:
+            # a single writer keeps checkpoint.json updates in the same order as the saves
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint-writer')
+            self._inflight = threading.BoundedSemaphore(max_inflight_saves)
+            atexit.register(self.close)
+
     def _maybe_load_last_checkpoints(self):
         if self._loaded_last_checkpoints:
             return
@@ -73,23 +161,113 @@ class Saver(object):
             self._all_checkpoints = []
             self._latest_checkpoint = None
 
-    def save(self, save_model_state_dict, save_opt_state_dict, global_step):
+    def _write_checkpoint(self, save_model_state_dict, save_opt_state_dict, global_step, best):
         self._maybe_load_last_checkpoints()
 
         model_name = 'iteration_' + str(global_step) + '.pth'
         opt_name = 'iteration_' + str(global_step) + '_optim.pth'
 
+        _atomic_torch_save(save_model_state_dict, os.path.join(self._savedir, model_name))
+        _atomic_torch_save(save_opt_state_dict, os.path.join(self._savedir, opt_name))
+        if best:
+            # best.pth outlives the checkpoint it links to, since deleting the checkpoint only removes one name
+            _atomic_link(os.path.join(self._savedir, model_name), os.path.join(self._savedir, 'best.pth'))
+            _atomic_link(os.path.join(self._savedir, opt_name), os.path.join(self._savedir, 'best_optim.pth'))
+
         self._latest_checkpoint = model_name
         self._all_checkpoints.append(model_name)
-        if len(self._all_checkpoints) > self._max_to_keep:
+        todelete = []
+        while len(self._all_checkpoints) > self._max_to_keep:
+            todelete.append(self._all_checkpoints.pop(0))
+        _atomic_json_dump(
+            dict(all=self._all_checkpoints, latest=self._latest_checkpoint), os.path.join(self._savedir, 'checkpoint.json')
+        )
+
+        # only delete old checkpoints once checkpoint.json no longer points to them
+        for name in todelete:
             try:
-                todelete = self._all_checkpoints.pop(0)
-                os.unlink(os.path.join(self._savedir, todelete))
-                opt_todelete = todelete.rsplit('.', 1)[0] + '_optim.' + todelete.rsplit('.', 1)[1]
+                os.unlink(os.path.join(self._savedir, name))
+                opt_todelete = name.rsplit('.', 1)[0] + '_optim.' + name.rsplit('.', 1)[1]
                 os.unlink(os.path.join(self._savedir, opt_todelete))
             except (OSError, IOError) as e:
-                logging.warning('Failed to delete old checkpoint: %s', e)
-        torch.save(save_model_state_dict, os.path.join(self._savedir, model_name))
-        torch.save(save_opt_state_dict, os.path.join(self._savedir, opt_name))
-        with open(os.path.join(self._savedir, 'checkpoint.json'), 'w') as fp:
-            json.dump(dict(all=self._all_checkpoints, latest=self._latest_checkpoint), fp)
+                logger.warning('Failed to delete old checkpoint: %s', e)
+
+    def _run_job(self, ready_event, fn, *args):
+        try:
+            if ready_event is not None:
+                ready_event.synchronize()
+            fn(*args)
+        except Exception as e:
+            logger.error('Failed to write checkpoint: %s', e)
+            self._error = e
+        finally:
+            self._inflight.release()
+
+    def submit(self, fn, *args):
+        '''
+        Call fn(*args) on the writer thread, with every tensor in args copied to CPU memory first.
+        Any function that writes state dicts can use this to keep the write off the training thread.
+        '''
+        if self._executor is None:
+            fn(*args)
+            return
+
+        self._raise_pending_error()
+        # block training only if too many snapshots are already waiting to be written
+        self._inflight.acquire()
+        pin_memory = torch.cuda.is_available()
+        args = _snapshot_to_cpu(args, pin_memory)
+        ready_event = None
+        if pin_memory:
+            ready_event = torch.cuda.Event()
+            ready_event.record()
+        self._pending = [future for future in self._pending if not future.done()]
+        self._pending.append(self._executor.submit(self._run_job, ready_event, fn, *args))
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, save_model_state_dict, save_opt_state_dict, global_step, best=False):
+        '''
+        Save a checkpoint. If best is True, best.pth and best_optim.pth are made to point to it as well, from the
+        same snapshot and in the same background job.
+        '''
+        self.submit(self._write_checkpoint, save_model_state_dict, save_opt_state_dict, global_step, best)
+
+    def save_file(self, state_dict, filename):
+        '''
+        Save an arbitrary state dict (e.g. best.pth) in savedir, going through the same writer as checkpoints
+        '''
+        self.submit(_atomic_torch_save, state_dict, os.path.join(self._savedir, filename))
+
+    def save_best_from_file(self, path, best_decascore):
+        '''
+        Make the model file at path (e.g. a validation snapshot) the new best.pth, by moving it on the writer thread.
+        The file is not rewritten, so its best_decascore goes to a side file, see decascore_path().
+        '''
+        self.submit(self._move_to_best, path, best_decascore)
+
+    def _move_to_best(self, path, best_decascore):
+        best_path = os.path.join(self._savedir, 'best.pth')
+        os.replace(path, best_path)
+        _atomic_json_dump({'best_decascore': best_decascore}, decascore_path(best_path))
+
+    def flush(self):
+        for future in self._pending:
+            future.result()
+        self._pending = []
+        self._raise_pending_error()
+
+    def close(self):
+        if self._executor is None:
+            return
+        if self._pending:
+            logger.info('Waiting for %d pending checkpoint writes', len(self._pending))
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            atexit.unregister(self.close)
@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from ..data_utils.example import NumericalizedExamples, SequentialField
+from ..data_utils.progbar import progress_bar
+from ..models.base import GenieModelForGeneration, ValidationOutput
+
+logger = logging.getLogger(__name__)
+
+# how often the parent checks that workers are still alive while it waits on a queue, in seconds
+POLL_INTERVAL = 5
+
+
+def _field_to_device(field, device):
+    return SequentialField(
+        value=field.value.to(device),
+        length=field.length.to(device),
+        limited=field.limited.to(device),
+        # features are an empty list when the dataset has none
+        feature=field.feature.to(device) if isinstance(field.feature, torch.Tensor) else field.feature,
+    )
+
+
+def batch_to_device(batch, device):
+    return NumericalizedExamples(
+        example_id=batch.example_id,
+        context=_field_to_device(batch.context, device),
+        answer=_field_to_device(batch.answer, device),
+    )
+
+
+def _prediction_worker(load_model, args, device, jobs, results):
+    try:
+        model = load_model(args, device)
+    except BaseException:
+        results.put((None, None, traceback.format_exc()))
+        return
+    results.put((None, None, None))
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        batch_idx, task_idx, batch, options = job
+        try:
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=args.mixed_precision):
+                output = model.generate_batches([batch_to_device(batch, device)], args.tasks[task_idx], **options)
+            results.put((batch_idx, output, None))
+        except BaseException:
+            results.put((batch_idx, None, traceback.format_exc()))
+        del batch
+
+
+class ShardedPredictionModel(object):
+    """
+    Takes the place of the model in the process that drives sharded prediction. It numericalizes the data and
+    post-processes generated outputs, but has no weights: only the workers load those.
+    """
+
+    finalize_validation_output = GenieModelForGeneration.finalize_validation_output
+
+    def __init__(self, model_class, args, tasks, save_directory=None, src_lang='en', tgt_lang='en'):
+        self.args = args
+        self.numericalizer = model_class.load_numericalizer(args, tasks, save_directory, src_lang, tgt_lang)
+
+
+class ShardedPredictor(object):
+    """
+    Runs generation on several devices at once. One worker process per device loads its own copy of the model
+    and pulls collated batches from a shared queue, so faster devices simply take more batches. Data is loaded
+    and numericalized only once, in the calling process, and the batch tensors are handed to the workers
+    through shared memory.
+    """
+
+    def __init__(self, args, devices, load_model, queue_size_per_device=2):
+        """
+        load_model: a picklable function (args, device) -> model, called in each worker
+        """
+        context = mp.get_context('spawn')
+        self.jobs = context.Queue(maxsize=queue_size_per_device * len(devices))
+        self.results = context.Queue()
+        self.workers = [
+            context.Process(target=_prediction_worker, args=(load_model, args, device, self.jobs, self.results))
+            for device in devices
+        ]
+        for worker in self.workers:
+            worker.start()
+        # wait until every worker has its model, so loading errors surface before any data is sent
+        for _ in self.workers:
+            _, _, error = self._get_result()
+            if error is not None:
+                self.close()
+                raise RuntimeError(f'Failed to load the model in a prediction worker:\n{error}')
+        logger.info(f'Started {len(self.workers)} prediction workers on {devices}')
+
+    def _check_workers(self):
+        for worker in self.workers:
+            if not worker.is_alive():
+                raise RuntimeError(f'Prediction worker {worker.pid} exited unexpectedly with code {worker.exitcode}')
+
+    def _get_result(self):
+        while True:
+            try:
+                return self.results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+
+    def _put_job(self, job):
+        while True:
+            try:
+                self.jobs.put(job, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                self._check_workers()
+
+    def generate(self, data_iterator, task_idx, **options):
+        """
+        Equivalent to model.generate_batches(data_iterator, args.tasks[task_idx], **options), with batches spread
+        over all workers
+        """
+        return ValidationOutput.concatenate(list(self.iter_generate(data_iterator, task_idx, **options)))
+
+    def iter_generate(self, data_iterator, task_idx, disable_progbar=True, **options):
+        """
+        Equivalent to model.iter_generate_batches(data_iterator, args.tasks[task_idx], **options). Outputs are
+        yielded in the order of data_iterator, as soon as all earlier batches are done.
+        """
+        outputs = {}
+        num_batches = 0
+        next_batch_idx = 0
+
+        def store(result):
+            batch_idx, output, error = result
+            if error is not None:
+                raise RuntimeError(f'Generation failed for batch {batch_idx}:\n{error}')
+            outputs[batch_idx] = output
+
+        for batch in progress_bar(data_iterator, desc='Generating', disable=disable_progbar):
+            self._put_job((num_batches, task_idx, batch, options))
+            num_batches += 1
+            # drain finished batches as we go, so their outputs do not pile up in the queue
+            while True:
+                try:
+                    store(self.results.get_nowait())
+                except queue.Empty:
+                    break
+            while next_batch_idx in outputs:
+                yield outputs.pop(next_batch_idx)
+                next_batch_idx += 1
+        while next_batch_idx < num_batches:
+            if next_batch_idx not in outputs:
+                store(self._get_result())
+                continue
+            yield outputs.pop(next_batch_idx)
+            next_batch_idx += 1
+
+    def close(self):
+        for _ in self.workers:
+            try:
+                self.jobs.put(None, timeout=POLL_INTERVAL)
+            except queue.Full:
+                # workers are stuck or dead after an error
+                break
+        for worker in self.workers:
+            worker.join(timeout=POLL_INTERVAL)
+            if worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,316 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_FILE = 'telemetry.jsonl'
+SECTIONS = ('data', 'forward_backward', 'optimizer')
+TIMINGS_FILE = 'timings.json'
+
+
+class _TaskStats(object):
+    def __init__(self):
+        self.steps = 0
+        self.examples = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.step_time = 0.0
+        self.section_time = defaultdict(float)
+
+
+class StepTelemetry(object):
+    '''
+    Measures training throughput per task: examples and (non-padding) tokens per second, padding ratio, how the time
+    of a step is split between waiting for data, forward/backward and the optimizer, and peak GPU memory.
+    Statistics are accumulated between calls to flush(), which writes them to TensorBoard and to a JSONL file.
+
+    If profile_iterations = (start, end) is given, a torch.profiler trace of iterations [start, end) is saved as well.
+    When not enabled, all methods except the profiler are no-ops.
+    '''
+
+    def __init__(self, log_dir, writer, device, enabled=True, profile_iterations=None, log_prefix='training'):
+        self.enabled = enabled
+        self.log_dir = log_dir
+        self.writer = writer
+        self.log_prefix = log_prefix
+        self.sync_cuda = device.type == 'cuda'
+        self.device = device
+        self.jsonl_path = os.path.join(log_dir, TELEMETRY_FILE)
+        self.profile_iterations = profile_iterations
+        self._profiler = None
+        self._stats = defaultdict(_TaskStats)
+        self._current = None
+        self._step_start = None
+
+    def _synchronize(self):
+        # CUDA kernels run asynchronously, so without this time would be attributed to whichever section waits first
+        if self.sync_cuda:
+            torch.cuda.synchronize(self.device)
+
+    def begin_step(self, task, iteration):
+        if self.profile_iterations is not None:
+            start, end = self.profile_iterations
+            if iteration == start:
+                self._start_profiler()
+            elif iteration == end and self._profiler is not None:
+                self._stop_profiler(start, end)
+        if not self.enabled:
+            return
+        self._current = self._stats[task.name]
+        self._step_start = time.perf_counter()
+
+    def end_step(self, batch):
+        if self._current is None:
+            return
+        self._synchronize()
+        stats = self._current
+        stats.step_time += time.perf_counter() - self._step_start
+        stats.steps += 1
+        stats.examples += batch.context.value.size(0)
+        for field in (batch.context, batch.answer):
+            stats.tokens += int(field.length.sum())
+            stats.padded_tokens += field.value.numel()
+        self._current = None
+
+    def abort_step(self):
+        # the step did not complete (e.g. skipped because of OOM)
+        self._current = None
+
+    @contextlib.contextmanager
+    def section(self, name):
+        if self._current is None:
+            yield
+            return
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self._current.section_time[name] += time.perf_counter() - start
+
+    def _start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._profiler.start()
+
+    def _stop_profiler(self, start, end):
+        self._profiler.stop()
+        trace_path = os.path.join(self.log_dir, f'profile_iteration_{start}-{end}.json')
+        self._profiler.export_chrome_trace(trace_path)
+        self._profiler = None
+        logger.info(f'Saved profiler trace to {trace_path}')
+
+    def flush(self, iteration):
+        if not self.enabled:
+            return
+        peak_memory = None
+        if self.sync_cuda:
+            peak_memory = torch.cuda.max_memory_allocated(self.device) / 2**20
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        records = []
+        for task_name, stats in self._stats.items():
+            if stats.steps == 0 or stats.step_time == 0:
+                continue
+            record = {
+                'iteration': iteration,
+                'task': task_name,
+                'steps': stats.steps,
+                'examples_per_sec': stats.examples / stats.step_time,
+                'tokens_per_sec': stats.tokens / stats.step_time,
+                'padding_ratio': 1.0 - stats.tokens / max(stats.padded_tokens, 1),
+                'sec_per_step': stats.step_time / stats.steps,
+            }
+            for name in SECTIONS:
+                record[f'{name}_fraction'] = stats.section_time[name] / stats.step_time
+            record['other_fraction'] = max(0.0, 1.0 - sum(record[f'{name}_fraction'] for name in SECTIONS))
+            if peak_memory is not None:
+                record['peak_memory_mb'] = peak_memory
+            records.append(record)
+
+            if self.writer is not None:
+                for key, value in record.items():
+                    if key not in ('iteration', 'task'):
+                        self.writer.add_scalar(f'{self.log_prefix}/throughput/{task_name}/{key}', value, iteration)
+
+        self._stats.clear()
+        if records:
+            with open(self.jsonl_path, 'a') as fp:
+                for record in records:
+                    fp.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self._profiler is not None:
+            # training ended inside the profiling window
+            self._stop_profiler(self.profile_iterations[0], 'end')
+
+
+class _StageStats(object):
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.counters = defaultdict(int)
+
+    def to_dict(self):
+        result = {'seconds': self.seconds, 'calls': self.calls}
+        for name, value in sorted(self.counters.items()):
+            result[name] = value
+            if self.seconds > 0:
+                result[f'{name}_per_sec'] = value / self.seconds
+        return result
+
+
+class StageTimings(object):
+    """
+    Measures how much time a prediction run spends in each of its stages (reading data, numericalization, encoding,
+    decoding, writing outputs, ...) and counts what each stage processed, e.g. examples or tokens, per task.
+
+    The time of a stage does not include the stages nested in it, so that the stages of a thread add up to its running
+    time. Post-processing threads work while generation runs, so all stages together can take longer than the run.
+    Code reports to the instance made active with record_stages() through the module-level stage() and
+    count_stage(), which do nothing when there is none.
+    """
+
+    def __init__(self):
+        self.task = None  # stages are attributed to this task as well as to the whole run
+        self._stats = defaultdict(_StageStats)  # (task, stage name) -> _StageStats
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.perf_counter()
+
+    @staticmethod
+    def _synchronize():
+        # CUDA kernels run asynchronously, so without this their time would be attributed to the next stage that waits
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def stage(self, name, synchronize=False):
+        if not hasattr(self._local, 'nested_time'):
+            self._local.nested_time = []
+        nested_time = self._local.nested_time
+        if synchronize:
+            self._synchronize()
+        start = time.perf_counter()
+        nested_time.append(0.0)
+        try:
+            yield
+        finally:
+            if synchronize:
+                self._synchronize()
+            elapsed = time.perf_counter() - start
+            own_time = elapsed - nested_time.pop()
+            if nested_time:
+                nested_time[-1] += elapsed
+            with self._lock:
+                stats = self._stats[(self.task, name)]
+                stats.seconds += own_time
+                stats.calls += 1
+
+    def count(self, name, **counters):
+        with self._lock:
+            stats = self._stats[(self.task, name)]
+            for counter, value in counters.items():
+                stats.counters[counter] += int(value)
+
+    def report(self):
+        stages = defaultdict(_StageStats)
+        tasks = defaultdict(dict)
+        for (task, name), stats in sorted(self._stats.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+            total = stages[name]
+            total.seconds += stats.seconds
+            total.calls += stats.calls
+            for counter, value in stats.counters.items():
+                total.counters[counter] += value
+            if task is not None:
+                tasks[task][name] = stats.to_dict()
+        return {
+            'total_seconds': time.perf_counter() - self._start,
+            'stages': {name: stats.to_dict() for name, stats in stages.items()},
+            'tasks': dict(tasks),
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write('\n')
+        logger.info(f'Saved timings of prediction stages to {path}')
+
+
+_active_timings = None
+_no_stage = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def record_stages(timings):
+    """
+    Makes `timings` receive the stages reported with stage() and count_stage() in this process
+    """
+    global _active_timings
+    previous, _active_timings = _active_timings, timings
+    try:
+        yield timings
+    finally:
+        _active_timings = previous
+
+
+def stage(name, synchronize=False):
+    """
+    Context manager that times a stage of prediction, if timings are being recorded.
+    synchronize: wait for CUDA kernels at the start and end of the stage, for stages that run the model
+    """
+    if _active_timings is None:
+        return _no_stage
+    return _active_timings.stage(name, synchronize)
+
+
+def count_stage(name, **counters):
+    """
+    Adds to the counters of a stage, e.g. count_stage('decoder', tokens=...)
+    """
+    if _active_timings is not None:
+        _active_timings.count(name, **counters)
+
+
+def set_stage_task(task_name):
+    if _active_timings is not None:
+        _active_timings.task = task_name
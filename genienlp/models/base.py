@@ -30,7 +30,9 @@
 import copy
 import logging
 import os
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 
 import dialogues
@@ -39,9 +41,13 @@ import ujson
 from dateparser.languages import default_loader
 from transformers import AutoConfig, BartForConditionalGeneration, MarianTokenizer, PreTrainedModel
 
+from ..data_utils.adaptive_batching import run_with_oom_splitting
+from ..data_utils.deduplication import expand_generated, select_rows, unique_rows
 from ..data_utils.example import NumericalizedExamples, SequentialField
 from ..data_utils.numericalizer import TransformerNumericalizer
 from ..data_utils.progbar import progress_bar
+from ..model_utils.saver import decascore_path
+from ..model_utils.telemetry import count_stage, stage
 from ..util import adjust_language_code, merge_translated_sentences, replace_capturing_group
 
 logger = logging.getLogger(__name__)
@@ -63,6 +69,7 @@ class GenieModel(PreTrainedModel):
         tasks = kwargs.pop("tasks", None)
         vocab_sets = kwargs.pop("vocab_sets", None)
 
+        start_time = time.time()
         full_checkpoint_path = os.path.join(save_directory, model_checkpoint_file)
         logger.info(f'Loading the model from {full_checkpoint_path}')
         model = cls(args=args, tasks=tasks, vocab_sets=vocab_sets, save_directory=save_directory, *model_args, **kwargs)
@@ -82,8 +89,14 @@ class GenieModel(PreTrainedModel):
             save_dict['model_state_dict']['model.lm_head.weight'] = save_dict['model_state_dict']['model.model.shared.weight']
 
         model.load_state_dict(save_dict['model_state_dict'], strict=True)
+        logger.info(f'Loaded the model in {time.time() - start_time:.2f} seconds')
 
-        return model, save_dict.get('best_decascore')
+        best_decascore = save_dict.get('best_decascore')
+        if best_decascore is None and os.path.exists(decascore_path(full_checkpoint_path)):
+            # best models promoted from validation snapshots keep their score next to them
+            with open(decascore_path(full_checkpoint_path)) as fp:
+                best_decascore = ujson.load(fp)['best_decascore']
+        return model, best_decascore
 
     def add_new_vocab_from_data(self, tasks, resize_decoder=False):
         old_num_tokens = self.numericalizer.num_tokens
@@ -126,9 +139,79 @@ class ValidationOutput(object):
         self.confidence_features = confidence_features
         self.confidence_scores = confidence_scores
 
+    @staticmethod
+    def concatenate(outputs: List['ValidationOutput']):
+        """
+        Concatenate the per-batch outputs of GenieModelForGeneration.iter_generate_batches() into one
+        """
+        losses = [output.loss for output in outputs if output.loss is not None]
+        result = ValidationOutput(
+            loss=sum(losses) if losses else None,
+            example_ids=[],
+            predictions=[],
+            raw_predictions=[],
+            answers=[],
+            contexts=[],
+            confidence_features=[],
+        )
+        for output in outputs:
+            for field in ('example_ids', 'predictions', 'raw_predictions', 'answers', 'contexts', 'confidence_features'):
+                getattr(result, field).extend(getattr(output, field))
+        return result
+
+
+class Generation(object):
+    """
+    The output of one generate() call for a batch, on its way from the model to post-processing
+    """
+
+    def __init__(self, num_outputs: int, prediction_ids):
+        self.num_outputs = num_outputs
+        self.prediction_ids = prediction_ids
+        self.raw_prediction_ids = None
+        self.words = None
+        self.cross_attentions = None
+        self.confidence_features = None
+
+    def to_cpu(self):
+        """
+        Move tensors off the accelerator, so that post-processing does not hold on to its memory
+        """
+        if isinstance(self.prediction_ids, torch.Tensor):
+            self.prediction_ids = self.prediction_ids.cpu()
+        if isinstance(self.raw_prediction_ids, torch.Tensor):
+            self.raw_prediction_ids = self.raw_prediction_ids.cpu()
+        if self.cross_attentions is not None:
+            self.cross_attentions = self.cross_attentions.cpu()
+
 
 # TransformerSeq2Seq and TransformerLSTM will inherit from this model
 class GenieModelForGeneration(GenieModel):
+    # whether the decoder generates from a vocabulary limited to --max_generative_vocab words
+    limits_generative_vocab = False
+
+    @classmethod
+    def load_numericalizer(cls, args, tasks, save_directory=None, src_lang='en', tgt_lang='en'):
+        """
+        Creates the numericalizer that the model saved in `save_directory` (or the pretrained model if it is None) has
+        after add_new_vocab_from_data(tasks), without building the model or loading its weights
+        """
+        config = AutoConfig.from_pretrained(args.pretrained_model, cache_dir=args.embeddings)
+        src_lang, tgt_lang = adjust_language_code(config, args.pretrained_model, src_lang, tgt_lang)
+        numericalizer = TransformerNumericalizer(
+            args.pretrained_model,
+            args,
+            max_generative_vocab=args.max_generative_vocab if cls.limits_generative_vocab else None,
+            save_dir=save_directory,
+            config=config,
+            src_lang=src_lang,
+            tgt_lang=tgt_lang,
+            vocab_sets=None,
+            tasks=tasks,
+        )
+        numericalizer.grow_vocab(tasks)
+        return numericalizer
+
     def numericalize_example(self, input_text, turn_id, device):
         if isinstance(input_text, str):
             input_text = [input_text]
@@ -157,6 +240,9 @@ class GenieModelForGeneration(GenieModel):
         original_order=None,
         confidence_estimators=None,
         disable_progbar=True,
+        output_contexts=True,
+        output_answers=True,
+        token_budget=None,
         **kwargs,
     ):
         if self.args.e2e_dialogue_evaluation:
@@ -172,6 +258,9 @@ class GenieModelForGeneration(GenieModel):
                 original_order,
                 confidence_estimators,
                 disable_progbar,
+                output_contexts,
+                output_answers,
+                token_budget,
             )
 
     def validate_batch(
@@ -183,25 +272,88 @@ class GenieModelForGeneration(GenieModel):
         original_order=None,
         confidence_estimators=None,
         disable_progbar=True,
+        output_contexts=True,
+        output_answers=True,
+        token_budget=None,
     ):
         """
         Inputs:
             original_order: List of indices. If provided, we will sort the results according to this order
             confidence_estimator: if provided, will use it to calculate and output confidence scores
+            output_contexts: if False, contexts are not decoded back to text and are returned as empty strings
+            output_answers: if False, gold answers are not decoded back to text and are returned as empty strings
+            token_budget: with --split_OOM_batches, the TokenBudget of data_iterator, which learns from batches that run out of memory
         Outputs: predictions if `output_predictions_only` == True, (loss, predictions, answers, contexts) otherwise
             loss
             predictions: a List of Lists of strings
             answers
             contexts
         """
-        total_loss = 0.0 if 'loss' in task.metrics else None
-        output_confidence_scores = confidence_estimators is not None
-        predictions = []
-        raw_predictions = []
-        confidence_features = []
-        example_ids = []
-        answers = []
-        contexts = []
+        generation_output = self.generate_batches(
+            data_iterator,
+            task,
+            output_predictions_only=output_predictions_only,
+            output_confidence_features=output_confidence_features or confidence_estimators is not None,
+            disable_progbar=disable_progbar,
+            output_contexts=output_contexts,
+            output_answers=output_answers,
+            token_budget=token_budget,
+        )
+        return self.finalize_validation_output(
+            generation_output,
+            output_predictions_only=output_predictions_only,
+            output_confidence_features=output_confidence_features,
+            original_order=original_order,
+            confidence_estimators=confidence_estimators,
+        )
+
+    def generate_batches(
+        self,
+        data_iterator,
+        task,
+        output_predictions_only=False,
+        output_confidence_features=False,
+        disable_progbar=True,
+        output_contexts=True,
+        output_answers=True,
+        token_budget=None,
+    ):
+        """
+        First half of validate_batch(): runs generation on every batch of data_iterator.
+        Returns a ValidationOutput with one entry per example in the order of data_iterator, all fields filled in,
+        and the sum of batch losses as loss. Outputs for different batches can be concatenated before
+        they are passed to finalize_validation_output().
+        """
+        return ValidationOutput.concatenate(
+            list(
+                self.iter_generate_batches(
+                    data_iterator,
+                    task,
+                    output_predictions_only=output_predictions_only,
+                    output_confidence_features=output_confidence_features,
+                    disable_progbar=disable_progbar,
+                    output_contexts=output_contexts,
+                    output_answers=output_answers,
+                    token_budget=token_budget,
+                )
+            )
+        )
+
+    def iter_generate_batches(
+        self,
+        data_iterator,
+        task,
+        output_predictions_only=False,
+        output_confidence_features=False,
+        disable_progbar=True,
+        output_contexts=True,
+        output_answers=True,
+        token_budget=None,
+    ):
+        """
+        Like generate_batches(), but yields one ValidationOutput per batch of data_iterator as soon as it is generated
+        """
+        compute_loss = 'loss' in task.metrics
 
         if self.numericalizer._tokenizer.tgt_lang:
             tgt_lang = self.numericalizer._tokenizer.tgt_lang
@@ -216,52 +368,80 @@ class GenieModelForGeneration(GenieModel):
         date_parser = default_loader.get_locale(src_lang[:2])
 
         translate_return_raw_outputs = getattr(self.args, 'translate_return_raw_outputs', False)
-
-        for batch in progress_bar(data_iterator, desc='Generating', disable=disable_progbar):
+        # with sampling, every copy of an input should get its own sample
+        dedupe_inputs = getattr(self.args, 'dedupe_inputs', False) and all(t == 0 for t in self.args.temperature)
+        dedupe_stats = {'examples': 0, 'generated': 0}
+
+        def postprocess_prediction_ids(example_ids, context_values, prediction_ids, cross_attentions):
+            """
+            Task-specific post-processing of generated ids that needs the cross attentions (e.g. alignment in translation).
+            Returns the new ids, and the words they stand for if the task produced them.
+            """
+            kwargs = {
+                'numericalizer': self.numericalizer,
+                'cross_attentions': cross_attentions,
+                'tgt_lang': tgt_lang,
+                'date_parser': date_parser,
+            }
+            return task.batch_postprocess_prediction_ids(example_ids, context_values, prediction_ids, **kwargs)
+
+        def generate_batch(batch):
+            """
+            The part of a batch that needs the model: loss, generation and confidence features.
+            Returns the loss and, for every hyperparameter set, a Generation whose tensors are on the CPU.
+            """
             batch_size = len(batch.example_id)
-            batch_prediction = [[] for _ in range(batch_size)]
-            batch_raw_prediction = [[] for _ in range(batch_size)]
-            batch_confidence_features = [[] for _ in range(batch_size)]
-            batch_example_ids = batch.example_id
-
-            example_ids += batch_example_ids
-            if not output_predictions_only:
-                batch_answer = self.numericalizer.reverse(batch.answer.value.data, 'answer')
-                batch_answer = [
-                    task.postprocess_prediction(batch_example_ids[i], batch_answer[i]) for i in range(len(batch_answer))
-                ]
-                answers += batch_answer
-                batch_context = self.numericalizer.reverse(batch.context.value.data, 'context')
-                contexts += batch_context
-            elif output_confidence_features:
-                # need gold answer for confidence estimation
-                batch_answer = self.numericalizer.reverse(batch.answer.value.data, 'answer')
-                answers += batch_answer
-
-            if total_loss is not None:
-                loss = self.forward(batch, train=True).loss.item()
-                total_loss += loss
 
+            loss = None
+            if compute_loss:
+                with stage('loss', synchronize=True):
+                    loss = self.forward(batch, train=True).loss.item()
+
+            # generate identical inputs only once, and copy the outputs to all of them before any per-example processing
+            generation_batch, inverse = batch, None
+            if dedupe_inputs:
+                unique_indices, inverse = unique_rows(batch)
+                if len(unique_indices) < batch_size:
+                    generation_batch = select_rows(batch, unique_indices)
+                dedupe_stats['examples'] += batch_size
+                dedupe_stats['generated'] += len(unique_indices)
+
+            # the encoder output only depends on the input, so it is shared by all hyperparameter sets
+            with stage('encoder', synchronize=True):
+                encoder_output = self.encode_for_generation(generation_batch)
+            count_stage('encoder', examples=len(generation_batch.example_id), tokens=generation_batch.context.length.sum())
+
+            generations = []
             for hyperparameter_idx in range(len(self.args.temperature)):
-                generated = self.generate(
-                    batch,
-                    max_output_length=self.args.max_output_length,
-                    min_output_length=self.args.min_output_length,
-                    num_outputs=self.args.num_outputs[hyperparameter_idx],
-                    temperature=self.args.temperature[hyperparameter_idx]
-                    if self.args.temperature[hyperparameter_idx] > 0
-                    else 1.0,
-                    repetition_penalty=self.args.repetition_penalty[hyperparameter_idx],
-                    top_k=self.args.top_k[hyperparameter_idx],
-                    top_p=self.args.top_p[hyperparameter_idx],
-                    num_beams=self.args.num_beams[hyperparameter_idx],
-                    num_beam_groups=self.args.num_beam_groups[hyperparameter_idx],
-                    diversity_penalty=self.args.diversity_penalty[hyperparameter_idx],
-                    no_repeat_ngram_size=self.args.no_repeat_ngram_size[hyperparameter_idx],
-                    do_sample=self.args.temperature[hyperparameter_idx] != 0,  # if temperature==0, we do not sample
+                with stage('decoder', synchronize=True):
+                    generated = self.generate(
+                        generation_batch,
+                        max_output_length=self.args.max_output_length,
+                        min_output_length=self.args.min_output_length,
+                        num_outputs=self.args.num_outputs[hyperparameter_idx],
+                        temperature=self.args.temperature[hyperparameter_idx]
+                        if self.args.temperature[hyperparameter_idx] > 0
+                        else 1.0,
+                        repetition_penalty=self.args.repetition_penalty[hyperparameter_idx],
+                        top_k=self.args.top_k[hyperparameter_idx],
+                        top_p=self.args.top_p[hyperparameter_idx],
+                        num_beams=self.args.num_beams[hyperparameter_idx],
+                        num_beam_groups=self.args.num_beam_groups[hyperparameter_idx],
+                        diversity_penalty=self.args.diversity_penalty[hyperparameter_idx],
+                        no_repeat_ngram_size=self.args.no_repeat_ngram_size[hyperparameter_idx],
+                        do_sample=self.args.temperature[hyperparameter_idx] != 0,  # if temperature==0, we do not sample
+                        encoder_output=encoder_output,
+                    )
+                count_stage(
+                    'decoder',
+                    examples=len(generation_batch.example_id),
+                    tokens=(generated.sequences != self.numericalizer.pad_id).sum(),
+                )
+                if generation_batch is not batch:
+                    generated = expand_generated(generated, inverse)
+                generation = Generation(
+                    num_outputs=self.args.num_outputs[hyperparameter_idx], prediction_ids=generated.sequences
                 )
-                partial_batch_prediction_ids = generated.sequences
-                partial_batch_words = None
 
                 if getattr(task, 'need_attention_scores', False):
                     cross_attentions = generated.cross_attentions
@@ -275,64 +455,191 @@ class GenieModelForGeneration(GenieModel):
 
                     # choose only last layer attentions
                     # cross_attentions = torch.mean(cross_attentions[-3:, ...], dim=0)
-                    cross_attentions = cross_attentions[-1, ...]
-
-                    # postprocess prediction ids
-                    kwargs = {
-                        'numericalizer': self.numericalizer,
-                        'cross_attentions': cross_attentions,
-                        'tgt_lang': tgt_lang,
-                        'date_parser': date_parser,
-                    }
+                    generation.cross_attentions = cross_attentions[-1, ...]
+
+                if output_confidence_features:
+                    # confidence features are computed from the post-processed ids, so post-process them here
+                    postprocess_generation(batch.example_id, batch.context.value.data, generation)
+                    # MarianTokenizer uses two different spm models for encoding source and target languages.
+                    # in almond_translate we postprocess text with alignment which produces code-switched sentences.
+                    # encoding a code-switched sentence with either spm will omit tokens from the other language
+                    # so we have to return both the processed and encoded text.
+                    # we need to return encoded text too since confidence_features requires ids
+                    if not (isinstance(self.numericalizer._tokenizer, MarianTokenizer) and generation.words):
+                        with stage('confidence_features', synchronize=True):
+                            generation.confidence_features = self.confidence_features(
+                                batch=batch, predictions=generation.prediction_ids, mc_dropout_num=self.args.mc_dropout_num
+                            )
 
-                    if translate_return_raw_outputs:
-                        partial_batch_raw_prediction_ids = partial_batch_prediction_ids
+                generation.to_cpu()
+                generations.append(generation)
 
-                    partial_batch_prediction_ids, partial_batch_words = task.batch_postprocess_prediction_ids(
-                        batch_example_ids, batch.context.value.data, partial_batch_prediction_ids, **kwargs
-                    )
+            return loss, generations
 
-                # MarianTokenizer uses two different spm models for encoding source and target languages.
-                # in almond_translate we postprocess text with alignment which produces code-switched sentences.
-                # encoding a code-switched sentence with either spm will omit tokens from the other language
-                # so we have to return both the processed and encoded text.
-                # we need to return encoded text too since confidence_features requires ids
-                if isinstance(self.numericalizer._tokenizer, MarianTokenizer) and partial_batch_words:
-                    partial_batch_prediction = partial_batch_words
+        def postprocess_generation(example_ids, context_values, generation):
+            if generation.cross_attentions is None:
+                return
+            if translate_return_raw_outputs:
+                generation.raw_prediction_ids = generation.prediction_ids
+            with stage('postprocess'):
+                generation.prediction_ids, generation.words = postprocess_prediction_ids(
+                    example_ids, context_values, generation.prediction_ids, generation.cross_attentions
+                )
+            generation.cross_attentions = None
+
+        def postprocess_batch(*args):
+            with stage('postprocess'):
+                output = _postprocess_batch(*args)
+            count_stage('postprocess', examples=len(output.example_ids))
+            return output
+
+        def _postprocess_batch(example_ids, answer_values, context_values, sub_batches, total_loss):
+            """
+            The part of a batch that only needs the CPU: turning ids into text and post-processing it.
+            sub_batches has one (example_ids, context_values, output of generate_batch()) tuple per part of the batch that
+            was generated separately.
+            """
+            batch_size = len(example_ids)
+            answers, contexts = [], []
+            if not output_predictions_only:
+                if output_answers:
+                    batch_answer = self.numericalizer.reverse(answer_values, 'answer')
+                    answers = [task.postprocess_prediction(example_ids[i], batch_answer[i]) for i in range(len(batch_answer))]
                 else:
-                    if output_confidence_features or output_confidence_scores:
-                        partial_batch_confidence_features = self.confidence_features(
-                            batch=batch, predictions=partial_batch_prediction_ids, mc_dropout_num=self.args.mc_dropout_num
-                        )
-                    partial_batch_prediction = self.numericalizer.reverse(partial_batch_prediction_ids, 'answer')
+                    answers = [''] * batch_size
+                if output_contexts:
+                    contexts = self.numericalizer.reverse(context_values, 'context')
+                else:
+                    contexts = [''] * batch_size
+            elif output_confidence_features:
+                # need gold answer for confidence estimation
+                answers = self.numericalizer.reverse(answer_values, 'answer')
+
+            predictions, raw_predictions, confidence_features = [], [], []
+            for sub_batch_example_ids, sub_batch_context_values, (_, generations) in sub_batches:
+                sub_batch_size = len(sub_batch_example_ids)
+                batch_prediction = [[] for _ in range(sub_batch_size)]
+                batch_raw_prediction = [[] for _ in range(sub_batch_size)]
+                batch_confidence_features = [[] for _ in range(sub_batch_size)]
+
+                for generation in generations:
+                    postprocess_generation(sub_batch_example_ids, sub_batch_context_values, generation)
+                    if isinstance(self.numericalizer._tokenizer, MarianTokenizer) and generation.words:
+                        partial_batch_prediction = generation.words
+                    else:
+                        partial_batch_prediction = self.numericalizer.reverse(generation.prediction_ids, 'answer')
+
+                    def get_example_index(i):
+                        return (i // generation.num_outputs) % sub_batch_size
 
-                def get_example_index(i):
-                    return (i // self.args.num_outputs[hyperparameter_idx]) % batch_size
+                    if translate_return_raw_outputs:
+                        partial_batch_raw_prediction = self.numericalizer.reverse(generation.raw_prediction_ids, 'answer')
+                        for i in range(len(partial_batch_prediction)):
+                            partial_batch_raw_prediction[i] = task.postprocess_prediction(
+                                sub_batch_example_ids[get_example_index(i)], partial_batch_raw_prediction[i]
+                            )
+                        for i in range(len(partial_batch_prediction)):
+                            batch_raw_prediction[get_example_index(i)].append(partial_batch_raw_prediction[i])
 
-                if translate_return_raw_outputs:
-                    partial_batch_raw_prediction = self.numericalizer.reverse(partial_batch_raw_prediction_ids, 'answer')
+                    # post-process predictions
                     for i in range(len(partial_batch_prediction)):
-                        partial_batch_raw_prediction[i] = task.postprocess_prediction(
-                            batch_example_ids[get_example_index(i)], partial_batch_raw_prediction[i]
+                        partial_batch_prediction[i] = task.postprocess_prediction(
+                            sub_batch_example_ids[get_example_index(i)], partial_batch_prediction[i]
                         )
+
+                    # put them into the right array
                     for i in range(len(partial_batch_prediction)):
-                        batch_raw_prediction[get_example_index(i)].append(partial_batch_raw_prediction[i])
+                        batch_prediction[get_example_index(i)].append(partial_batch_prediction[i])
+                        if output_confidence_features:
+                            batch_confidence_features[get_example_index(i)].append(generation.confidence_features[i])
 
-                # post-process predictions
-                for i in range(len(partial_batch_prediction)):
-                    partial_batch_prediction[i] = task.postprocess_prediction(
-                        batch_example_ids[get_example_index(i)], partial_batch_prediction[i]
-                    )
+                predictions += batch_prediction
+                confidence_features += batch_confidence_features
+                raw_predictions += batch_raw_prediction
+
+            return ValidationOutput(
+                loss=total_loss,
+                example_ids=list(example_ids),
+                predictions=predictions,
+                raw_predictions=raw_predictions,
+                answers=answers,
+                contexts=contexts,
+                confidence_features=confidence_features,
+            )
 
-                # put them into the right array
-                for i in range(len(partial_batch_prediction)):
-                    batch_prediction[get_example_index(i)].append(partial_batch_prediction[i])
-                    if output_confidence_features or output_confidence_scores:
-                        batch_confidence_features[get_example_index(i)].append(partial_batch_confidence_features[i])
+        split_oom_batches = getattr(self.args, 'split_OOM_batches', False)
+        simulate_oom_tokens = getattr(self.args, 'simulate_OOM_tokens', None)
+        # with workers, post-processing of a batch overlaps with generating the next ones
+        postprocess_workers = getattr(self.args, 'postprocess_workers', 0)
+        executor = ThreadPoolExecutor(max_workers=postprocess_workers) if postprocess_workers > 0 else None
+        pending = deque()
 
-            predictions += batch_prediction
-            confidence_features += batch_confidence_features
-            raw_predictions += batch_raw_prediction
+        try:
+            for batch in progress_bar(data_iterator, desc='Generating', disable=disable_progbar):
+                batch_size = len(batch.example_id)
+
+                if split_oom_batches:
+                    outputs = run_with_oom_splitting(generate_batch, batch, token_budget, simulate_oom_tokens)
+                else:
+                    outputs = [(batch, generate_batch(batch))]
+
+                total_loss = 0.0 if compute_loss else None
+                sub_batches = []
+                for sub_batch, (loss, generations) in outputs:
+                    if total_loss is not None:
+                        # weighted so that the parts of a split batch add up to the loss of the whole batch
+                        total_loss += loss * len(sub_batch.example_id) / batch_size
+                    sub_batches.append((sub_batch.example_id, sub_batch.context.value.data.cpu(), (loss, generations)))
+
+                job = (
+                    postprocess_batch,
+                    batch.example_id,
+                    batch.answer.value.data.cpu(),
+                    batch.context.value.data.cpu(),
+                    sub_batches,
+                    total_loss,
+                )
+                if executor is None:
+                    yield job[0](*job[1:])
+                    continue
+                pending.append(executor.submit(*job))
+                # yield finished batches in order, and keep generation at most a few batches ahead of post-processing
+                while pending and (pending[0].done() or len(pending) > 2 * postprocess_workers):
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        if dedupe_inputs:
+            logger.info(
+                f'Generated outputs for {dedupe_stats["generated"]} distinct inputs out of {dedupe_stats["examples"]} examples'
+            )
+
+    def finalize_validation_output(
+        self,
+        generation_output,
+        output_predictions_only=False,
+        output_confidence_features=False,
+        original_order=None,
+        confidence_estimators=None,
+    ):
+        """
+        Second half of validate_batch(): restores the original order of the examples in the output of
+        generate_batches(), merges split examples back together and computes confidence scores.
+        Only uses self.args and self.numericalizer, so that ShardedPredictionModel can share it.
+        """
+        total_loss = generation_output.loss
+        example_ids = generation_output.example_ids
+        predictions = generation_output.predictions
+        raw_predictions = generation_output.raw_predictions
+        answers = generation_output.answers
+        contexts = generation_output.contexts
+        confidence_features = generation_output.confidence_features
+        output_confidence_scores = confidence_estimators is not None
+        translate_return_raw_outputs = getattr(self.args, 'translate_return_raw_outputs', False)
 
         if total_loss is not None:
             total_loss /= len(example_ids)
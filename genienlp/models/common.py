@@ -28,7 +28,7 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from typing import List
+from typing import List, Optional
 
 import torch
 import torch.nn as nn
@@ -202,11 +202,15 @@ class LSTMDecoderAttention(nn.Module):
         # context_mask is batch x encoder_time, convert it to batch x 1 x encoder_time
         self.context_mask = context_mask.unsqueeze(1)
 
-    def forward(self, input: torch.Tensor, context: torch.Tensor):
+    def forward(self, input: torch.Tensor, context: torch.Tensor, context_mask: Optional[torch.Tensor] = None):
         # input is batch x decoder_time x dim
         # context is batch x encoder_time x dim
         # output will be batch x decoder_time x dim
         # context_attention will be batch x decoder_time x encoder_time
+        # context_mask (batch x 1 x encoder_time) can be passed explicitly instead of calling applyMasks,
+        # so that the module stays stateless when traced for export
+        if context_mask is None:
+            context_mask = self.context_mask
 
         if not self.dot:
             targetT = self.linear_in(input)  # batch x decoder_time x dim x 1
@@ -215,7 +219,7 @@ class LSTMDecoderAttention(nn.Module):
 
         transposed_context = torch.transpose(context, 2, 1)
         context_scores = torch.matmul(targetT, transposed_context)
-        context_scores.masked_fill_(self.context_mask, -float('inf'))
+        context_scores.masked_fill_(context_mask, -float('inf'))
         context_attention = F.softmax(context_scores, dim=-1) + EPSILON
 
         # convert context_attention to batch x decoder_time x 1 x encoder_time
@@ -231,24 +235,92 @@ class LSTMDecoderAttention(nn.Module):
         return output, context_attention
 
 
-class LabelSmoothingCrossEntropy(torch.nn.Module):
-    def __init__(self, smoothing):
-        super(LabelSmoothingCrossEntropy, self).__init__()
+def smoothed_cross_entropy(logits, target, smoothing, ignore_index):
+    """
+    Cross entropy with label smoothing, computed from the log-sum-exp of the logits instead of from log_softmax,
+    so no extra tensor of the size of the logits is kept for backward. Logits can have any number of leading dimensions.
+    Inputs:
+        logits: Tensor of shape (*, vocab_size)
+        target: Tensor of shape (*)
+    Outputs:
+        loss: a float Tensor of shape (*), 0 where target == ignore_index
+    """
+    # -log p(y) = logsumexp(x) - x_y  and  -mean(log p) = logsumexp(x) - mean(x)
+    loss = torch.logsumexp(logits, dim=-1).float()
+    loss = loss - (1.0 - smoothing) * logits.gather(dim=-1, index=target.unsqueeze(-1)).squeeze(-1).float()
+    if smoothing > 0.0:
+        loss = loss - smoothing * logits.mean(dim=-1, dtype=torch.float32)
+    return loss.masked_fill(target == ignore_index, 0.0)
+
+
+class LossTruncation(nn.Module):
+    """
+    Loss Truncation (https://arxiv.org/abs/2004.14589): drops the examples whose loss is above the `1 - drop_ratio`
+    quantile of the losses of the last `window` examples. The cutoff is recomputed every `window` examples, and
+    nothing is dropped before `min_count` examples have been seen.
+
+    The window is a ring buffer on the same device as the losses, so no per-step synchronization with the CPU is needed.
+    """
+
+    def __init__(self, drop_ratio, min_count=10000, window=10000):
+        super().__init__()
+        self.keep_quantile = 1.0 - drop_ratio
+        self.min_count = min_count
+        self.window = window
+        self.count = 0
+        self.since_recompute = 0
+        # not persistent, so that checkpoints do not depend on whether truncation was used
+        self.register_buffer('history', torch.zeros(window), persistent=False)
+        self.register_buffer('cutoff', torch.tensor(float('inf')), persistent=False)
+
+    def forward(self, loss):
+        """
+        Inputs:
+            loss: Tensor of shape (batch_size, ) with per-example losses
+        Outputs:
+            mask: Tensor of shape (batch_size, ) with 0 for examples that should be dropped and 1 otherwise
+        """
+        losses = loss.detach().float().view(-1)[-self.window :]
+        positions = torch.arange(self.count, self.count + len(losses), device=losses.device) % self.window
+        self.history.index_copy_(0, positions, losses)
+        self.count += loss.numel()
+        self.since_recompute += loss.numel()
+
+        if self.count < max(self.min_count, self.window):
+            return torch.ones_like(loss)
+        if self.since_recompute > self.window:
+            self.cutoff = torch.quantile(self.history, self.keep_quantile)
+            self.since_recompute = 0
+        return (loss < self.cutoff).to(loss.dtype)
+
+
+class SequenceLoss(nn.Module):
+    """
+    Label-smoothed cross entropy averaged over the tokens of each example, then (after optional loss truncation)
+    over the examples of the batch
+    """
+
+    def __init__(self, smoothing=0.0, drop_ratio=0.0, drop_min_count=10000):
+        super().__init__()
         self.smoothing = smoothing
+        self.truncation = LossTruncation(drop_ratio, min_count=drop_min_count) if drop_ratio > 0 else None
+
+    def token_loss(self, logits, target, ignore_index):
+        return smoothed_cross_entropy(logits, target, self.smoothing, ignore_index)
+
+    def reduce(self, example_loss):
+        if self.truncation is not None:
+            example_loss = example_loss * self.truncation(example_loss)
+        return example_loss.mean()
 
-    def forward(self, x, target, ignore_index):
+    def forward(self, logits, target, ignore_index, target_length):
         """
         Inputs:
-            x: Tensor of shape (N, vocab_size)
-            target: Tensor of shape (N, ) where N is batch_size * sequence_length
-            ignore_index: this index in the vocabulary is ignored when calculating loss. This is useful for pad tokens.
+            logits: Tensor of shape (batch_size, sequence_length, vocab_size)
+            target: Tensor of shape (batch_size, sequence_length)
+            target_length: Tensor of shape (batch_size, ) with the number of tokens the loss of each example is averaged over
         Outputs:
-            loss: a Tensor of shape (N, )
+            loss: a scalar Tensor
         """
-        logprobs = F.log_softmax(x, dim=-1)
-        nll_loss = -logprobs.gather(dim=-1, index=target.unsqueeze(1))
-        nll_loss = nll_loss.squeeze(1)
-        smooth_loss = -logprobs.mean(dim=-1)
-        loss = (1.0 - self.smoothing) * nll_loss + self.smoothing * smooth_loss
-        loss.masked_fill_((target == ignore_index), 0)
-        return loss
+        example_loss = self.token_loss(logits, target, ignore_index).sum(dim=1) / target_length
+        return self.reduce(example_loss)
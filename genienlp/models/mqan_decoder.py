@@ -31,6 +31,7 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers.modeling_outputs import Seq2SeqLMOutput
 
 from .common import EPSILON, CombinedEmbedding, Feedforward, LSTMDecoderAttention, MultiLSTMCell, mask
@@ -192,6 +193,8 @@ class LSTMDecoder(nn.Module):
 
         self.rnn = MultiLSTMCell(self.num_layers, d_in, d_hid, dropout)
         self.context_attn = LSTMDecoderAttention(d_hid, dot=True)
+        # if > 0, activations are recomputed during backward in blocks of this many decoding steps
+        self.checkpoint_steps = 0
 
     def applyMasks(self, context_mask):
         self.context_attn.applyMasks(context_mask)
@@ -199,6 +202,21 @@ class LSTMDecoder(nn.Module):
     def forward(self, input: torch.Tensor, context, output=None, hidden=None):
         context_output = output if output is not None else self.make_init_output(context)
 
+        if self.checkpoint_steps > 0 and self.training and torch.is_grad_enabled():
+            # keep only the state between blocks of decoding steps, and recompute the rest during backward
+            h, c = hidden
+            block_outputs = []
+            for block in input.split(self.checkpoint_steps, dim=1):
+                outputs = checkpoint(self._decode_steps, block, context, context_output, h, c)
+                block_outputs.append(outputs[:3])
+                context_output, h, c = outputs[3:]
+            return [torch.cat(x, dim=1) for x in zip(*block_outputs)] + [(h, c)]
+
+        outputs = self._decode_steps(input, context, context_output, *hidden)
+        return list(outputs[:3]) + [outputs[4:]]
+
+    def _decode_steps(self, input: torch.Tensor, context, context_output, h, c):
+        hidden = (h, c)
         context_outputs, vocab_pointer_switch_inputs, context_attentions = [], [], []
         for decoder_input in input.split(1, dim=1):
             context_output = self.dropout(context_output)
@@ -218,7 +236,10 @@ class LSTMDecoder(nn.Module):
             context_outputs.append(context_output)
             context_attentions.append(context_attention)
 
-        return [torch.cat(x, dim=1) for x in (context_outputs, vocab_pointer_switch_inputs, context_attentions)] + [hidden]
+        return tuple(torch.cat(x, dim=1) for x in (context_outputs, vocab_pointer_switch_inputs, context_attentions)) + (
+            context_output,
+            *hidden,
+        )
 
     def make_init_output(self, context):
         batch_size = context.size(0)
@@ -0,0 +1,380 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import os
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from .common import EPSILON
+
+logger = logging.getLogger(__name__)
+
+ENCODER_FILE_NAME = 'encoder.pt'
+DECODER_STEP_FILE_NAME = 'decoder_step.pt'
+
+
+class ExportableEncoder(nn.Module):
+    """
+    Tensor-in, tensor-out wrapper around IdentityEncoder.compute_final_embeddings so that it can be traced
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+        self.pad_idx = encoder.pad_idx
+
+    def forward(self, context, context_lengths):
+        context_padding = torch.eq(context, self.pad_idx)
+        final_context, context_rnn_state = self.encoder.compute_final_embeddings(
+            context, context_lengths, context_padding, None, entity_word_embeds_dropout=False
+        )
+        if context_rnn_state is None:
+            # models without RNN layers have no recurrent state
+            # return placeholders so that the decoder step has the same signature in both cases
+            h = c = final_context.new_zeros(1, context.size(0), 1)
+        else:
+            h, c = context_rnn_state
+
+        return final_context, context_padding, h, c
+
+
+class ExportableDecoderStep(nn.Module):
+    """
+    A single step of MQANDecoder, equivalent to MQANDecoderWrapper.next_token_probs, but stateless: the attention mask,
+    the recurrent state and the previous decoder output are explicit inputs and outputs
+    """
+
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+        self.rnn_layers = decoder.args.rnn_layers
+
+    def forward(
+        self, current_token_id, final_context, context_padding, context_limited, vocab_extension, decoder_output, h, c
+    ):
+        """
+        Inputs:
+            current_token_id: (batch_size, 1) token ids in the full vocabulary
+            vocab_extension: (batch_size, 1, len(decoder_vocab) - generative_vocab_size) filled with EPSILON
+            decoder_output: (batch_size, 1, rnn_dimension) output of the previous step, used for input feeding
+            h, c: (rnn_layers, batch_size, rnn_dimension) recurrent state
+        Outputs:
+            log_probs: (batch_size, len(decoder_vocab)) log-probabilities over the decoder vocabulary
+            decoder_output, h, c: inputs for the next step
+        """
+        decoder = self.decoder
+        context_mask = context_padding.unsqueeze(1)
+        embedding = decoder.decoder_embeddings(current_token_id)
+
+        if self.rnn_layers > 0:
+            rnn_input = torch.cat([embedding, decoder_output], 2).squeeze(1)
+            dec_state, (h, c) = decoder.rnn_decoder.rnn(rnn_input, (h, c))
+            dec_state = dec_state.unsqueeze(1)
+            decoder_output, context_attention = decoder.rnn_decoder.context_attn(dec_state, final_context, context_mask)
+            vocab_pointer_switch_input = torch.cat([dec_state, decoder_output, embedding], -1)
+        else:
+            decoder_output, context_attention = decoder.context_attn(embedding, final_context, context_mask)
+            vocab_pointer_switch_input = torch.cat((decoder_output, embedding), dim=-1)
+
+        vocab_pointer_switch = decoder.vocab_pointer_switch(vocab_pointer_switch_input)
+
+        # same mixture as MQANDecoder.probs, with the out-of-vocabulary part of the decoder vocabulary passed in
+        p_vocab = F.softmax(decoder.out(decoder_output), dim=-1)
+        scaled_p_vocab = torch.cat([vocab_pointer_switch * p_vocab, vocab_extension], dim=-1)
+        scaled_p_vocab = scaled_p_vocab.scatter_add(
+            -1, context_limited.unsqueeze(1), (1 - vocab_pointer_switch) * context_attention
+        )
+
+        return torch.log(scaled_p_vocab).squeeze(1), decoder_output, h, c
+
+
+def export_torchscript(model, save_directory, batch):
+    """
+    Trace the encoder and a single decoder step of a TransformerLSTM model, and save them in `save_directory`
+    `batch` is a NumericalizedExamples used as example input for tracing
+    """
+    if model.args.do_ned:
+        raise ValueError('Exporting models that use entity embeddings is not supported')
+
+    model.eval()
+    encoder = ExportableEncoder(model.encoder)
+    decoder_step = ExportableDecoderStep(model.decoder)
+    with torch.no_grad():
+        context, context_lengths = batch.context.value, batch.context.length
+        traced_encoder = torch.jit.trace(encoder, (context, context_lengths))
+
+        final_context, context_padding, h, c = encoder(context, context_lengths)
+        batch_size = context.size(0)
+        extension_size = len(model.numericalizer.decoder_vocab) - model.numericalizer.generative_vocab_size
+        step_inputs = (
+            torch.full((batch_size, 1), model.numericalizer.init_id, dtype=torch.long, device=context.device),
+            final_context,
+            context_padding,
+            batch.context.limited,
+            final_context.new_full((batch_size, 1, extension_size), EPSILON),
+            final_context.new_zeros(batch_size, 1, final_context.size(-1)),
+            h,
+            c,
+        )
+        traced_decoder_step = torch.jit.trace(decoder_step, step_inputs)
+
+    os.makedirs(save_directory, exist_ok=True)
+    traced_encoder.save(os.path.join(save_directory, ENCODER_FILE_NAME))
+    traced_decoder_step.save(os.path.join(save_directory, DECODER_STEP_FILE_NAME))
+
+
+class _BeamHypotheses(object):
+    """
+    Finished hypotheses of one input; same scoring as `transformers` beam search with length_penalty=1 and early_stopping
+    """
+
+    def __init__(self, num_beams):
+        self.num_beams = num_beams
+        self.beams = []
+        self.worst_score = 1e9
+
+    def add(self, hyp, sum_logprobs):
+        score = sum_logprobs / hyp.shape[-1]
+        if len(self.beams) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hyp))
+            if len(self.beams) > self.num_beams:
+                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self):
+        return len(self.beams) >= self.num_beams
+
+
+class TorchScriptGenerator(object):
+    """
+    Greedy and beam search over the graphs saved by `export_torchscript`.
+    For the options it supports, the output is the same as `TransformerLSTM.generate(...).sequences`,
+    without the per-token overhead of `transformers` generation utilities.
+    """
+
+    def __init__(self, encoder, decoder_step, numericalizer):
+        self.encoder = encoder
+        self.decoder_step = decoder_step
+        self.numericalizer = numericalizer
+
+    @classmethod
+    def load(cls, save_directory, numericalizer, device=torch.device('cpu')):
+        encoder = torch.jit.load(os.path.join(save_directory, ENCODER_FILE_NAME), map_location=device)
+        decoder_step = torch.jit.load(os.path.join(save_directory, DECODER_STEP_FILE_NAME), map_location=device)
+        return cls(encoder, decoder_step, numericalizer)
+
+    @staticmethod
+    def exists(save_directory):
+        return os.path.exists(os.path.join(save_directory, ENCODER_FILE_NAME)) and os.path.exists(
+            os.path.join(save_directory, DECODER_STEP_FILE_NAME)
+        )
+
+    def _expand(self, state, num_beams):
+        final_context, context_padding, context_limited, vocab_extension, decoder_output, h, c = state
+        return (
+            final_context.repeat_interleave(num_beams, dim=0),
+            context_padding.repeat_interleave(num_beams, dim=0),
+            context_limited.repeat_interleave(num_beams, dim=0),
+            vocab_extension.repeat_interleave(num_beams, dim=0),
+            decoder_output.repeat_interleave(num_beams, dim=0),
+            h.repeat_interleave(num_beams, dim=1),
+            c.repeat_interleave(num_beams, dim=1),
+        )
+
+    def _reorder(self, state, beam_idx):
+        final_context, context_padding, context_limited, vocab_extension, decoder_output, h, c = state
+        # like MQANDecoderWrapper.reorder, decoder_output is not reordered
+        return (
+            final_context[beam_idx],
+            context_padding[beam_idx],
+            context_limited[beam_idx],
+            vocab_extension[beam_idx],
+            decoder_output,
+            h[:, beam_idx],
+            c[:, beam_idx],
+        )
+
+    def _step(self, current_token_id, state):
+        final_context, context_padding, context_limited, vocab_extension, decoder_output, h, c = state
+        log_probs, decoder_output, h, c = self.decoder_step(
+            current_token_id, final_context, context_padding, context_limited, vocab_extension, decoder_output, h, c
+        )
+        return log_probs, (final_context, context_padding, context_limited, vocab_extension, decoder_output, h, c)
+
+    @torch.no_grad()
+    def generate(self, batch, max_output_length, min_output_length=0, num_outputs=1, num_beams=1):
+        """
+        Returns a (batch_size * num_outputs, output_length) tensor of token ids in the full vocabulary
+        """
+        if num_beams == 1 and num_outputs != 1:
+            raise ValueError('Greedy search can only return one output per example; use num_beams > 1 for more outputs')
+        if num_outputs > num_beams:
+            raise ValueError('num_outputs cannot be larger than num_beams')
+
+        decoder_vocab = self.numericalizer.decoder_vocab
+        context = batch.context.value
+        batch_size = context.size(0)
+
+        final_context, context_padding, h, c = self.encoder(context, batch.context.length)
+        extension_size = len(decoder_vocab) - self.numericalizer.generative_vocab_size
+        state = (
+            final_context,
+            context_padding,
+            batch.context.limited,
+            final_context.new_full((batch_size, 1, extension_size), EPSILON),
+            final_context.new_zeros(batch_size, 1, final_context.size(-1)),
+            h,
+            c,
+        )
+        limited_to_full = torch.tensor(
+            [decoder_vocab.decode(idx) for idx in range(len(decoder_vocab))], dtype=torch.long, device=context.device
+        )
+
+        if num_beams > 1:
+            output_ids = self._beam_search(
+                state, limited_to_full, batch_size, num_beams, num_outputs, max_output_length, min_output_length
+            )
+        else:
+            output_ids = self._greedy_search(state, limited_to_full, batch_size, max_output_length, min_output_length)
+
+        # map everything to full vocabulary except BOS which already is in full vocabulary
+        return torch.cat((output_ids[:, 0:1], limited_to_full[output_ids[:, 1:]]), dim=1)
+
+    def _greedy_search(self, state, limited_to_full, batch_size, max_output_length, min_output_length):
+        decoder_vocab = self.numericalizer.decoder_vocab
+        device = limited_to_full.device
+        input_ids = torch.full((batch_size, 1), self.numericalizer.init_id, dtype=torch.long, device=device)
+        current_token_id = input_ids
+        unfinished = torch.ones(batch_size, dtype=torch.long, device=device)
+
+        while True:
+            log_probs, state = self._step(current_token_id, state)
+            if input_ids.size(1) < min_output_length:
+                log_probs[:, decoder_vocab.eos_idx] = -float('inf')
+
+            next_tokens = torch.argmax(log_probs, dim=-1)
+            next_tokens = next_tokens * unfinished + decoder_vocab.pad_idx * (1 - unfinished)
+            input_ids = torch.cat([input_ids, next_tokens.unsqueeze(-1)], dim=-1)
+            unfinished = unfinished.mul((next_tokens != decoder_vocab.eos_idx).long())
+            current_token_id = limited_to_full[next_tokens].unsqueeze(-1)
+
+            if unfinished.max() == 0 or input_ids.size(1) >= max_output_length:
+                break
+
+        return input_ids
+
+    def _beam_search(self, state, limited_to_full, batch_size, num_beams, num_outputs, max_output_length, min_output_length):
+        decoder_vocab = self.numericalizer.decoder_vocab
+        device = limited_to_full.device
+        state = self._expand(state, num_beams)
+        input_ids = torch.full((batch_size * num_beams, 1), self.numericalizer.init_id, dtype=torch.long, device=device)
+        current_token_id = input_ids
+
+        # only the first beam is active at the beginning, so that we do not get num_beams copies of the same hypothesis
+        beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float, device=device)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view(-1)
+        hypotheses = [_BeamHypotheses(num_beams) for _ in range(batch_size)]
+        done = [False] * batch_size
+
+        while True:
+            log_probs, state = self._step(current_token_id, state)
+            next_token_scores = F.log_softmax(log_probs, dim=-1)
+            if input_ids.size(1) < min_output_length:
+                next_token_scores[:, decoder_vocab.eos_idx] = -float('inf')
+            next_token_scores = next_token_scores + beam_scores[:, None]
+
+            vocab_size = next_token_scores.size(-1)
+            next_token_scores = next_token_scores.view(batch_size, num_beams * vocab_size)
+            next_token_scores, next_tokens = torch.topk(next_token_scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+            next_indices = torch.div(next_tokens, vocab_size, rounding_mode='floor')
+            next_tokens = next_tokens % vocab_size
+
+            next_beam_scores = torch.zeros((batch_size, num_beams), dtype=next_token_scores.dtype, device=device)
+            next_beam_tokens = torch.zeros((batch_size, num_beams), dtype=torch.long, device=device)
+            next_beam_indices = torch.zeros((batch_size, num_beams), dtype=torch.long, device=device)
+            for batch_idx in range(batch_size):
+                if done[batch_idx]:
+                    next_beam_tokens[batch_idx, :] = decoder_vocab.pad_idx
+                    continue
+                beam_idx = 0
+                for rank, (token, score, index) in enumerate(
+                    zip(next_tokens[batch_idx], next_token_scores[batch_idx], next_indices[batch_idx])
+                ):
+                    batch_beam_idx = batch_idx * num_beams + index.item()
+                    if token.item() == decoder_vocab.eos_idx:
+                        # an EOS outside of the top num_beams candidates does not make a finished hypothesis
+                        if rank >= num_beams:
+                            continue
+                        hypotheses[batch_idx].add(input_ids[batch_beam_idx].clone(), score.item())
+                    else:
+                        next_beam_scores[batch_idx, beam_idx] = score
+                        next_beam_tokens[batch_idx, beam_idx] = token
+                        next_beam_indices[batch_idx, beam_idx] = batch_beam_idx
+                        beam_idx += 1
+                    if beam_idx == num_beams:
+                        break
+                done[batch_idx] = done[batch_idx] or hypotheses[batch_idx].is_done()
+
+            beam_scores = next_beam_scores.view(-1)
+            beam_next_tokens = next_beam_tokens.view(-1)
+            beam_idx = next_beam_indices.view(-1)
+
+            input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
+            state = self._reorder(state, beam_idx)
+            current_token_id = limited_to_full[beam_next_tokens].unsqueeze(-1)
+
+            if all(done) or input_ids.size(1) >= max_output_length:
+                break
+
+        # add the unfinished beams, then keep the best num_outputs hypotheses for each input
+        best = []
+        for batch_idx, hyp in enumerate(hypotheses):
+            if not done[batch_idx]:
+                for beam_id in range(num_beams):
+                    batch_beam_idx = batch_idx * num_beams + beam_id
+                    hyp.add(input_ids[batch_beam_idx], beam_scores[batch_beam_idx].item())
+            sorted_hyps = sorted(hyp.beams, key=lambda x: x[0])
+            for _ in range(num_outputs):
+                best.append(sorted_hyps.pop()[1])
+
+        sent_lengths = [len(hyp) for hyp in best]
+        output_ids = input_ids.new_full((len(best), min(max(sent_lengths) + 1, max_output_length)), decoder_vocab.pad_idx)
+        for i, hyp in enumerate(best):
+            output_ids[i, : sent_lengths[i]] = hyp
+            if sent_lengths[i] < max_output_length:
+                output_ids[i, sent_lengths[i]] = decoder_vocab.eos_idx
+
+        return output_ids
@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Sequence packing for encoder-decoder training: several short (context, answer) pairs share one row of the batch.
+Examples in the same row cannot see each other, because of block-diagonal attention masks, and positions restart
+at 0 for each example, so every example is computed exactly as it would be in its own row.
+"""
+
+from typing import NamedTuple
+
+import torch
+
+# model types whose encoder and decoder layers can be driven directly with 4D attention masks
+PACKING_SUPPORTED_MODEL_TYPES = ('bart', 'mbart', 'marian')
+
+
+class PackedBatch(NamedTuple):
+    input_ids: torch.Tensor  # (rows, encoder_length)
+    encoder_segments: torch.Tensor  # (rows, encoder_length), index of the example each token belongs to, -1 for padding
+    encoder_positions: torch.Tensor  # (rows, encoder_length)
+    decoder_input_ids: torch.Tensor  # (rows, decoder_length)
+    labels: torch.Tensor  # (rows, decoder_length)
+    decoder_segments: torch.Tensor  # (rows, decoder_length)
+    decoder_positions: torch.Tensor  # (rows, decoder_length)
+    num_examples: int
+
+
+def assign_rows(context_lengths, answer_lengths, max_context_length, max_answer_length):
+    """
+    First-fit assignment of examples to rows, so that no row is longer than the longest example of the batch.
+    Returns the row, context offset and answer offset of each example, and the number of rows.
+    """
+    row_context_used = []
+    row_answer_used = []
+    rows, context_offsets, answer_offsets = [], [], []
+    for context_length, answer_length in zip(context_lengths, answer_lengths):
+        for row in range(len(row_context_used)):
+            if (
+                row_context_used[row] + context_length <= max_context_length
+                and row_answer_used[row] + answer_length <= max_answer_length
+            ):
+                break
+        else:
+            row = len(row_context_used)
+            row_context_used.append(0)
+            row_answer_used.append(0)
+        rows.append(row)
+        context_offsets.append(row_context_used[row])
+        answer_offsets.append(row_answer_used[row])
+        row_context_used[row] += context_length
+        row_answer_used[row] += answer_length
+    return rows, context_offsets, answer_offsets, len(row_context_used)
+
+
+def _scatter_into_rows(values, mask, rows, offsets, num_rows, row_length, pad_value):
+    """
+    Copy the unmasked tokens of each row of `values` to (rows[i], offsets[i]:offsets[i]+length) of a new tensor.
+    Returns the packed tensor, the example index of each packed token and its position within its example.
+    """
+    device = values.device
+    lengths = mask.sum(dim=1)
+    example_index = torch.repeat_interleave(torch.arange(values.size(0), device=device), lengths)
+    starts = torch.cumsum(lengths, dim=0) - lengths
+    positions = torch.arange(example_index.size(0), device=device) - starts[example_index]
+    rows = torch.tensor(rows, device=device)
+    offsets = torch.tensor(offsets, device=device)
+    destination = rows[example_index] * row_length + offsets[example_index] + positions
+
+    packed = values.new_full((num_rows * row_length,), pad_value)
+    packed[destination] = values[mask]
+    segments = torch.full((num_rows * row_length,), -1, dtype=torch.long, device=device)
+    segments[destination] = example_index
+    packed_positions = torch.zeros(num_rows * row_length, dtype=torch.long, device=device)
+    packed_positions[destination] = positions
+    return (
+        packed.view(num_rows, row_length),
+        segments.view(num_rows, row_length),
+        packed_positions.view(num_rows, row_length),
+    )
+
+
+def pack_batch(input_ids, decoder_input_ids, labels, pad_id):
+    """
+    input_ids can be left or right padded; labels and decoder_input_ids must be right padded and aligned
+    """
+    context_mask = input_ids != pad_id
+    answer_mask = labels != pad_id
+    context_lengths = context_mask.sum(dim=1)
+    answer_lengths = answer_mask.sum(dim=1)
+    max_context_length = int(context_lengths.max())
+    max_answer_length = int(answer_lengths.max())
+    rows, context_offsets, answer_offsets, num_rows = assign_rows(
+        context_lengths.tolist(), answer_lengths.tolist(), max_context_length, max_answer_length
+    )
+
+    packed_input_ids, encoder_segments, encoder_positions = _scatter_into_rows(
+        input_ids, context_mask, rows, context_offsets, num_rows, max_context_length, pad_id
+    )
+    packed_labels, decoder_segments, decoder_positions = _scatter_into_rows(
+        labels, answer_mask, rows, answer_offsets, num_rows, max_answer_length, pad_id
+    )
+    packed_decoder_input_ids, _, _ = _scatter_into_rows(
+        decoder_input_ids, answer_mask, rows, answer_offsets, num_rows, max_answer_length, pad_id
+    )
+    return PackedBatch(
+        packed_input_ids,
+        encoder_segments,
+        encoder_positions,
+        packed_decoder_input_ids,
+        packed_labels,
+        decoder_segments,
+        decoder_positions,
+        input_ids.size(0),
+    )
+
+
+def _block_mask(query_segments, key_segments, dtype, causal=False):
+    """
+    Additive attention mask of shape (rows, 1, query_length, key_length) that only lets tokens attend to tokens
+    of the same example
+    """
+    allowed = (query_segments[:, :, None] == key_segments[:, None, :]) & (key_segments[:, None, :] >= 0)
+    if causal:
+        query_length, key_length = query_segments.size(1), key_segments.size(1)
+        allowed = allowed & torch.ones(query_length, key_length, dtype=torch.bool, device=allowed.device).tril()
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=allowed.device)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask[:, None, :, :]
+
+
+def _embed(module, input_ids, positions):
+    # learned position embeddings of BART and mBART are offset by 2; Marian's sinusoidal ones are not
+    embed_positions = module.embed_positions
+    position_embeddings = torch.nn.functional.embedding(
+        positions + getattr(embed_positions, 'offset', 0), embed_positions.weight
+    )
+    hidden_states = module.embed_tokens(input_ids) * module.embed_scale + position_embeddings
+    if getattr(module, 'layernorm_embedding', None) is not None:
+        hidden_states = module.layernorm_embedding(hidden_states)
+    return torch.nn.functional.dropout(hidden_states, p=module.dropout, training=module.training)
+
+
+def packed_seq2seq_logits(model, packed: PackedBatch):
+    """
+    Runs a packed batch through a BART-like `transformers` model (see PACKING_SUPPORTED_MODEL_TYPES).
+    Returns logits of shape (rows, decoder_length, vocab_size).
+    """
+    encoder = model.get_encoder()
+    decoder = model.get_decoder()
+
+    hidden_states = _embed(encoder, packed.input_ids, packed.encoder_positions)
+    dtype = hidden_states.dtype
+    encoder_mask = _block_mask(packed.encoder_segments, packed.encoder_segments, dtype)
+    for layer in encoder.layers:
+        hidden_states = layer(hidden_states, encoder_mask, layer_head_mask=None)[0]
+    if getattr(encoder, 'layer_norm', None) is not None:
+        hidden_states = encoder.layer_norm(hidden_states)
+    encoder_hidden_states = hidden_states
+
+    hidden_states = _embed(decoder, packed.decoder_input_ids, packed.decoder_positions)
+    decoder_mask = _block_mask(packed.decoder_segments, packed.decoder_segments, dtype, causal=True)
+    cross_mask = _block_mask(packed.decoder_segments, packed.encoder_segments, dtype)
+    for layer in decoder.layers:
+        hidden_states = layer(
+            hidden_states,
+            attention_mask=decoder_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=cross_mask,
+            use_cache=False,
+        )[0]
+    if getattr(decoder, 'layer_norm', None) is not None:
+        hidden_states = decoder.layer_norm(hidden_states)
+
+    logits = model.lm_head(hidden_states)
+    if hasattr(model, 'final_logits_bias'):
+        logits = logits + model.final_logits_bias
+    return logits
+
+
+def per_example_token_loss_sum(token_loss, segments, num_examples):
+    """
+    Sum the per-token losses of a packed batch into one value per example
+    """
+    token_loss = token_loss.view(-1)
+    segments = segments.reshape(-1)
+    valid = segments >= 0
+    return token_loss.new_zeros(num_examples).index_add_(0, segments[valid], token_loss[valid])
@@ -44,6 +44,8 @@ logger = logging.getLogger(__name__)
 
 
 class TransformerLSTM(GenieModelForGeneration):
+    limits_generative_vocab = True
+
     def __init__(self, config=None, *inputs, args, vocab_sets, tasks, save_directory=None, **kwargs):
         """
         Relevant inputs should be provided using kwargs. This method is defined this way to match parent's and siblings' method signatures.
@@ -199,6 +201,12 @@ class TransformerLSTM(GenieModelForGeneration):
         past.reorder(beam_idx)
         return past
 
+    def encode_for_generation(self, batch):
+        """
+        Runs the encoder on batch once, so that its output can be reused by several generate() calls
+        """
+        return self.encoder(batch)
+
     def generate(
         self,
         batch,
@@ -214,9 +222,11 @@ class TransformerLSTM(GenieModelForGeneration):
         diversity_penalty,
         no_repeat_ngram_size,
         do_sample,
+        encoder_output=None,
     ):
 
-        encoder_output = self.encoder(batch)
+        if encoder_output is None:
+            encoder_output = self.encode_for_generation(batch)
         self.config.vocab_size = len(self.numericalizer.decoder_vocab)
         self.config.is_encoder_decoder = (
             False  # in order to make it work with `transformers` generation code, we should treat this as a decoder-only model
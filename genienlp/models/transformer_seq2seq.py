@@ -31,13 +31,15 @@ from typing import List
 
 import torch
 from transformers import AutoConfig, AutoModelForSeq2SeqLM, MBartTokenizer, MBartTokenizerFast
+from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
 
 from ..calibrate import ConfidenceFeatures
 from ..data_utils.numericalizer import TransformerNumericalizer
 from ..model_utils.transformers_utils import MULTILINGUAL_TOKENIZERS
 from ..util import adjust_language_code
 from .base import GenieModelForGeneration
-from .common import LabelSmoothingCrossEntropy
+from .common import SequenceLoss
+from .packing import PACKING_SUPPORTED_MODEL_TYPES, pack_batch, packed_seq2seq_logits, per_example_token_loss_sum
 
 logger = logging.getLogger(__name__)
 
@@ -84,15 +86,13 @@ class TransformerSeq2Seq(GenieModelForGeneration):
         self.update_language_dependent_configs(self.tgt_lang)
         self.model.resize_token_embeddings(self.numericalizer.num_tokens)
 
-        if args.dropper_ratio > 0:
-            # lazy import since dropper is an optional dependency
-            from loss_dropper import LossDropper
+        self.criterion = SequenceLoss(args.label_smoothing, args.dropper_ratio, args.dropper_min_count)
 
-            self.dropper = LossDropper(dropc=args.dropper_ratio, min_count=args.dropper_min_count)
-        else:
-            self.dropper = None
-
-        self.criterion = LabelSmoothingCrossEntropy(args.label_smoothing)
+        self._sequence_packing = getattr(args, 'sequence_packing', False)
+        if self._sequence_packing and self.config.model_type not in PACKING_SUPPORTED_MODEL_TYPES:
+            raise ValueError(
+                f'Sequence packing is only supported for the following model types: {PACKING_SUPPORTED_MODEL_TYPES}'
+            )
 
     def add_new_vocab_from_data(self, tasks, resize_decoder=False):
         super().add_new_vocab_from_data(tasks, resize_decoder)
@@ -146,29 +146,61 @@ class TransformerSeq2Seq(GenieModelForGeneration):
             # longer sequences in the batch do not drown shorter sequences.
             # (3) if `args.dropper_ratio > 0.0`, will perform Loss Truncation
             # (4) if `args.label_smoothing > 0.0`, will add label smoothing term to loss
+            if self._sequence_packing:
+                return self._packed_forward(batch.context.value, answer, answer_length)
+
+            if hasattr(self.model, 'prepare_decoder_input_ids_from_labels'):
+                # pass decoder inputs instead of labels, so that `transformers` does not compute a loss we would discard
+                decoder_kwargs = {'decoder_input_ids': self.model.prepare_decoder_input_ids_from_labels(labels=answer)}
+            else:
+                decoder_kwargs = {'labels': answer}
             outputs = self.model(
                 batch.context.value,
-                labels=answer,
                 attention_mask=(batch.context.value != self.numericalizer.pad_id),
                 output_attentions=False,
                 output_hidden_states=False,
+                use_cache=False,
                 return_dict=True,
+                **decoder_kwargs,
             )
-            batch_size, vocab_size = outputs.logits.shape[0], outputs.logits.shape[2]
-            loss = self.criterion(
-                outputs.logits.view(-1, vocab_size), target=answer.view(-1), ignore_index=self.numericalizer.pad_id
+            # answer_length accounts for the case where BOS is removed
+            outputs.loss = self.criterion(
+                outputs.logits, target=answer, ignore_index=self.numericalizer.pad_id, target_length=answer_length
             )
-            loss = loss.view(batch_size, -1)  # (batch_size, sequence_length)
-            loss = loss.sum(dim=1) / answer_length  # accounts for the case where BOS is removed
-            if self.dropper is not None:
-                dropper_mask = self.dropper(loss)
-                loss = loss * dropper_mask
-            loss = loss.mean()  # average over the batch size
-            outputs.loss = loss  # replace the loss calculated by `transformers` with the new loss
             return outputs
         else:
             return self.model(**kwargs)
 
+    def _packed_forward(self, context, answer, answer_length):
+        pad_id = self.numericalizer.pad_id
+        decoder_input_ids = self.model.prepare_decoder_input_ids_from_labels(labels=answer)
+        packed = pack_batch(context, decoder_input_ids, answer, pad_id)
+        logits = packed_seq2seq_logits(self.model, packed)
+        loss = self.criterion.token_loss(logits, target=packed.labels, ignore_index=pad_id)
+        # same per-example loss as the unpacked path, so label smoothing and loss truncation behave the same
+        loss = per_example_token_loss_sum(loss, packed.decoder_segments, packed.num_examples) / answer_length
+        loss = self.criterion.reduce(loss)
+        # logits are in the packed layout: (rows, decoder_length, vocab_size)
+        return Seq2SeqLMOutput(loss=loss, logits=logits)
+
+    def encode_for_generation(self, batch):
+        """
+        Runs the encoder on batch once, so that its output can be reused by several generate() calls
+        """
+        input_ids = batch.context.value
+        # the same mask that generate() builds when it runs the encoder itself
+        attention_mask = self.model._prepare_attention_mask_for_generation(
+            input_ids, self.numericalizer.pad_id, self.numericalizer.eos_id
+        )
+        encoder_outputs = self.model.get_encoder()(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            output_attentions=self._output_attentions,
+            output_hidden_states=self._output_hidden_states,
+            return_dict=True,
+        )
+        return encoder_outputs, attention_mask
+
     def generate(
         self,
         batch,
@@ -184,10 +216,24 @@ class TransformerSeq2Seq(GenieModelForGeneration):
         diversity_penalty,
         no_repeat_ngram_size,
         do_sample,
+        encoder_output=None,
     ):
 
         input_ids = batch.context.value
 
+        encoder_kwargs = {}
+        if encoder_output is not None:
+            encoder_outputs, attention_mask = encoder_output
+            # generate() expands encoder outputs for beams in place, so hand it a fresh container every time
+            encoder_kwargs = {
+                'encoder_outputs': BaseModelOutput(
+                    last_hidden_state=encoder_outputs.last_hidden_state,
+                    hidden_states=encoder_outputs.hidden_states,
+                    attentions=encoder_outputs.attentions,
+                ),
+                'attention_mask': attention_mask,
+            }
+
         # when attention_mask is not provided to generate(), it will default to masking pad tokens, which is the correct thing
         generated = self.model.generate(
             input_ids=input_ids,
@@ -211,6 +257,7 @@ class TransformerSeq2Seq(GenieModelForGeneration):
             output_attentions=self._output_attentions,
             output_hidden_states=self._output_hidden_states,
             return_dict_in_generate=True,
+            **encoder_kwargs,
         )
 
         return generated
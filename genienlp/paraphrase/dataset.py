@@ -4,10 +4,10 @@ import pickle
 import random
 
 import torch
-from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
 
 from ..data_utils.almond_utils import detokenize_cjk_chars
+from ..data_utils.padding import pad_batch
 from ..data_utils.progbar import progress_bar
 from .data_utils import get_number_of_lines
 
@@ -18,6 +18,8 @@ class TextDataset(Dataset):
     def __init__(self, tokenizer, args, file_path=None, block_size=512, evaluate=None):
         self.tokenizer = tokenizer
         self.block_size = block_size
+        # decoder-only models continue the input, so padding goes before it; their position ids skip the padding
+        self.padding_side = 'left' if args.model_type == 'gpt2' else 'right'
         assert os.path.isfile(file_path)
         directory, filename = os.path.split(file_path)
         cached_features_file = os.path.join(
@@ -33,6 +35,7 @@ class TextDataset(Dataset):
             logger.info("Loading features from cached file %s", cached_features_file)
             with open(cached_features_file, 'rb') as handle:
                 self.input_ids, self.labels, self.position_ids, self.segment_ids = pickle.load(handle)
+            self.attention_mask = [[1] * len(input_ids) for input_ids in self.input_ids]
         else:
             logger.info("Creating features from dataset file at %s", file_path)
 
@@ -163,7 +166,6 @@ class TextDataset(Dataset):
             + [self.segment2_id] * (len(input_ids) - prompt_token_location - 1)
         )
 
-        # ignored
         self.attention_mask.append([1] * len(input_ids))
 
     def _add_seq2seq_example(self, input_sequence, output_sequence, args):
@@ -207,15 +209,12 @@ class TextDataset(Dataset):
 
     def collate_fn(self, batch):
         (inputs, attention_mask, labels, position_ids, segment_ids) = zip(*batch)
-        inputs_pad = pad_sequence(inputs, batch_first=True, padding_value=self.tokenizer.pad_token_id)
-        labels_pad = pad_sequence(labels, batch_first=True, padding_value=-100)
-        attention_mask = pad_sequence(attention_mask, batch_first=True, padding_value=0)
-        position_ids = pad_sequence(
-            position_ids, batch_first=True, padding_value=0
-        )  # will be ignored in the loss function, so its value does not matter
-        segment_ids = pad_sequence(
-            segment_ids, batch_first=True, padding_value=0
-        )  # will be ignored in the loss function, so its value does not matter
+        inputs_pad = pad_batch(inputs, padding_value=self.tokenizer.pad_token_id, padding_side=self.padding_side)
+        labels_pad = pad_batch(labels, padding_value=-100, padding_side=self.padding_side)
+        attention_mask = pad_batch(attention_mask, padding_value=0, padding_side=self.padding_side)
+        # will be ignored in the loss function, so their padding value does not matter
+        position_ids = pad_batch(position_ids, padding_value=0, padding_side=self.padding_side)
+        segment_ids = pad_batch(segment_ids, padding_value=0, padding_side=self.padding_side)
 
         return inputs_pad, attention_mask, labels_pad, position_ids, segment_ids
 
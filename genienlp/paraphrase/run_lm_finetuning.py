@@ -264,7 +264,9 @@ def train(
                 decoder_input_ids[decoder_input_ids == args.mlm_ignore_index] = tokenizer.pad_token_id
                 model_inputs['decoder_input_ids'] = decoder_input_ids
             else:
-                model_inputs.update({'position_ids': position_ids, 'token_type_ids': segment_ids})
+                model_inputs.update(
+                    {'position_ids': position_ids, 'token_type_ids': segment_ids, 'attention_mask': attention_mask}
+                )
 
             outputs = model(**model_inputs)
             lm_logits = outputs.logits.contiguous()
@@ -434,7 +436,9 @@ def evaluate(args, model, tokenizer, prefix="", aux=False):
                 decoder_input_ids[decoder_input_ids == args.mlm_ignore_index] = tokenizer.pad_token_id
                 model_inputs['decoder_input_ids'] = decoder_input_ids
             else:
-                model_inputs.update({'position_ids': position_ids, 'token_type_ids': segment_ids})
+                model_inputs.update(
+                    {'position_ids': position_ids, 'token_type_ids': segment_ids, 'attention_mask': attention_mask}
+                )
 
             outputs = model(**model_inputs)
             lm_logits = outputs.logits
@@ -28,33 +28,38 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import copy
+import contextlib
 import json
 import logging
 import os
-import shutil
 from collections import defaultdict
 from pprint import pformat
 
 import torch
-from torch.multiprocessing import Process, set_start_method
+from torch.multiprocessing import set_start_method
 
 from . import models
 from .arguments import check_and_update_generation_args
 from .calibrate import ConfidenceEstimator
+from .confidence_store import ConfidenceFeatureReader, ConfidenceFeatureWriter, clear_confidence_features
+from .data_utils.adaptive_batching import MemoryAwareTokenBudget, MemoryMonitor, TokenBudget
+from .generation_cache import GenerationCache, file_identity, generation_key
 from .metrics import calculate_and_reduce_metrics
+from .model_utils.sharded_prediction import ShardedPredictionModel, ShardedPredictor
+from .model_utils.telemetry import TIMINGS_FILE, StageTimings, record_stages, set_stage_task, stage
+from .models.base import ValidationOutput
 from .ned.ned_utils import init_ned_model
-from .tasks.registry import get_tasks
-from .util import (
-    combine_folders_on_disk,
-    get_devices,
-    get_part_path,
-    load_config_file_to_args,
-    log_model_size,
-    make_data_loader,
-    set_seed,
-    split_folder_on_disk,
+from .prediction_writer import (
+    OUTPUT_FORMATS,
+    PredictionJournal,
+    PredictionRecord,
+    PredictionWriter,
+    UnfinishedBatches,
+    finished_fingerprint,
+    mark_finished,
 )
+from .tasks.registry import get_tasks
+from .util import get_devices, load_config_file_to_args, log_model_size, make_data_loader, set_seed
 
 logger = logging.getLogger(__name__)
 
@@ -98,7 +103,7 @@ def parse_argv(parser):
         default=None,
         nargs='+',
         type=int,
-        help='a list of devices that can be used for prediction. By default, all devices will be used.',
+        help='a list of devices that can be used for prediction. By default, all devices will be used. Batches are spread over one worker process per device; use -1 for the CPU.',
     )
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
     parser.add_argument('--data', default='.data/', type=str, help='where to load data from.')
@@ -141,6 +146,10 @@ def parse_argv(parser):
         type=int,
         help='Batch size for validation corresponding to tasks in val tasks',
     )
+    parser.add_argument(
+        '--pad_to_multiple_of', type=int, help='round padded lengths up to a multiple of this value (e.g. 8 or 16)'
+    )
+    parser.add_argument('--max_padding_buckets', type=int, help='maximum number of distinct padded lengths')
     parser.add_argument(
         "--reduce_metrics",
         type=str,
@@ -195,7 +204,10 @@ def parse_argv(parser):
         help='If provided, will be used to output confidence scores for each prediction.',
     )
     parser.add_argument(
-        "--confidence_feature_path", type=str, default=None, help='A .pkl file to save confidence features in.'
+        "--confidence_feature_path",
+        type=str,
+        default=None,
+        help='A directory to save confidence features in. It has one binary file per kind of feature, for calibrate.py.',
     )
     parser.add_argument(
         "--mc_dropout_num",
@@ -220,6 +232,52 @@ def parse_argv(parser):
         help='If True, will use mixed precision for prediction.'
         'This reduces memory consumption and is especially faster on GPUs like NVIDIA V100 and T4. May slightly change the generated output.',
     )
+    parser.add_argument(
+        '--output_format',
+        default='tsv',
+        choices=OUTPUT_FORMATS,
+        help='format of the prediction files. Each example is written out as soon as its batch is generated.',
+    )
+    parser.add_argument(
+        '--dedupe_inputs',
+        action='store_true',
+        help='batch examples with identical inputs together and generate outputs for each distinct input only once. '
+        'Has no effect when sampling (temperature > 0), where every example gets its own sample.',
+    )
+    parser.add_argument(
+        '--postprocess_workers',
+        type=int,
+        default=1,
+        help='number of threads that detokenize and post-process generated batches while the model generates the next ones. '
+        'Use 0 to post-process each batch before generating the next one.',
+    )
+    parser.add_argument(
+        '--resumable',
+        action='store_true',
+        help='keep a journal of finished examples next to the outputs. If the run is interrupted, running the same command '
+        'again continues from the journal and produces the same outputs as an uninterrupted run. A journal written with a '
+        'different model, data or generation arguments is not resumed. Tasks that a previous resumable run with the same '
+        'model, data and generation arguments has finished are skipped, unless --overwrite is given.',
+    )
+    parser.add_argument(
+        '--simulate_interruption',
+        default=None,
+        type=int,
+        help='For testing: stop with an error after adding this many batches to the journal of --resumable',
+    )
+    parser.add_argument(
+        '--report_timings',
+        action='store_true',
+        help='Record how much time each stage of prediction takes and what it processed, and save it to '
+        f'{TIMINGS_FILE} next to the results. Synchronizes CUDA around the stages that run the model',
+    )
+    parser.add_argument(
+        '--generation_cache',
+        type=str,
+        default=None,
+        help='a directory to keep generated outputs (and confidence features) in, keyed by the model files, the data and '
+        'the generation arguments. Later runs with the same key reuse them, and only compute metrics and confidence scores.',
+    )
     parser.add_argument(
         '--one_output_per_line',
         action='store_true',
@@ -249,6 +307,43 @@ def parse_argv(parser):
         help='return raw translation as well as ones post-processed with alignment. this is useful for STS filtering.',
     )
 
+    parser.add_argument(
+        '--split_OOM_batches',
+        action='store_true',
+        help='Split batches that run out of GPU memory in halves (recursively) and process them one after the other, '
+        'and build smaller batches for examples of similar length afterwards',
+    )
+    parser.add_argument(
+        '--simulate_OOM_tokens',
+        default=None,
+        type=int,
+        help='For testing: raise an out of memory error for every batch with more than this many padded tokens',
+    )
+    parser.add_argument(
+        '--adaptive_batch_size',
+        action='store_true',
+        help='Measure how much memory generation needs per token, and use the largest batches that fit in memory for '
+        'each range of example lengths, starting from --val_batch_size. Implies --split_OOM_batches.',
+    )
+    parser.add_argument(
+        '--max_val_batch_size',
+        default=None,
+        type=int,
+        help='The largest batch size (in tokens) that --adaptive_batch_size can grow to. Defaults to 8 times --val_batch_size.',
+    )
+    parser.add_argument(
+        '--memory_fraction',
+        default=0.9,
+        type=float,
+        help='With --adaptive_batch_size, the fraction of device memory (or of --cpu_memory_limit) that batches can fill',
+    )
+    parser.add_argument(
+        '--cpu_memory_limit',
+        default=None,
+        type=float,
+        help='With --adaptive_batch_size on the CPU, the resident memory (RSS) in GiB that prediction should stay under. '
+        'Defaults to the physical memory of the machine.',
+    )
     parser.add_argument(
         '--filter_long_inputs',
         action='store_true',
@@ -313,7 +408,7 @@ def set_default_values(args):
     sets default values that depend on other input arguments
     """
     if args.confidence_feature_path is None:
-        args.confidence_feature_path = os.path.join(args.path, 'confidence_features.pkl')
+        args.confidence_feature_path = os.path.join(args.path, 'confidence_features')
 
     if args.e2e_dialogue_evaluation and args.val_batch_size[0] != 1:
         logger.warning('When evaluating dialogues end-to-end, val_batch_size should be 1 so we load the data turn by turn')
@@ -358,6 +453,25 @@ def check_args(args):
     if args.main_metric_only and args.extra_metrics:
         raise ValueError('Please remove --main_metric_only from your arguments so the requested extra metrics can be shown.')
 
+    if args.resumable and (args.e2e_dialogue_evaluation or args.translate_example_split or args.translate_only_entities):
+        raise ValueError(
+            '--resumable does not work with end-to-end dialogue evaluation or translation example splitting, whose outputs are only written at the end'
+        )
+
+    if args.generation_cache is not None and args.e2e_dialogue_evaluation:
+        raise ValueError('--generation_cache does not work with end-to-end dialogue evaluation, which writes more files')
+
+    if args.postprocess_workers < 0:
+        raise ValueError('--postprocess_workers cannot be negative')
+
+    if args.adaptive_batch_size:
+        if not 0 < args.memory_fraction <= 1:
+            raise ValueError('--memory_fraction should be between 0 and 1')
+        if args.max_val_batch_size is not None and args.max_val_batch_size < max(args.val_batch_size):
+            raise ValueError('--max_val_batch_size cannot be smaller than --val_batch_size')
+        # batches that do not fit after all are split, and lower the budget
+        args.split_OOM_batches = True
+
 
 def prepare_data(args):
     # TODO handle multiple languages
@@ -369,6 +483,7 @@ def prepare_data(args):
         args.pred_src_languages *= len(args.tasks)
     for i, task in enumerate(args.tasks):
         logger.info(f'Loading {task}')
+        set_stage_task(task.name)
         kwargs = {'train': None, 'validation': None, 'test': None}
         if args.evaluate == 'train':
             del kwargs['train']  # deleting keys means use the default file name
@@ -388,7 +503,8 @@ def prepare_data(args):
             }
         )
 
-        split, path = task.get_splits(root=args.data, lower=args.lower, **kwargs)
+        with stage('load_data'):
+            split, path = task.get_splits(root=args.data, lower=args.lower, **kwargs)
         assert (split.eval or split.test or split.train) and not split.aux
         if split.train:
             data = split.train
@@ -409,7 +525,8 @@ def prepare_data(args):
         else:
             ned_model = init_ned_model(args, 'bootleg-annotator')
         if ned_model:
-            ned_model.process_examples(data.examples, path, task.utterance_field)
+            with stage('ned'):
+                ned_model.process_examples(data.examples, path, task.utterance_field)
 
         logger.info(f'{task.name} has {len(data.examples)} prediction examples')
         datasets.append(data)
@@ -424,48 +541,160 @@ def prepare_data_iterators(args, val_sets, numericalizer, device):
         args.val_batch_size *= len(val_sets)
     iters = []
     for task, bs, val_set in zip(args.tasks, args.val_batch_size, val_sets):
+        set_stage_task(task.name)
         task_iter = []
-        loader, original_order = make_data_loader(val_set, numericalizer, bs, device, train=False, return_original_order=True)
-        task_iter.append((task, loader, original_order))
+        # learned from OOM errors (and measured memory use), and shared between the iterator and generation
+        if args.adaptive_batch_size:
+            cpu_memory_limit = int(args.cpu_memory_limit * 2**30) if args.cpu_memory_limit is not None else None
+            token_budget = MemoryAwareTokenBudget(
+                MemoryMonitor(device, cpu_memory_limit),
+                initial_budget=bs,
+                max_budget=args.max_val_batch_size or 8 * bs,
+                memory_fraction=args.memory_fraction,
+            )
+            # the token budget decides how large batches are
+            bs = token_budget.max_budget
+        elif args.split_OOM_batches:
+            token_budget = TokenBudget()
+        else:
+            token_budget = None
+        loader, original_order = make_data_loader(
+            val_set, numericalizer, bs, device, train=False, return_original_order=True, token_budget=token_budget
+        )
+        task_iter.append((task, loader, original_order, token_budget))
 
         iters.extend(task_iter)
 
     return iters
 
 
-def create_output_lines(args, index, validation_output, raw_outputs=False):
-    if raw_outputs and args.translate_return_raw_outputs:
-        predictions = validation_output.raw_predictions
+def create_output_records(validation_output, raw_outputs=False):
+    """
+    Yields a PredictionRecord for each example of validation_output
+    """
+    predictions = validation_output.raw_predictions if raw_outputs else validation_output.predictions
+    confidence_scores = validation_output.confidence_scores or []
+    for i, example_id in enumerate(validation_output.example_ids):
+        yield PredictionRecord(
+            example_id=example_id,
+            predictions=predictions[i],
+            answer=validation_output.answers[i],
+            context=validation_output.contexts[i],
+            confidence_scores=[scores[i] for scores in confidence_scores],
+        )
+
+
+def select_examples(output, indices):
+    """
+    Returns the examples of a per-batch ValidationOutput at the given indices
+    """
+    return ValidationOutput(
+        example_ids=[output.example_ids[i] for i in indices],
+        predictions=[output.predictions[i] for i in indices],
+        raw_predictions=[output.raw_predictions[i] for i in indices],
+        answers=[output.answers[i] for i in indices],
+        contexts=[output.contexts[i] for i in indices],
+        confidence_features=[output.confidence_features[i] for i in indices],
+        confidence_scores=[[scores[i] for i in indices] for scores in output.confidence_scores],
+    )
+
+
+def stream_predictions(
+    args,
+    model,
+    predictor,
+    task_idx,
+    task,
+    data_iterator,
+    original_order,
+    token_budget,
+    confidence_estimators,
+    writers,
+    journal=None,
+    confidence_writer=None,
+    keep_raw_predictions=False,
+):
+    """
+    Generates predictions batch by batch, and hands every batch to `writers` (a prediction writer and optionally a
+    raw prediction writer) as soon as it is done. Returns the ValidationOutput of the whole task, in the original
+    order of the examples, for computing metrics. Raw predictions (unless `keep_raw_predictions`) and confidence
+    features are dropped once written (confidence features to `confidence_writer` if given), so they are never held
+    for the whole split.
+    If a journal is given, examples it has from a previous run are written from there instead of being generated
+    again, and new examples are added to it.
+    """
+    kept_outputs = []
+    kept_positions = []
+
+    def write(positions, output):
+        with stage('write_outputs'):
+            for writer, raw_outputs in zip(writers, (False, True)):
+                for example_position, record in zip(positions, create_output_records(output, raw_outputs)):
+                    writer.add(example_position, record)
+            if not keep_raw_predictions:
+                output.raw_predictions = [None] * len(positions)
+            if confidence_writer is not None:
+                if args.override_confidence_labels:
+                    for answer, example in zip(output.answers, output.confidence_features):
+                        for confidence in example:
+                            confidence.label = answer == args.override_confidence_labels
+                confidence_writer.append(output.confidence_features, positions)
+        output.confidence_features = [None] * len(positions)
+        kept_outputs.append(output)
+        kept_positions.extend(positions)
+
+    if journal is not None:
+        for positions, output in journal.entries:
+            write(positions, output)
+    new_journal_entries = 0
+
+    batches = UnfinishedBatches(data_iterator, original_order, journal.finished if journal is not None else None)
+    output_confidence_features = args.save_confidence_features or confidence_estimators is not None
+    if predictor is not None:
+        batch_outputs = predictor.iter_generate(
+            batches, task_idx, disable_progbar=False, output_confidence_features=output_confidence_features
+        )
     else:
-        predictions = validation_output.predictions
-
-    if args.one_output_per_line:
-        lines = [
-            '\t'.join(
-                [
-                    validation_output.example_ids[index],
-                    prediction,
-                    validation_output.answers[index],
-                    validation_output.contexts[index],
+        batch_outputs = model.iter_generate_batches(
+            batches,
+            task,
+            output_confidence_features=output_confidence_features,
+            disable_progbar=False,
+            token_budget=token_budget,
+        )
+
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=args.mixed_precision):
+        for batch_output in batch_outputs:
+            batch_positions = batches.positions.popleft()
+            with stage('calibration'):
+                batch_output.confidence_scores = [
+                    estimator.estimate(batch_output.confidence_features) for estimator in confidence_estimators or []
                 ]
-            )
-            for prediction in predictions[index]
-        ]  # one line per generation output
-    else:
-        lines = [
-            '\t'.join(
-                [
-                    validation_output.example_ids[index],
-                    *predictions[index],
-                    validation_output.answers[index],
-                    validation_output.contexts[index],
+            if journal is not None:
+                # examples of this batch that were finished before are kept as they were
+                new_indices = [
+                    i for i, example_position in enumerate(batch_positions) if example_position not in journal.finished
                 ]
-            )
-        ]  # one line with all generation outputs separated by '\t'
-    if args.calibrator_paths is not None:
-        for score in validation_output.confidence_scores:
-            lines = [line + '\t' + str(score[index]) for line in lines]  # append score to all lines
-    return lines
+                batch_positions = [batch_positions[i] for i in new_indices]
+                batch_output = select_examples(batch_output, new_indices)
+                journal.append(batch_positions, batch_output)
+                new_journal_entries += 1
+            write(batch_positions, batch_output)
+            if args.simulate_interruption is not None and new_journal_entries >= args.simulate_interruption:
+                raise RuntimeError(f'Simulated interruption after {new_journal_entries} batches')
+
+    validation_output = model.finalize_validation_output(
+        ValidationOutput.concatenate(kept_outputs), original_order=kept_positions
+    )
+    if confidence_estimators is not None:
+        confidence_scores = [[] for _ in confidence_estimators]
+        for output in kept_outputs:
+            for scores, batch_scores in zip(confidence_scores, output.confidence_scores):
+                scores.extend(batch_scores)
+        validation_output.confidence_scores = [
+            [score for _, score in sorted(zip(kept_positions, scores))] for scores in confidence_scores
+        ]
+    return validation_output
 
 
 def get_metrics_to_compute(args, task):
@@ -477,8 +706,7 @@ def get_metrics_to_compute(args, task):
     return metrics_to_compute
 
 
-def run(args, device):
-    print(args.model)
+def load_model(args, device):
     model_class = getattr(models, args.model)
     if args.is_hf_model:
         logger.info(f'Loading model {args.path} from HuggingFace model hub')
@@ -501,33 +729,127 @@ def run(args, device):
             tgt_lang=args.pred_tgt_languages[0],
         )
 
-    val_sets = prepare_data(args)
     model.add_new_vocab_from_data(args.tasks)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def run(args, devices):
+    print(args.model)
+    # with several devices, this process only prepares the data and post-processes the outputs, and
+    # generation runs in one worker process per device
+    sharded = len(devices) > 1
+    device = torch.device('cpu') if sharded else devices[0]
+    with stage('load_model'):
+        if sharded:
+            # only the workers need the weights
+            model = ShardedPredictionModel(
+                getattr(models, args.model),
+                args,
+                args.tasks,
+                save_directory=None if args.is_hf_model else args.path,
+                src_lang=args.pred_src_languages[0],
+                tgt_lang=args.pred_tgt_languages[0],
+            )
+        else:
+            model = load_model(args, device)
 
+    val_sets = prepare_data(args)
     iters = prepare_data_iterators(args, val_sets, model.numericalizer, device)
+    set_stage_task(None)
+
+    if not sharded:
+        log_model_size(logger, model, args.model)
+
+    cache_entries = None
+    if args.generation_cache is not None:
+        cache = GenerationCache(args.generation_cache)
+        cache_entries = [cache.entry(args, task, val_set) for task, val_set in zip(args.tasks, val_sets)]
+    need_confidence_features = args.save_confidence_features or args.calibrator_paths is not None
+    all_cached = cache_entries is not None and all(entry.has_outputs(need_confidence_features) for entry in cache_entries)
+
+    journal_fingerprints = None
+    if args.resumable:
+        # checkpoints are too large to hash on every run, so the model files are identified by their size and mtime
+        journal_fingerprints = [
+            generation_key(args, task, val_set, file_identity) for task, val_set in zip(args.tasks, val_sets)
+        ]
+
+    with stage('load_model'):
+        predictor = ShardedPredictor(args, devices, load_model) if sharded and not all_cached else None
+    try:
+        run_tasks(args, model, iters, predictor, cache_entries, journal_fingerprints)
+    finally:
+        if predictor is not None:
+            predictor.close()
 
-    log_model_size(logger, model, args.model)
-    model.to(device)
 
-    model.eval()
+def write_outputs(writers, validation_output):
+    with stage('write_outputs'):
+        for writer, raw_outputs in zip(writers, (False, True)):
+            for example_position, record in enumerate(create_output_records(validation_output, raw_outputs)):
+                writer.add(example_position, record)
+
+
+def load_cached_outputs(cache_entry, confidence_estimators):
+    validation_output = cache_entry.load_output()
+    if confidence_estimators is not None:
+        confidence_features = list(ConfidenceFeatureReader(cache_entry.confidence_feature_path))
+        with stage('calibration'):
+            validation_output.confidence_scores = [
+                estimator.estimate(confidence_features) for estimator in confidence_estimators
+            ]
+    return validation_output
+
+
+def run_tasks(args, model, iters, predictor=None, cache_entries=None, journal_fingerprints=None):
     task_scores = defaultdict(list)
 
     eval_dir = os.path.join(args.eval_dir, args.evaluate)
     os.makedirs(eval_dir, exist_ok=True)
 
-    for index, (task, it, original_order) in enumerate(iters):
+    for index, (task, it, original_order, token_budget) in enumerate(iters):
         logger.info(task.name)
+        set_stage_task(task.name)
         tgt_lang = args.pred_tgt_languages[index]
-        prediction_file_name = os.path.join(eval_dir, task.name + '.tsv')
-        raw_prediction_file_name = os.path.join(eval_dir, task.name + '.raw.tsv')
+        prediction_file_name = os.path.join(eval_dir, f'{task.name}.{args.output_format}')
+        raw_prediction_file_name = os.path.join(eval_dir, f'{task.name}.raw.{args.output_format}')
         results_file_name = os.path.join(eval_dir, task.name + '.results.json')
+        journal_file_name = os.path.join(eval_dir, task.name + '.journal')
+        done_file_name = os.path.join(eval_dir, task.name + '.done')
+
+        resuming = args.resumable and os.path.exists(journal_file_name)
+        if (
+            args.resumable
+            and not resuming
+            and not args.overwrite
+            and os.path.exists(prediction_file_name)
+            and os.path.exists(done_file_name)
+        ):
+            # resumable runs create the journal before the outputs, and replace it with the fingerprint of the run once
+            # the task is done
+            if finished_fingerprint(done_file_name) != journal_fingerprints[index]:
+                raise OSError(
+                    f'{prediction_file_name} was written by a prediction run with a different model, data or generation '
+                    'arguments. Use --overwrite to replace it.'
+                )
+            logger.info(f'{task.name} was finished by a previous run, reusing {prediction_file_name}')
+            if os.path.exists(results_file_name):
+                with open(results_file_name) as results_file:
+                    metrics = json.loads(results_file.read())
+                task_scores[task].append((len(original_order), metrics[task.metrics[0]]))
+            continue
 
         for fname in [prediction_file_name, raw_prediction_file_name, results_file_name]:
-            if os.path.exists(fname):
+            if os.path.exists(fname) and not resuming:
                 if args.overwrite:
                     logger.warning(f'{fname} already exists -- overwriting **')
                 else:
                     raise OSError(f'{fname} already exists')
+        if os.path.exists(done_file_name):
+            # the outputs it vouches for are about to be replaced
+            os.remove(done_file_name)
 
         if args.calibrator_paths is not None:
             confidence_estimators = []
@@ -538,36 +860,105 @@ def run(args, device):
         else:
             confidence_estimators = None
 
-        with torch.no_grad(), torch.cuda.amp.autocast(enabled=args.mixed_precision):
-            validation_output = model.validate(
-                it,
-                task,
-                eval_dir=eval_dir,
-                output_confidence_features=args.save_confidence_features,
-                original_order=original_order,
-                confidence_estimators=confidence_estimators,
-                disable_progbar=False,
-            )
-
-        if args.save_confidence_features:
-            torch.save(validation_output.confidence_features, args.confidence_feature_path)
-
-        # write into file
-        # TODO change to jsonl format
-        with open(prediction_file_name, 'w' + ('' if args.overwrite else '+')) as prediction_file:
-            for i in range(len(validation_output.example_ids)):
-                lines = create_output_lines(args, i, validation_output)
-                prediction_file.write('\n'.join(lines) + '\n')
+        cache_entry = cache_entries[index] if cache_entries is not None else None
+        cached = cache_entry is not None and cache_entry.has_outputs(
+            args.save_confidence_features or confidence_estimators is not None
+        )
 
-        if args.translate_return_raw_outputs:
-            with open(raw_prediction_file_name, 'w' + ('' if args.overwrite else '+')) as prediction_file:
-                for i in range(len(validation_output.example_ids)):
-                    lines = create_output_lines(args, i, validation_output, raw_outputs=True)
-                    prediction_file.write('\n'.join(lines) + '\n')
+        with contextlib.ExitStack() as stack:
+            # the cache entry is only completed after everything else is closed
+            cache_writer = stack.enter_context(cache_entry.writer()) if cache_entry is not None and not cached else None
+            journal = None
+            if args.resumable and not cached:
+                journal = stack.enter_context(
+                    PredictionJournal(journal_file_name, journal_fingerprints[index], overwrite=args.overwrite)
+                )
+            # confidence features go to the cache (and are copied from there) if there is one, since later runs may
+            # need them for confidence scores
+            store_confidence_features = args.save_confidence_features or (
+                cache_writer is not None and confidence_estimators is not None
+            )
+            confidence_writer = None
+            if store_confidence_features and not cached:
+                confidence_writer = stack.enter_context(
+                    ConfidenceFeatureWriter(
+                        cache_writer.confidence_feature_path if cache_writer is not None else args.confidence_feature_path
+                    )
+                )
+            writers = [
+                stack.enter_context(PredictionWriter(prediction_file_name, args.output_format, args.one_output_per_line))
+            ]
+            if args.translate_return_raw_outputs:
+                writers.append(
+                    stack.enter_context(
+                        PredictionWriter(raw_prediction_file_name, args.output_format, args.one_output_per_line)
+                    )
+                )
+            # these need the outputs of neighboring examples, so they can only be written out at the end
+            can_stream = not (
+                args.e2e_dialogue_evaluation or args.translate_example_split or getattr(args, 'translate_only_entities', False)
+            )
+            if cached:
+                logger.info(f'Reusing the outputs of {task.name} from {cache_entry.path}')
+                validation_output = load_cached_outputs(cache_entry, confidence_estimators)
+                write_outputs(writers, validation_output)
+            elif can_stream:
+                validation_output = stream_predictions(
+                    args,
+                    model,
+                    predictor,
+                    index,
+                    task,
+                    it,
+                    original_order,
+                    token_budget,
+                    confidence_estimators,
+                    writers,
+                    journal=journal,
+                    confidence_writer=confidence_writer,
+                    keep_raw_predictions=cache_writer is not None,
+                )
+            else:
+                if predictor is not None:
+                    generation_output = predictor.generate(
+                        it,
+                        index,
+                        disable_progbar=False,
+                        output_confidence_features=args.save_confidence_features or confidence_estimators is not None,
+                    )
+                    validation_output = model.finalize_validation_output(
+                        generation_output,
+                        output_confidence_features=store_confidence_features,
+                        original_order=original_order,
+                        confidence_estimators=confidence_estimators,
+                    )
+                else:
+                    with torch.no_grad(), torch.cuda.amp.autocast(enabled=args.mixed_precision):
+                        validation_output = model.validate(
+                            it,
+                            task,
+                            eval_dir=eval_dir,
+                            output_confidence_features=store_confidence_features,
+                            original_order=original_order,
+                            confidence_estimators=confidence_estimators,
+                            disable_progbar=False,
+                            token_budget=token_budget,
+                        )
+                write_outputs(writers, validation_output)
+                if confidence_writer is not None:
+                    with stage('write_outputs'):
+                        confidence_writer.append(validation_output.confidence_features)
+            if cache_writer is not None:
+                cache_writer.validation_output = validation_output
+
+        if cache_entry is not None and args.save_confidence_features:
+            clear_confidence_features(args.confidence_feature_path)
+            cache_entry.copy_confidence_features(args.confidence_feature_path)
 
         if len(validation_output.answers) > 0:
             metrics_to_compute = get_metrics_to_compute(args, task)
-            metrics = calculate_and_reduce_metrics(args, validation_output, metrics_to_compute, tgt_lang)
+            with stage('metrics'):
+                metrics = calculate_and_reduce_metrics(args, validation_output, metrics_to_compute, tgt_lang)
 
             with open(results_file_name, 'w' + ('' if args.overwrite else '+')) as results_file:
                 results_file.write(json.dumps(metrics) + '\n')
@@ -590,6 +981,13 @@ def run(args, device):
 
             task_scores[task].append((len(validation_output.answers), metrics[task.metrics[0]]))
 
+        # only now that all outputs of the task are on disk
+        if args.resumable:
+            mark_finished(done_file_name, journal_fingerprints[index])
+        if journal is not None:
+            journal.remove()
+    set_stage_task(None)
+
     decaScore = []
     for task in task_scores.keys():
         decaScore.append(
@@ -641,30 +1039,26 @@ def main(args):
     devices = get_devices(args.devices)
 
     if len(devices) > 1:
-        logger.info(f'Independent multi-GPU generation on following devices: {devices}')
-        all_processes = []
-        all_data_folders = split_folder_on_disk(args.data, len(devices))
-        if args.do_ned and args.ned_retrieve_method == 'bootleg':
-            all_bootleg_data_folders = split_folder_on_disk(args.bootleg_output_dir, len(devices))
-
-        for device_id in range(len(devices)):
-            copy_args = copy.copy(args)
-            copy_args.data = all_data_folders[device_id]
-            if args.do_ned and args.ned_retrieve_method == 'bootleg':
-                copy_args.bootleg_output_dir = all_bootleg_data_folders[device_id]
-            copy_args.eval_dir = get_part_path(args.eval_dir, device_id)
-
-            p = Process(target=run, args=(copy_args, devices[device_id]))
-            all_processes.append(p)
-            p.start()
-
-        for p in all_processes:
-            p.join()
-
-        for folder in all_data_folders:
-            shutil.rmtree(folder)
-        combine_folders_on_disk(args.eval_dir, len(devices), line_group_size=1, delete=True)
-
+        if args.e2e_dialogue_evaluation:
+            raise ValueError(
+                'End-to-end dialogue evaluation feeds each turn the previous predictions, so it can only use one device.'
+            )
+        if args.adaptive_batch_size:
+            raise ValueError('--adaptive_batch_size measures memory use on a single device, so it can only use one device.')
+        if args.split_OOM_batches:
+            raise ValueError(
+                '--split_OOM_batches learns batch sizes from out of memory errors in the process that builds the batches, '
+                'but with several devices those errors happen in the workers, so it can only use one device.'
+            )
+        logger.info(f'Sharded multi-device generation on following devices: {devices}')
     else:
         logger.info(f'Single device generation on: {devices[0]}')
-        run(args, devices[0])
+
+    if not args.report_timings:
+        run(args, devices)
+        return
+
+    # where prediction spends its time, saved next to the results; generation in sharded workers is not included
+    with record_stages(StageTimings()) as timings:
+        run(args, devices)
+    timings.save(os.path.join(args.eval_dir, args.evaluate, TIMINGS_FILE))
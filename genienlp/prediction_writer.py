@@ -0,0 +1,308 @@
+#
+# Copyright (c) 2022 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import io
+import json
+import logging
+import os
+import pickle
+from typing import List, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ('tsv', 'jsonl')
+
+
+class PredictionRecord(NamedTuple):
+    """
+    Everything that is written out for one example
+    """
+
+    example_id: str
+    predictions: List[str]
+    answer: str
+    context: str
+    confidence_scores: List[float]  # one per confidence estimator
+
+
+def format_record(record: PredictionRecord, output_format='tsv', one_output_per_line=False):
+    """
+    Returns the lines (without trailing newlines) that represent `record` in the output file.
+    With one_output_per_line, each prediction gets its own line and the other columns are repeated.
+    """
+    if output_format == 'tsv':
+        scores = [str(score) for score in record.confidence_scores]
+        if one_output_per_line:
+            return [
+                '\t'.join([record.example_id, prediction, record.answer, record.context, *scores])
+                for prediction in record.predictions
+            ]
+        return ['\t'.join([record.example_id, *record.predictions, record.answer, record.context, *scores])]
+
+    if output_format == 'jsonl':
+        if one_output_per_line:
+            predictions = [{'prediction': prediction} for prediction in record.predictions]
+        else:
+            predictions = [{'predictions': record.predictions}]
+        fields = {'answer': record.answer, 'context': record.context}
+        if record.confidence_scores:
+            fields['confidence_scores'] = record.confidence_scores
+        return [
+            json.dumps({'example_id': record.example_id, **prediction, **fields}, ensure_ascii=False)
+            for prediction in predictions
+        ]
+
+    raise ValueError(f'Unknown output format {output_format}, should be one of {OUTPUT_FORMATS}')
+
+
+class PredictionWriter(object):
+    """
+    Writes prediction records to a file while they are being generated.
+
+    Records can be added in any order, each with its position in the original dataset. As long as they arrive in
+    dataset order, they go straight through a buffered file. Evaluation batches are sorted by length though, so
+    usually they do not: records that arrive out of order are formatted and appended to a spill file next to the
+    output instead, and only their offsets are kept in memory. close() copies them from there in dataset order.
+    """
+
+    def __init__(self, path, output_format='tsv', one_output_per_line=False, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'Unknown output format {output_format}, should be one of {OUTPUT_FORMATS}')
+        self.path = path
+        self.output_format = output_format
+        self.one_output_per_line = one_output_per_line
+        self.buffer_size = buffer_size
+        self.num_written = 0
+        self.spill_path = path + '.unordered'
+        self._spilled = {}  # position -> (offset, size) in the spill file
+        self._spill_file = None
+        self._file = open(path, 'w', buffering=buffer_size, encoding='utf-8')
+
+    @property
+    def num_spilled(self):
+        return len(self._spilled)
+
+    def _format(self, record):
+        return '\n'.join(format_record(record, self.output_format, self.one_output_per_line)) + '\n'
+
+    def add(self, index: int, record: PredictionRecord):
+        if index < self.num_written or index in self._spilled:
+            raise ValueError(f'Example {index} was already added to {self.path}')
+        if index == self.num_written and not self._spilled:
+            self._file.write(self._format(record))
+            self.num_written += 1
+            return
+        if self._spill_file is None:
+            self._spill_file = open(self.spill_path, 'w+b', buffering=self.buffer_size)
+        data = self._format(record).encode('utf-8')
+        self._spilled[index] = (self._spill_file.tell(), len(data))
+        self._spill_file.write(data)
+
+    def close(self):
+        try:
+            if self._spill_file is not None:
+                self._spill_file.flush()
+                missing = [
+                    index
+                    for index in range(self.num_written, self.num_written + len(self._spilled))
+                    if index not in self._spilled
+                ]
+                if missing:
+                    raise ValueError(
+                        f'{len(self._spilled)} examples could not be written to {self.path} because earlier examples '
+                        f'(e.g. {missing[0]}) are missing'
+                    )
+                logger.debug('Reordering %d examples of %s from %s', len(self._spilled), self.path, self.spill_path)
+                for index in range(self.num_written, self.num_written + len(self._spilled)):
+                    offset, size = self._spilled.pop(index)
+                    self._spill_file.seek(offset)
+                    self._file.write(self._spill_file.read(size).decode('utf-8'))
+                    self.num_written += 1
+        finally:
+            self._discard()
+
+    def _discard(self):
+        self._file.close()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+            os.remove(self.spill_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep what was written so far, and let the original exception propagate
+            self._discard()
+
+
+class PredictionJournal(object):
+    """
+    Append-only record of the examples that a prediction run has finished, kept next to its outputs, so that an
+    interrupted run can continue where it stopped instead of starting over.
+
+    The journal starts with a header holding the fingerprint of the run (see generation_key()), and is only resumed
+    by a run with the same fingerprint, so that outputs of different models, data or generation arguments are never
+    mixed. Every entry after it is a pickled (positions, output) pair for the new examples of one batch: their
+    positions in the original dataset, and their ValidationOutput including confidence scores. Entries are flushed to
+    disk before generation moves on. A partially written last entry, as left behind by a crash, is ignored and
+    overwritten.
+    """
+
+    def __init__(self, path, fingerprint, overwrite=False):
+        """
+        overwrite: start over instead of raising an error if the journal was written by a run with another fingerprint
+        """
+        self.path = path
+        self.entries = []
+        self.finished = {}  # position -> example id
+        valid_size = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as journal_file:
+                try:
+                    header = pickle.load(journal_file)
+                except Exception:
+                    # an empty or truncated header, nothing was generated yet
+                    header = None
+                if header is not None and header != {'fingerprint': fingerprint}:
+                    if not overwrite:
+                        raise ValueError(
+                            f'{path} was written by a prediction run with a different model, data or generation '
+                            'arguments. Remove it, or use --overwrite, to start over.'
+                        )
+                    logger.warning('Starting over instead of resuming from %s, which belongs to a different run', path)
+                elif header is not None:
+                    valid_size = journal_file.tell()
+                    while True:
+                        try:
+                            positions, output = pickle.load(journal_file)
+                        except EOFError:
+                            break
+                        except Exception:
+                            # unpickling a truncated entry can fail in many different ways
+                            logger.warning('Ignoring an incomplete entry at the end of %s', path)
+                            break
+                        valid_size = journal_file.tell()
+                        self.entries.append((positions, output))
+                        self.finished.update(zip(positions, output.example_ids))
+                    logger.info('Resuming from %s, which has %d finished examples', path, len(self.finished))
+        self._file = open(path, 'ab')
+        self._file.truncate(valid_size)
+        if valid_size == 0:
+            self._dump({'fingerprint': fingerprint})
+
+    def _dump(self, obj):
+        pickle.dump(obj, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, positions, output):
+        self._dump((list(positions), output))
+        self.finished.update(zip(positions, output.example_ids))
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        """
+        Delete the journal once all outputs are written
+        """
+        self.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def mark_finished(path, fingerprint):
+    """
+    Record at `path` that all outputs of a task were written by a run with `fingerprint` (see generation_key()), so
+    that a later resumable run with the same fingerprint can skip the task
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(fingerprint + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def finished_fingerprint(path):
+    """
+    The fingerprint recorded by mark_finished(), or None if there is none
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+class UnfinishedBatches(object):
+    """
+    Wraps the data iterator of a task and leaves out batches whose examples are all finished according to `finished`,
+    a dictionary from positions in the original dataset to example ids. The positions of every batch that is let
+    through are queued in `positions`, for matching them to the outputs of the batch.
+    """
+
+    def __init__(self, data_iterator, original_order=None, finished=None):
+        self.data_iterator = data_iterator
+        self.original_order = original_order
+        self.finished = finished if finished is not None else {}
+        self.positions = collections.deque()
+
+    def __len__(self):
+        return len(self.data_iterator)
+
+    def __iter__(self):
+        position = 0
+        for batch in self.data_iterator:
+            batch_size = len(batch.example_id)
+            if self.original_order is not None:
+                batch_positions = self.original_order[position : position + batch_size]
+            else:
+                batch_positions = list(range(position, position + batch_size))
+            position += batch_size
+
+            for example_position, example_id in zip(batch_positions, batch.example_id):
+                if example_position in self.finished and self.finished[example_position] != example_id:
+                    raise ValueError(
+                        f'Example {example_position} is {example_id}, but {self.finished[example_position]} in the '
+                        'journal of a previous run. The data or the batching has changed, remove the journal to start over.'
+                    )
+            if all(example_position in self.finished for example_position in batch_positions):
+                continue
+            self.positions.append(batch_positions)
+            yield batch
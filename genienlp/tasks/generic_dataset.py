@@ -80,6 +80,13 @@ def all_tokens_fn(batch: Iterable[NumericalizedExamples]):
     return (max([context_question_len(e) for e in batch]) + max([answer_len(e) for e in batch])) * len(batch)
 
 
+def packed_tokens_fn(batch: Iterable[NumericalizedExamples]):
+    """
+    with sequence packing, padding is mostly removed, so the cost of a batch is close to its number of real tokens
+    """
+    return sum(context_question_len(e) + answer_len(e) for e in batch)
+
+
 def default_batch_fn(batch: Iterable[NumericalizedExamples]):
     return len(batch)
 
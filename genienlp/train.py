@@ -29,11 +29,15 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import contextlib
 import logging
 import logging.handlers
 import math
 import os
+import queue
+import shutil
 import time
+import traceback
 from copy import deepcopy
 from pprint import pformat
 
@@ -43,10 +47,26 @@ from torch.utils.tensorboard import SummaryWriter
 
 from . import arguments, models
 from .arguments import save_args
+from .data_utils.adaptive_batching import TokenBudget, batch_num_rows, is_oom_error, run_with_oom_splitting
+from .data_utils.multitask_sampler import MultiTaskSampler
 from .metrics import calculate_and_reduce_metrics
+from .model_utils.checkpointing import enable_activation_checkpointing
+from .model_utils.distributed import (
+    all_reduce_mean,
+    all_reduce_sum,
+    barrier,
+    cleanup_distributed,
+    get_rank,
+    get_world_size,
+    init_distributed,
+    is_main_process,
+    main_process_first,
+    world_size_from_env,
+)
 from .model_utils.optimizer import init_opt
 from .model_utils.parallel_utils import NamedTupleCompatibleDataParallel
 from .model_utils.saver import Saver
+from .model_utils.telemetry import StepTelemetry
 from .ned.ned_utils import init_ned_model
 from .util import (
     elapsed_time,
@@ -60,20 +80,25 @@ from .util import (
 )
 
 
+logger = logging.getLogger(__name__)
+
+
 def initialize_logger(args):
     # set up file logger
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
-    handler = logging.handlers.RotatingFileHandler(
-        os.path.join(args.log_dir, 'train.log'), maxBytes=1024 * 1024 * 10, backupCount=1
-    )
-    handler.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(name)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # in distributed training, only rank 0 writes the training log
+    if is_main_process():
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(args.log_dir, 'train.log'), maxBytes=1024 * 1024 * 10, backupCount=1
+        )
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
-    handler.setLevel(logging.DEBUG)
+    handler.setLevel(logging.DEBUG if is_main_process() else logging.WARNING)
     logger.addHandler(handler)
     logger.propagate = False
 
@@ -159,39 +184,155 @@ def prepare_data(args, logger):
     return train_sets, val_sets, aux_sets
 
 
-accumulated_batch_lengths = 0
-
-
-def train_step(model, batch, iteration, opt, devices, lr_scheduler=None, grad_clip=None, gradient_accumulation_steps=1):
-    # Since the batch size is different in each call to this function due to dynamic batching, we need to keep track of
-    # the total batch size
-    global accumulated_batch_lengths
-    model.train()
-    if (iteration) % gradient_accumulation_steps == 0:
-        opt.zero_grad()
-    loss = model(batch).loss
-    if torch.isnan(loss).any():
-        raise RuntimeError('Got NaN loss %s', str(loss))
-    if len(devices) > 1:
-        loss = loss.mean()
-    non_accumulated_loss = loss.item()
-    loss = loss * len(batch[0])
-    accumulated_batch_lengths += len(batch[0])
-
-    loss.backward()
-    grad_norm = None
-    if (iteration + 1) % gradient_accumulation_steps == 0:
-        for p in model.parameters():
-            if p.grad is None:
-                continue
-            p.grad /= accumulated_batch_lengths
-        accumulated_batch_lengths = 0
-        if grad_clip > 0.0:
-            grad_norm = torch.nn.utils.clip_grad_norm_(model.params, grad_clip)
-        opt.step()
-        lr_scheduler.step()
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class Trainer(object):
+    '''
+    Runs forward, backward and optimizer steps, and keeps the number of examples accumulated since the last optimizer step
+    (which differs between calls because of dynamic batching)
+    '''
+
+    def __init__(
+        self,
+        model,
+        opt,
+        lr_scheduler,
+        devices,
+        *,
+        grad_clip,
+        gradient_accumulation_steps=1,
+        amp_dtype=None,
+        split_oom_batches=False,
+        simulate_oom_tokens=None,
+    ):
+        self.model = model
+        self.opt = opt
+        self.lr_scheduler = lr_scheduler
+        self.devices = devices
+        self.grad_clip = grad_clip
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.accumulated_batch_lengths = 0
+        # set by train() to time the forward/backward and optimizer parts of each step
+        self.telemetry = None
+
+        self.amp_dtype = AMP_DTYPES[amp_dtype] if amp_dtype is not None else None
+        self.device_type = devices[0].type
+        if self.amp_dtype == torch.float16 and self.device_type != 'cuda':
+            raise ValueError('fp16 mixed precision training requires a GPU; use --amp_dtype bf16 on CPU')
+        # bf16 has the same exponent range as fp32, so only fp16 needs loss scaling
+        self.grad_scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16)
+
+        self.is_ddp = isinstance(model, torch.nn.parallel.DistributedDataParallel)
+        # batches that run out of memory are split in halves and processed as micro-batches
+        self.split_oom_batches = split_oom_batches
+        self.simulate_oom_tokens = simulate_oom_tokens
+        # without accumulation (and outside DDP, which averages over ranks) the loss is already the mean over the
+        # batch, so gradients need no further normalization. Split batches accumulate gradients over their micro-batches.
+        self.normalize_in_loss = gradient_accumulation_steps == 1 and not self.is_ddp and not split_oom_batches
+
+    def _section(self, name):
+        if self.telemetry is None:
+            return contextlib.nullcontext()
+        return self.telemetry.section(name)
+
+    def autocast(self):
+        if self.amp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device_type, dtype=self.amp_dtype)
+
+    def _normalize_and_clip_gradients(self, normalizer):
+        '''
+        Divide gradients by normalizer and clip them to self.grad_clip, in a single multiply over all gradients
+        '''
+        grads = [p.grad for p in self.model.params if p.grad is not None]
+        if not grads:
+            return None
+        grad_norm = None
+        scale = 1.0 / normalizer
+        if self.grad_clip > 0.0:
+            device = grads[0].device
+            grad_norm = torch.norm(torch.stack([torch.norm(g.detach(), 2.0).to(device) for g in grads]), 2.0) / normalizer
+            scale *= min(1.0, self.grad_clip / (grad_norm.item() + 1e-6))
+        if scale != 1.0:
+            torch._foreach_mul_(grads, scale)
+        return grad_norm
+
+    def train_step(self, batch, iteration, token_budget=None):
+        '''
+        token_budget: if batches are split on OOM errors, the TokenBudget of the iterator that produced `batch`,
+        so that it learns to build smaller batches
+        '''
+        self.model.train()
+        if (iteration) % self.gradient_accumulation_steps == 0:
+            self.opt.zero_grad()
+            # parts of a split batch that finished before another part ran out of memory (and was skipped with
+            # --allow_OOM) were counted, but their gradients are gone now
+            self.accumulated_batch_lengths = 0
+        should_step = (iteration + 1) % self.gradient_accumulation_steps == 0
+        with self._section('forward_backward'):
+            if self.split_oom_batches:
+                outputs = run_with_oom_splitting(self._forward_backward, batch, token_budget, self.simulate_oom_tokens)
+                # report the mean over the examples of the whole batch, as if it had not been split
+                non_accumulated_loss = sum(loss * batch_num_rows(micro_batch) for micro_batch, loss in outputs)
+                non_accumulated_loss /= batch_num_rows(batch)
+            else:
+                non_accumulated_loss = self._forward_backward(batch, should_step)
+        grad_norm = None
+        if should_step:
+            with self._section('optimizer'):
+                grad_norm = self._optimizer_step()
+
+        return non_accumulated_loss, grad_norm
+
+    def _forward_backward(self, batch, should_step=True):
+        # only all-reduce gradients on the micro-batch that ends an accumulation window
+        sync_context = self.model.no_sync() if self.is_ddp and not should_step else contextlib.nullcontext()
+        with sync_context:
+            with self.autocast():
+                loss = self.model(batch).loss
+            if torch.isnan(loss).any():
+                raise RuntimeError('Got NaN loss %s', str(loss))
+            if len(self.devices) > 1:
+                loss = loss.mean()
+            non_accumulated_loss = loss.item()
+            if not self.normalize_in_loss:
+                loss = loss * len(batch[0])
+
+            try:
+                self.grad_scaler.scale(loss).backward()
+            except RuntimeError as e:
+                if is_oom_error(e):
+                    # backward stopped after adding to some of the gradients, so none of them can be trusted anymore
+                    logger.warning('Out of memory during backward; dropping the gradients accumulated since the last step')
+                    self.opt.zero_grad()
+                    self.accumulated_batch_lengths = 0
+                raise e
+        self.accumulated_batch_lengths += len(batch[0])
+
+        return non_accumulated_loss
+
+    def _optimizer_step(self):
+        if not self.normalize_in_loss and not self.is_ddp and self.accumulated_batch_lengths == 0:
+            # all examples of this step were dropped because they ran out of memory
+            self.lr_scheduler.step()
+            return None
+        if self.normalize_in_loss:
+            normalizer = 1
+        elif self.is_ddp:
+            # DDP averages gradients over ranks, so normalize by the average number of examples per rank
+            normalizer = all_reduce_sum(self.accumulated_batch_lengths) / get_world_size()
+        else:
+            normalizer = self.accumulated_batch_lengths
+        self.accumulated_batch_lengths = 0
+        self.grad_scaler.unscale_(self.opt)
+        grad_norm = self._normalize_and_clip_gradients(normalizer)
+        # skips the update if fp16 gradients overflowed
+        self.grad_scaler.step(self.opt)
+        self.grad_scaler.update()
+        self.lr_scheduler.step()
 
-    return non_accumulated_loss, grad_norm
+        return grad_norm
 
 
 def update_fraction(args, task_iteration):
@@ -225,13 +366,21 @@ def should_log(iteration, log_every):
 def validate_while_training(task, val_iter, model, args, num_print=10):
     with torch.no_grad():
         model.eval()
-        if isinstance(model, torch.nn.DataParallel):
+        if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
             # get rid of the DataParallel wrapper
             model = model.module
 
+        # contexts are only needed to print examples and for metrics that look at the input,
+        # and gold answers to print examples and for every metric other than the loss
+        output_contexts = num_print > 0 or any(metric in task.metrics for metric in ('ser', 'e2e_dialogue_score'))
+        output_answers = num_print > 0 or any(metric != 'loss' for metric in task.metrics)
         validation_output = model.validate(
-            val_iter, task, disable_progbar=len(val_iter) < 500
-        )  # show progress bar if there are more than 500 batches in the validation set
+            val_iter,
+            task,
+            disable_progbar=len(val_iter) < 500,  # show progress bar if there are more than 500 batches in the validation set
+            output_contexts=output_contexts,
+            output_answers=output_answers,
+        )
 
         # loss is already calculated
         metrics_to_compute = [metric for metric in task.metrics if metric != 'loss']
@@ -241,24 +390,25 @@ def validate_while_training(task, val_iter, model, args, num_print=10):
         results = {
             'model prediction': validation_output.predictions,
             'gold answer': validation_output.answers,
-            'context': validation_output.contexts,
         }
+        if output_contexts:
+            results['context'] = validation_output.contexts
 
         print_results(results, num_print)
 
         return validation_output, metrics
 
 
-def do_validate_while_training(
-    iteration, args, model, val_iters, *, train_task, round_progress, task_progress, writer, logger
-):
+def log_validation_results(iteration, args, val_results, *, train_task, round_progress, task_progress, writer, logger):
+    """
+    val_results is a list of (val_task, val_loss, metric_dict), one per validation task. Returns the deca score.
+    """
     deca_score = 0
-    for val_task_idx, (val_task, val_iter) in enumerate(val_iters):
-        output, metric_dict = validate_while_training(val_task, val_iter, model, args, num_print=args.num_print)
-        val_loss = output.loss
+    for val_task, val_loss, metric_dict in val_results:
         if val_loss is not None:
             log_entry = f'{args.timestamp}:{elapsed_time(logger)}:iteration_{iteration}:{round_progress}train_{train_task.name}:{task_progress}val_{val_task.name}:val_loss_{val_loss:.4f}:'
-            writer.add_scalar(f'loss/{val_task.name}/val', val_loss, iteration)
+            if writer is not None:
+                writer.add_scalar(f'loss/{val_task.name}/val', val_loss, iteration)
         else:
             log_entry = f'{args.timestamp}:{elapsed_time(logger)}:iteration_{iteration}:{round_progress}train_{train_task.name}:{task_progress}val_{val_task.name}:'
 
@@ -288,6 +438,170 @@ def do_validate_while_training(
     return deca_score
 
 
+def do_validate_while_training(
+    iteration, args, model, val_iters, *, train_task, round_progress, task_progress, writer, logger
+):
+    val_results = []
+    for val_task, val_iter in val_iters:
+        output, metric_dict = validate_while_training(val_task, val_iter, model, args, num_print=args.num_print)
+        val_results.append((val_task, output.loss, metric_dict))
+
+    return log_validation_results(
+        iteration,
+        args,
+        val_results,
+        train_task=train_task,
+        round_progress=round_progress,
+        task_progress=task_progress,
+        writer=writer,
+        logger=logger,
+    )
+
+
+def _async_validation_worker(args, val_sets, device, jobs, results):
+    model_class = getattr(models, args.model)
+    model = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        iteration, snapshot_path = job
+        try:
+            if model is None:
+                # the numericalizer was saved in args.save when training started
+                model, _ = model_class.load(
+                    args.save,
+                    model_checkpoint_file=os.path.relpath(snapshot_path, args.save),
+                    args=args,
+                    device=device,
+                    tasks=args.val_tasks,
+                    src_lang=args.train_src_languages.split('+')[0],
+                    tgt_lang=args.train_tgt_languages.split('+')[0],
+                )
+                model.to(device)
+                val_iters = [
+                    (task, make_data_loader(dataset, model.numericalizer, bs, device, train=False))
+                    for task, dataset, bs in zip(args.val_tasks, val_sets, args.val_batch_size)
+                ]
+            else:
+                model.load_state_dict(torch.load(snapshot_path, map_location=device)['model_state_dict'], strict=True)
+
+            val_results = []
+            for val_task, val_iter in val_iters:
+                output, metric_dict = validate_while_training(val_task, val_iter, model, args, num_print=0)
+                val_results.append((output.loss, metric_dict))
+            results.put((iteration, snapshot_path, val_results, None))
+        except Exception:
+            results.put((iteration, snapshot_path, None, traceback.format_exc()))
+
+
+class AsyncValidator(object):
+    """
+    Runs validation in a separate process on a snapshot of the model weights, so that training does not stop
+    for generation and metric computation. Results arrive later, in submission order, through poll().
+    """
+
+    def __init__(self, args, val_sets, device, saver, max_pending=2):
+        self.snapshot_dir = os.path.join(args.log_dir, 'validation_snapshots')
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        # snapshots are written by the checkpoint writer thread, like checkpoints
+        self.saver = saver
+        self.max_pending = max_pending
+        self.pending = {}
+        self._ready = []
+
+        # CUDA cannot be used in forked processes
+        ctx = torch.multiprocessing.get_context('spawn')
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._process = ctx.Process(
+            target=_async_validation_worker, args=(args, val_sets, device, self._jobs, self._results), daemon=True
+        )
+        self._process.start()
+
+    def _wait_for_result(self):
+        while True:
+            try:
+                self._ready.append(self._results.get(timeout=10))
+                return
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(f'Validation worker died with exit code {self._process.exitcode}')
+
+    def submit(self, iteration, model_state_dict, **log_kwargs):
+        # bound the number of snapshots on disk if validation is slower than training
+        while len(self.pending) - len(self._ready) >= self.max_pending:
+            self._wait_for_result()
+        snapshot_path = os.path.join(self.snapshot_dir, f'iteration_{iteration}.pth')
+        self.pending[iteration] = log_kwargs
+        # the weights are copied to CPU now, and the worker gets the job once they are on disk
+        self.saver.submit(self._write_snapshot, {'model_state_dict': model_state_dict}, iteration, snapshot_path)
+
+    def _write_snapshot(self, state_dict, iteration, snapshot_path):
+        try:
+            torch.save(state_dict, snapshot_path)
+        except Exception:
+            # reported like a failed validation
+            self._results.put((iteration, snapshot_path, None, traceback.format_exc()))
+            return
+        self._jobs.put((iteration, snapshot_path))
+
+    def poll(self, wait=False):
+        """
+        Returns (iteration, snapshot_path, val_results, log_kwargs) for the validations that have finished.
+        If wait is True, blocks until all submitted validations are finished.
+        """
+        while True:
+            try:
+                self._ready.append(self._results.get_nowait())
+            except queue.Empty:
+                break
+        while wait and len(self._ready) < len(self.pending):
+            self._wait_for_result()
+
+        finished = []
+        for iteration, snapshot_path, val_results, error in self._ready:
+            log_kwargs = self.pending.pop(iteration)
+            if error is not None:
+                logger.error(f'Validation of iteration {iteration} failed:\n{error}')
+                if os.path.exists(snapshot_path):
+                    os.unlink(snapshot_path)
+                continue
+            finished.append((iteration, snapshot_path, val_results, log_kwargs))
+        self._ready = []
+        return finished
+
+    def close(self):
+        # snapshots still being written would queue their job after the worker is told to stop
+        self.saver.flush()
+        if self._process.is_alive():
+            self._jobs.put(None)
+            self._process.join()
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+
+def handle_async_validation_results(finished, args, best_decascore, *, saver, writer, logger):
+    for iteration, snapshot_path, val_results, log_kwargs in finished:
+        deca_score = log_validation_results(
+            iteration,
+            args,
+            [(val_task, val_loss, metric_dict) for val_task, (val_loss, metric_dict) in zip(args.val_tasks, val_results)],
+            writer=writer,
+            logger=logger,
+            **log_kwargs,
+        )
+        # the snapshot holds the weights that were validated, so the best model stays correct even though
+        # training has moved on since; it becomes best.pth as is, without being loaded again
+        if best_decascore is None or best_decascore < deca_score:
+            best_decascore = deca_score
+            logger.info(f'{args.timestamp}:{elapsed_time(logger)}:iteration_{iteration}: saving new best model')
+            saver.save_best_from_file(snapshot_path, best_decascore)
+        else:
+            os.unlink(snapshot_path)
+
+    return best_decascore
+
+
 def maybe_save(
     iteration,
     model,
@@ -303,7 +617,12 @@ def maybe_save(
     timestamp,
     log_dir,
     model_parallel,
+    grad_scaler=None,
+    sampler_state=None,
 ):
+    if not is_main_process():
+        return best_decascore
+
     save_wo_finetuning = bool(best_decascore == -1)
     should_save_best = False
     if deca_score is not None and (best_decascore is None or best_decascore < deca_score):
@@ -321,16 +640,20 @@ def maybe_save(
     save_model_state_dict = {'model_state_dict': model_state_dict, 'best_decascore': best_decascore}
     save_opt_state_dict = opt.state_dict()
     save_opt_state_dict.update({'start_iteration': iteration})
+    if grad_scaler is not None and grad_scaler.is_enabled():
+        save_opt_state_dict['grad_scaler'] = grad_scaler.state_dict()
+    if sampler_state is not None:
+        save_opt_state_dict['sampler'] = sampler_state
 
     if not save_wo_finetuning:
-        saver.save(save_model_state_dict, save_opt_state_dict, global_step=iteration)
+        # a new best model is linked to the checkpoint, so it costs neither a second snapshot nor a second write
+        saver.save(save_model_state_dict, save_opt_state_dict, global_step=iteration, best=should_save_best)
     if should_save_best:
         logger.info(
             f'{timestamp}:{elapsed_time(logger)}:iteration_{iteration}:{round_progress}train_{train_task.name}:{task_progress} saving new best model'
         )
-        torch.save(save_model_state_dict, os.path.join(log_dir, 'best.pth'))
-        if not save_wo_finetuning:
-            torch.save(save_opt_state_dict, os.path.join(log_dir, 'best_optim.pth'))
+        if save_wo_finetuning:
+            saver.save_file(save_model_state_dict, 'best.pth')
 
         if model_parallel:
             model.numericalizer.save(saver._savedir)
@@ -358,6 +681,9 @@ def do_log_training_loss(
     writer,
     log_prefix,
 ):
+    # average over ranks in distributed training; the batch size is reported for the global batch
+    loss, num_examples, len_contexts, len_answers = all_reduce_mean(loss, num_examples, len_contexts, len_answers)
+    num_examples *= get_world_size()
     avg_batch_size = f'avbatch_{num_examples:.0f}_{len_contexts:.0f}_{len_answers:.0f}:'
     logger.info(
         f'{timestamp}:{elapsed_time(logger)}:iteration_{iteration}:epoch_{epochs:.2f}:{round_progress}train_{train_task.name}:{task_progress}{avg_batch_size}{log_prefix}/loss_{loss:.4f}'
@@ -372,26 +698,6 @@ def do_log_training_loss(
             writer.add_scalar(f'{log_prefix}/norm', grad_norm, iteration)
 
 
-def np_coin(prob):
-    return np.random.uniform() < prob
-
-
-def get_next_batch(train_iter, aux_iters, *, task, task_idx, task_fraction, use_curriculum):
-    if use_curriculum:
-        aux_iter = aux_iters[task_idx][1]
-        prob = np_coin(task_fraction[task])
-        if prob == 'aux':
-            return next(aux_iter)
-        else:
-            assert prob == 'train'
-            batch = next(train_iter)
-
-    else:
-        batch = next(train_iter)
-
-    return batch
-
-
 def train(
     args,
     devices,
@@ -402,6 +708,7 @@ def train(
     train_iterations,
     numericalizer,
     *,
+    trainer,
     log_every,
     val_every,
     val_after,
@@ -416,8 +723,12 @@ def train(
     rnd=1,
     best_decascore,
     use_curriculum,
+    sampler_state=None,
 ):
-    """main training function"""
+    """
+    main training function
+    sampler_state: the state of the MultiTaskSampler saved with the checkpoint that training resumes from, if any
+    """
     local_loss, num_examples, len_contexts, len_answers, iteration = 0, 0, 0, 0, 1
 
     train_iter_deep = deepcopy(train_iterations)
@@ -435,36 +746,71 @@ def train(
         task_total_num_examples[task] = 0.0
         task_train_size[task] = len(train_set)
 
-    saver = Saver(args.log_dir, args.max_to_keep)
+    saver = Saver(args.log_dir, args.max_to_keep, max_inflight_saves=args.max_inflight_saves)
+    telemetry = StepTelemetry(
+        args.log_dir,
+        writer,
+        devices[0],
+        enabled=args.telemetry and is_main_process(),
+        profile_iterations=args.profile_iterations if is_main_process() else None,
+        log_prefix=log_prefix,
+    )
+    trainer.telemetry = telemetry
     per_task_iterations = 0
 
     logger.info('Preparing iterators')
     main_device = devices[0]
 
+    # learned from OOM errors, and shared between each training iterator and the trainer
+    token_budgets = {task: TokenBudget() if args.split_OOM_batches else None for task in args.train_tasks}
+
+    def iterator_seed(task_idx):
+        # prefetching threads cannot share the global random generator deterministically
+        return args.seed + task_idx if args.prefetch_batches > 0 else None
+
     t0 = time.time()
     train_iters = [
         (
             task,
             make_data_loader(
-                dataset, numericalizer, tok, main_device, train=True, batching_algorithm=args.train_batching_algorithm
+                dataset,
+                numericalizer,
+                tok,
+                main_device,
+                train=True,
+                batching_algorithm=args.train_batching_algorithm,
+                num_shards=get_world_size(),
+                shard_id=get_rank(),
+                token_budget=token_budgets[task],
+                seed=iterator_seed(task_idx),
             ),
         )
-        for task, dataset, tok in zip(args.train_tasks, train_sets, args.train_batch_tokens)
+        for task_idx, (task, dataset, tok) in enumerate(zip(args.train_tasks, train_sets, args.train_batch_tokens))
     ]
     t1 = time.time()
     logger.info('Preparing train iterators took %d minutes and %.2f seconds', int((t1 - t0) // 60), (t1 - t0) % 60)
 
-    train_iters = [(task, iter(train_iter)) for task, train_iter in train_iters]
     # save memory
     del train_sets
 
-    val_iters = [
-        (
-            task,
-            make_data_loader(dataset, numericalizer, bs, main_device, train=False),
-        )  # no need to specify batching_algorithm for validation sets
-        for task, dataset, bs in zip(args.val_tasks, val_sets, args.val_batch_size)
-    ]
+    validator = None
+    if args.async_validation and is_main_process():
+        # the validation worker loads the numericalizer from here
+        numericalizer.save(args.log_dir)
+        validation_device = (
+            torch.device('cpu') if args.async_validation_device < 0 else torch.device(args.async_validation_device)
+        )
+        logger.info(f'Validating in a separate process on {validation_device}')
+        validator = AsyncValidator(args, val_sets, validation_device, saver)
+        val_iters = []
+    else:
+        val_iters = [
+            (
+                task,
+                make_data_loader(dataset, numericalizer, bs, main_device, train=False),
+            )  # no need to specify batching_algorithm for validation sets
+            for task, dataset, bs in zip(args.val_tasks, val_sets, args.val_batch_size)
+        ]
     # save memory
     del val_sets
 
@@ -474,15 +820,26 @@ def train(
             (
                 name,
                 make_data_loader(
-                    dataset, numericalizer, tok, main_device, train=True, batching_algorithm=args.train_batching_algorithm
+                    dataset,
+                    numericalizer,
+                    tok,
+                    main_device,
+                    train=True,
+                    batching_algorithm=args.train_batching_algorithm,
+                    num_shards=get_world_size(),
+                    shard_id=get_rank(),
+                    seed=iterator_seed(len(args.train_tasks) + task_idx),
                 ),
             )
-            for name, dataset, tok in zip(args.train_tasks, aux_sets, args.train_batch_tokens)
+            for task_idx, (name, dataset, tok) in enumerate(zip(args.train_tasks, aux_sets, args.train_batch_tokens))
         ]
-        aux_iters = [(task, iter(aux_iter)) for task, aux_iter in aux_iters]
         # save memory
         del aux_sets
 
+    sampler = MultiTaskSampler(train_iters, aux_iters, prefetch=args.prefetch_batches, state_dict=sampler_state)
+    if sampler_state is not None:
+        logger.info('Restored the positions of the training data iterators')
+
     zero_loss = 0
     logger.info(f'Begin {log_prefix}')
 
@@ -499,7 +856,7 @@ def train(
             else:
                 train_iterations = train_iter_deep
 
-            for task_idx, (task, train_iter) in enumerate(train_iters):
+            for task_idx, task in enumerate(args.train_tasks):
                 task_iterations = train_iterations[task_idx] if train_iterations is not None else None
                 if task_iterations == 0:
                     continue
@@ -507,19 +864,16 @@ def train(
                     task_done[task] = True
                     continue
 
-                # load batches even if (args.resume == True) and we are going to skip the iteration
-                # this makes runs that are resumed have the exact same behavior as runs that are
-                # finished in one pass (given that the random seed is the same).
-                batch = get_next_batch(
-                    train_iter,
-                    aux_iters,
-                    task=task,
-                    task_idx=task_idx,
-                    task_fraction=task_fraction,
-                    use_curriculum=use_curriculum,
-                )
+                # unless their positions were restored from the checkpoint, load batches even if (args.resume == True)
+                # and we are going to skip the iteration. this makes runs that are resumed have the exact same
+                # behavior as runs that are finished in one pass (given that the random seed is the same).
+                telemetry.begin_step(task, iteration)
+                if iteration >= start_iteration or sampler_state is None:
+                    with telemetry.section('data'):
+                        batch = sampler.next_batch(task, task_fraction[task] if use_curriculum else None)
 
                 if iteration < start_iteration:
+                    telemetry.abort_step()
                     # skip this iteration (this is done to ensure iterators are at the same position when resuming)
                     task_iteration[task] += 1
                     iteration += 1
@@ -532,31 +886,32 @@ def train(
 
                 # param update
                 try:
-                    loss, grad_norm = train_step(
-                        model,
-                        batch,
-                        iteration,
-                        opt,
-                        devices,
-                        lr_scheduler=lr_scheduler,
-                        grad_clip=args.grad_clip,
-                        gradient_accumulation_steps=args.gradient_accumulation_steps,
-                    )
+                    loss, grad_norm = trainer.train_step(batch, iteration, token_budget=token_budgets[task])
                 except RuntimeError as e:
-                    # Ignore cuda OOM errors during training
+                    # Ignore cuda OOM errors during training (with --split_OOM_batches, only examples that do not fit on their own)
                     # However, if the error happens frequently, consider decreasing batch size.
-                    if args.allow_OOM and 'CUDA out of memory' in str(e):
+                    if args.allow_OOM and is_oom_error(e):
                         logger.warning(e)
+                        telemetry.abort_step()
                         continue
                     else:
                         raise e
                 if loss is None:
                     logger.info('Encountered NAN loss during training. Continue training ignoring the current batch')
+                    telemetry.abort_step()
                     continue
-                if loss < 1e-6:
+                telemetry.end_step(batch)
+                # decided by all ranks together, so that they stop at the same step instead of some of them waiting
+                # forever in the next collective operation
+                if all_reduce_sum(float(loss < 1e-6)) == get_world_size():
                     zero_loss += 1
                     if zero_loss >= 100:
                         logger.info('Found loss less than 1e-6 for 100 steps, stopping.')
+                        if validator is not None:
+                            validator.close()
+                        sampler.close()
+                        telemetry.close()
+                        saver.close()
                         return
                 else:
                     zero_loss = 0
@@ -601,49 +956,73 @@ def train(
                     len_contexts = 0
                     len_answers = 0
                     local_loss = 0
+                    telemetry.flush(iteration)
 
                 # validate
                 if should_validate_while_training(
                     iteration, val_every, val_after, resume=args.resume, start_iteration=start_iteration
                 ):
-                    if args.print_train_examples_too:
-                        results = {
-                            'answer': numericalizer.reverse(batch.answer.value.data, 'answer'),
-                            'context': numericalizer.reverse(batch.context.value.data, 'context'),
-                        }
-                        num_print = min(len(results['answer']), args.num_print)
-                        print_results(results, num_print)
-
-                    deca_score = do_validate_while_training(
-                        iteration,
-                        args,
-                        model,
-                        val_iters,
-                        train_task=task,
-                        round_progress=round_progress,
-                        task_progress=task_progress,
-                        writer=writer,
-                        logger=logger,
+                    # in distributed training, validation and checkpointing only happen on rank 0
+                    if is_main_process():
+                        if args.print_train_examples_too:
+                            results = {
+                                'answer': numericalizer.reverse(batch.answer.value.data, 'answer'),
+                                'context': numericalizer.reverse(batch.context.value.data, 'context'),
+                            }
+                            num_print = min(len(results['answer']), args.num_print)
+                            print_results(results, num_print)
+
+                        if validator is not None:
+                            # the best model is picked when the result comes back
+                            deca_score = None
+                            validator.submit(
+                                iteration,
+                                model.state_dict() if args.model_parallel else model.module.state_dict(),
+                                train_task=task,
+                                round_progress=round_progress,
+                                task_progress=task_progress,
+                            )
+                        else:
+                            deca_score = do_validate_while_training(
+                                iteration,
+                                args,
+                                model,
+                                val_iters,
+                                train_task=task,
+                                round_progress=round_progress,
+                                task_progress=task_progress,
+                                writer=writer,
+                                logger=logger,
+                            )
+
+                        # saving
+                        if should_save(iteration, save_every):
+                            best_decascore = maybe_save(
+                                iteration,
+                                model,
+                                opt,
+                                deca_score,
+                                best_decascore,
+                                saver=saver,
+                                logger=logger,
+                                train_task=task,
+                                round_progress=round_progress,
+                                task_progress=task_progress,
+                                timestamp=args.timestamp,
+                                log_dir=args.log_dir,
+                                model_parallel=args.model_parallel,
+                                grad_scaler=trainer.grad_scaler,
+                                sampler_state=sampler.state_dict(),
+                            )
+                    # keep the other ranks from running ahead (and timing out in the next all-reduce)
+                    # they wait here for all of rank 0's validation unless it is asynchronous, see --ddp_timeout
+                    barrier()
+
+                if validator is not None:
+                    best_decascore = handle_async_validation_results(
+                        validator.poll(), args, best_decascore, saver=saver, writer=writer, logger=logger
                     )
 
-                    # saving
-                    if should_save(iteration, save_every):
-                        best_decascore = maybe_save(
-                            iteration,
-                            model,
-                            opt,
-                            deca_score,
-                            best_decascore,
-                            saver=saver,
-                            logger=logger,
-                            train_task=task,
-                            round_progress=round_progress,
-                            task_progress=task_progress,
-                            timestamp=args.timestamp,
-                            log_dir=args.log_dir,
-                            model_parallel=args.model_parallel,
-                        )
-
                 # book keeping
                 task_iteration[task] += 1
                 iteration += 1
@@ -654,6 +1033,13 @@ def train(
 
         logger.info(f'{log_prefix} is done after {per_task_iterations - 1} iterations')
 
+        if validator is not None:
+            logger.info('Waiting for pending validations')
+            handle_async_validation_results(
+                validator.poll(wait=True), args, best_decascore, saver=saver, writer=writer, logger=logger
+            )
+            validator.close()
+
     else:
         # Save pretrained models as is without any finetuning
         # Useful for doing prediction/ generation on those models with genienlp
@@ -672,10 +1058,16 @@ def train(
                 timestamp=args.timestamp,
                 log_dir=args.log_dir,
                 model_parallel=args.model_parallel,
+                grad_scaler=trainer.grad_scaler,
             )
 
         logger.info(f'{args.pretrained_model} model is saved to {args.save} without any fine-tuning')
 
+    sampler.close()
+    telemetry.close()
+    # wait for background checkpoint writes before the caller loads or exports the model
+    saver.close()
+
 
 def main(args):
     args = arguments.post_parse_general(args)
@@ -684,7 +1076,11 @@ def main(args):
         return
 
     set_seed(args)
-    devices = get_devices(args.devices)
+    if world_size_from_env() > 1:
+        # launched by torchrun: one process per device
+        devices = [init_distributed(args.ddp_backend, args.ddp_timeout)]
+    else:
+        devices = get_devices(args.devices)
     logger = initialize_logger(args)
     logger.info(f'Arguments:\n{pformat(vars(args))}')
 
@@ -692,7 +1088,9 @@ def main(args):
     model_class = getattr(models, model_name)
 
     tasks = set(args.train_tasks) | set(args.val_tasks)
-    train_sets, val_sets, aux_sets = prepare_data(args, logger)
+    # let rank 0 fill the dataset caches before the other ranks read them
+    with main_process_first():
+        train_sets, val_sets, aux_sets = prepare_data(args, logger)
 
     if (args.use_curriculum and aux_sets is None) or (not args.use_curriculum and len(aux_sets) > 0):
         logging.error('Something unpleasant is happening with curriculum')
@@ -712,25 +1110,30 @@ def main(args):
             ned_dump_entity_type_pairs(val_set, args.data, 'eval', task.utterance_field)
 
     ########## initialize model
-    best_decascore = None
-    if args.load is not None:
-        model, best_decascore = model_class.load(
-            args.save,
-            args=args,
-            model_checkpoint_file=args.load,
-            vocab_sets=train_sets + val_sets,
-            tasks=tasks,
-            device=devices[0],
-            src_lang=src_lang,
-            tgt_lang=tgt_lang,
-        )
-        model.add_new_vocab_from_data(tasks=tasks, resize_decoder=True)
-        if not args.resume:
-            # we are fine-tuning, so reset the best score since the new fine-tune dataset usually has a different validation set from the original
-            best_decascore = None
-    else:
-        logger.info(f'Initializing a new {model_name}')
-        model = model_class(args=args, vocab_sets=train_sets + val_sets, tasks=tasks, src_lang=src_lang, tgt_lang=tgt_lang)
+    # let rank 0 download and cache the pretrained weights and tokenizer first
+    with main_process_first():
+        best_decascore = None
+        if args.load is not None:
+            model, best_decascore = model_class.load(
+                args.save,
+                args=args,
+                model_checkpoint_file=args.load,
+                vocab_sets=train_sets + val_sets,
+                tasks=tasks,
+                device=devices[0],
+                src_lang=src_lang,
+                tgt_lang=tgt_lang,
+            )
+            model.add_new_vocab_from_data(tasks=tasks, resize_decoder=True)
+            if not args.resume:
+                # we are fine-tuning, so reset the best score since the new fine-tune dataset usually has a different validation set from the original
+                best_decascore = None
+        else:
+            logger.info(f'Initializing a new {model_name}')
+            model = model_class(args=args, vocab_sets=train_sets + val_sets, tasks=tasks, src_lang=src_lang, tgt_lang=tgt_lang)
+
+    if args.checkpoint_every_n_layers > 0 or args.checkpoint_decoder_steps > 0:
+        enable_activation_checkpointing(model, args.checkpoint_every_n_layers, args.checkpoint_decoder_steps)
 
     params = get_trainable_params(model)
     log_model_size(logger, model, model_name)
@@ -764,6 +1167,14 @@ def main(args):
         device_map = dict(zip(args.devices, layers_list))
         model.model.parallelize(device_map)
         logger.info(f'Model parallel is used with following device map: {model.model.device_map}')
+    elif torch.distributed.is_initialized():
+        model.to(devices[0])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model,
+            device_ids=[devices[0]] if devices[0].type == 'cuda' else None,
+            bucket_cap_mb=args.ddp_bucket_cap_mb,
+            find_unused_parameters=args.ddp_find_unused_parameters,
+        )
     else:
         model.to(devices[0])
         model = NamedTupleCompatibleDataParallel(model, device_ids=devices)
@@ -771,7 +1182,19 @@ def main(args):
     ##########
 
     opt, lr_scheduler = init_opt(args, model, logger)
+    trainer = Trainer(
+        model,
+        opt,
+        lr_scheduler,
+        devices,
+        grad_clip=args.grad_clip,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        amp_dtype=args.amp_dtype,
+        split_oom_batches=args.split_OOM_batches,
+        simulate_oom_tokens=args.simulate_OOM_tokens,
+    )
     start_iteration = 1
+    sampler_state = None
 
     if args.resume:
         logger.info(f'Resuming training from {os.path.splitext(args.load)[0]}_optim.pth')
@@ -779,9 +1202,14 @@ def main(args):
         opt_state_dict = torch.load(os.path.join(args.save, f'{os.path.splitext(args.load)[0]}_optim.pth'), map_location='cpu')
         start_iteration = opt_state_dict.pop('start_iteration')
         logger.info(f'Starting iteration is {start_iteration}')
+        grad_scaler_state_dict = opt_state_dict.pop('grad_scaler', None)
+        # checkpoints from before the sampler state was saved resume by skipping batches instead
+        sampler_state = opt_state_dict.pop('sampler', None)
+        if grad_scaler_state_dict is not None and trainer.grad_scaler.is_enabled():
+            trainer.grad_scaler.load_state_dict(grad_scaler_state_dict)
         opt.load_state_dict(opt_state_dict)
 
-    if hasattr(args, 'tensorboard') and args.tensorboard:
+    if hasattr(args, 'tensorboard') and args.tensorboard and is_main_process():
         logger.info('Initializing Writer')
         writer = SummaryWriter(log_dir=args.tensorboard_dir, purge_step=start_iteration, flush_secs=60)
     else:
@@ -796,6 +1224,7 @@ def main(args):
         train_sets,
         args.train_iterations,
         model.module.numericalizer if not args.model_parallel else model.numericalizer,
+        trainer=trainer,
         val_sets=val_sets,
         aux_sets=aux_sets,
         logger=logger,
@@ -809,7 +1238,10 @@ def main(args):
         use_curriculum=args.use_curriculum,
         best_decascore=best_decascore,
         log_prefix='training',
+        sampler_state=sampler_state,
     )
 
     if writer is not None:
         writer.close()  # otherwise the last written value may not be flushed
+
+    cleanup_distributed()
@@ -33,10 +33,8 @@ import logging
 import os
 import random
 import re
-import shutil
 import sys
 import time
-from json.decoder import JSONDecodeError
 
 import numpy as np
 import torch
@@ -46,10 +44,12 @@ from transformers.models.mbart50.tokenization_mbart50 import FAIRSEQ_LANGUAGE_CO
 from transformers.models.nllb.tokenization_nllb import FAIRSEQ_LANGUAGE_CODES as NLLB_FAIRSEQ_LANGUAGE_CODES
 
 from .data_utils.almond_utils import token_type_regex
+from .data_utils.deduplication import duplicates_adjacent_sort_key
 from .data_utils.example import NumericalizedExamples
 from .data_utils.iterator import LengthSortedIterator
+from .model_utils.telemetry import count_stage, stage
 from .model_utils.transformers_utils import MARIAN_GROUP_MEMBERS
-from .tasks.generic_dataset import all_tokens_fn, input_tokens_fn
+from .tasks.generic_dataset import all_tokens_fn, input_tokens_fn, packed_tokens_fn
 
 logger = logging.getLogger(__name__)
 
@@ -126,20 +126,6 @@ def get_part_path(path, part_idx):
     return path + '_part' + str(part_idx + 1) + (os.path.sep if has_separator else '')
 
 
-def split_folder_on_disk(folder_path, num_splits):
-    new_folder_paths = [get_part_path(folder_path, part_idx) for part_idx in range(num_splits)]
-    for subdir, dirs, files in os.walk(folder_path):
-        for file in files:
-            # ignore system files
-            if file.startswith('.'):
-                continue
-            new_file_paths = [
-                os.path.join(subdir.replace(folder_path, new_folder_paths[part_idx]), file) for part_idx in range(num_splits)
-            ]
-            split_file_on_disk(os.path.join(subdir, file), num_splits, output_paths=new_file_paths)
-    return new_folder_paths
-
-
 def split_file_on_disk(file_path, num_splits, output_paths=None, delete=False):
     """ """
 
@@ -169,63 +155,6 @@ def split_file_on_disk(file_path, num_splits, output_paths=None, delete=False):
     return all_output_paths
 
 
-def combine_folders_on_disk(folder_path_prefix, num_files, line_group_size, delete=False):
-    folder_paths = [get_part_path(folder_path_prefix, part_idx) for part_idx in range(num_files)]
-    new_to_olds_map = {}
-    for i in range(num_files):
-        for subdir, dirs, files in os.walk(folder_paths[i]):
-            for file in files:
-                new_file_path = os.path.join(subdir.replace(folder_paths[i], folder_path_prefix), file)
-                if new_file_path not in new_to_olds_map:
-                    new_to_olds_map[new_file_path] = []
-                new_to_olds_map[new_file_path].append(os.path.join(subdir, file))
-
-    for new, olds in new_to_olds_map.items():
-        os.makedirs(os.path.dirname(new), exist_ok=True)
-        with open(new, 'w') as combined_file:
-            if new.endswith('.json'):
-                new_json = None
-                for old in olds:
-                    with open(old, 'r') as f:
-                        if new_json is None:
-                            try:
-                                new_json = json.load(f)
-                            except JSONDecodeError:
-                                f.seek(0)
-                                logger.info('Failed to read json file %s with content:\n %s', old, f.read())
-                        else:
-                            for k, v in json.load(f).items():
-                                new_json[k] += v
-                for k, v in new_json.items():
-                    new_json[k] /= float(num_files)
-                json.dump(new_json, combined_file)
-            else:
-                all_old_file_contents = []
-                for old in olds:
-                    with open(old, 'r') as f:
-                        all_old_file_contents.append([line for line in f])
-                old_file_idx = 0
-                all_indices = [0] * len(all_old_file_contents)
-                finished_reading = [False] * len(all_old_file_contents)
-                while True:
-                    if finished_reading[old_file_idx]:
-                        old_file_idx = (old_file_idx + 1) % len(all_old_file_contents)
-                        continue
-                    for i in range(line_group_size):
-                        line = all_old_file_contents[old_file_idx][all_indices[old_file_idx]]
-                        combined_file.write(line)
-                        all_indices[old_file_idx] += 1
-                    if all_indices[old_file_idx] == len(all_old_file_contents[old_file_idx]):
-                        finished_reading[old_file_idx] = True
-                        if all(finished_reading):
-                            break
-                    old_file_idx = (old_file_idx + 1) % len(all_old_file_contents)
-
-    if delete:
-        for folder in folder_paths:
-            shutil.rmtree(folder)
-
-
 def combine_files_on_disk(file_path_prefix, num_files, line_group_size, delete=False):
     all_input_file_contents = []
     all_input_file_paths = []
@@ -268,6 +197,9 @@ def map_filter(callable, iterable):
 
 
 def get_devices(devices=None):
+    # negative ordinals stand for the CPU; listing several lets prediction shard across CPU worker processes
+    if devices and all(ordinal < 0 for ordinal in devices):
+        return [torch.device('cpu')] * len(devices)
     if not torch.cuda.is_available():
         return [torch.device('cpu')]
     if not devices:
@@ -308,13 +240,28 @@ def elapsed_time(log):
 
 
 def make_data_loader(
-    dataset, numericalizer, batch_size, device=None, train=False, return_original_order=False, batching_algorithm='sample'
+    dataset,
+    numericalizer,
+    batch_size,
+    device=None,
+    train=False,
+    return_original_order=False,
+    batching_algorithm='sample',
+    num_shards=1,
+    shard_id=0,
+    token_budget=None,
+    seed=None,
 ):
+    """
+    seed: if provided, the iterator uses its own random generator seeded with it instead of the global one
+    """
     args = numericalizer.args
-    all_features = NumericalizedExamples.from_examples(dataset, numericalizer)
+    with stage('numericalize'):
+        all_features = NumericalizedExamples.from_examples(dataset, numericalizer)
 
     context_lengths = [ex.context.length for ex in all_features]
     answer_lengths = [ex.answer.length for ex in all_features]
+    count_stage('numericalize', examples=len(all_features), tokens=sum(context_lengths) + sum(answer_lengths))
 
     topN = args.log_n_longest
     logger.info(
@@ -340,6 +287,10 @@ def make_data_loader(
     else:
         min_batch_length = 1
 
+    if train and getattr(args, 'sequence_packing', False) and batch_size_fn == all_tokens_fn:
+        # fill the token budget with real tokens instead of padded rows
+        batch_size_fn = packed_tokens_fn
+
     min_output_length = numericalizer.args.min_output_length
     max_output_length = numericalizer.args.max_output_length
 
@@ -380,6 +331,10 @@ def make_data_loader(
 
     all_features = all_features_filtered
 
+    if not train and sort_key_fn and getattr(args, 'dedupe_inputs', False):
+        # batch duplicates together, so that generation only runs once for them
+        sort_key_fn = duplicates_adjacent_sort_key(all_features, sort_key_fn)
+
     sampler = LengthSortedIterator(
         all_features,
         batch_size=batch_size,
@@ -389,13 +344,22 @@ def make_data_loader(
         batch_size_fn=batch_size_fn,
         groups=dataset.groups,
         batching_algorithm=batching_algorithm,
+        num_shards=num_shards,
+        shard_id=shard_id,
+        seed=seed if seed is not None else (args.seed if num_shards > 1 else None),
+        token_budget=token_budget,
     )
     # get the sorted data_source
     all_f = sampler.data_source
+
+    def collate(batches):
+        with stage('batching'):
+            return NumericalizedExamples.collate_batches(batches, numericalizer, device)
+
     data_loader = torch.utils.data.DataLoader(
         all_f,
         batch_sampler=sampler,
-        collate_fn=lambda batches: NumericalizedExamples.collate_batches(batches, numericalizer, device),
+        collate_fn=collate,
         num_workers=0,
     )
 
@@ -675,6 +639,8 @@ def load_config_file_to_args(args):
         'e2e_dialogue_valid_subtasks',
         'e2e_dialogue_valid_submetrics',
         'e2e_dialogue_valid_subweights',
+        'pad_to_multiple_of',
+        'max_padding_buckets',
     ]
     for o in overwrite:
         if o not in args or getattr(args, o) is None:
@@ -29,18 +29,34 @@ do
     --data $SRCDIR/dataset/ \
     --embeddings $EMBEDDING_DIR \
     --save_confidence_features \
-    --confidence_feature_path $workdir/model_$i/confidences.pkl \
+    --confidence_feature_path $workdir/model_$i/confidences \
     --mc_dropout_num 10
 
-  # check if confidence file exists
-  if test ! -f $workdir/model_$i/confidences.pkl ; then
+  # check if confidence features were saved
+  if test ! -f $workdir/model_$i/confidences/metadata.json ; then
     echo "File not found!"
     exit 1
   fi
 
+  # a path that holds something else is not overwritten
+  touch $workdir/model_$i/confidences.pkl
+  if genienlp predict \
+    --tasks almond \
+    --evaluate test \
+    --path $workdir/model_$i \
+    --overwrite \
+    --eval_dir $workdir/model_$i/eval_results/ \
+    --data $SRCDIR/dataset/ \
+    --embeddings $EMBEDDING_DIR \
+    --save_confidence_features \
+    --confidence_feature_path $workdir/model_$i/confidences.pkl ; then
+    echo "Overwrote a file that does not hold confidence features!"
+    exit 1
+  fi
+
   # calibrate
   genienlp calibrate \
-    --confidence_path $workdir/model_$i/confidences.pkl \
+    --confidence_path $workdir/model_$i/confidences \
     --save $workdir/model_$i \
     --testing \
     --name_prefix test_calibrator
@@ -2,6 +2,48 @@
 
 . ./tests/lib.sh
 
+# undoing special token preprocessing prefers the longest sequence of words at each position
+mkdir -p $workdir/special_token_numericalizer
+echo '[["param:a", "a b"], ["param:b", "b c"], ["param:c", "a b c d"]]' > $workdir/special_token_numericalizer/special-token-preprocessing.json
+python3 - $EMBEDDING_DIR $workdir/special_token_numericalizer <<'EOF'
+import os
+import sys
+from argparse import Namespace
+
+from transformers import AutoConfig, AutoTokenizer
+
+from genienlp.data_utils.numericalizer import TransformerNumericalizer
+
+embedding_dir, save_dir = sys.argv[1:]
+AutoTokenizer.from_pretrained('sshleifer/bart-tiny-random', cache_dir=embedding_dir).save_pretrained(save_dir)
+config = AutoConfig.from_pretrained('sshleifer/bart-tiny-random', cache_dir=embedding_dir)
+args = Namespace(
+    embeddings=embedding_dir,
+    preprocess_special_tokens=True,
+    pad_to_multiple_of=None,
+    max_padding_buckets=None,
+    no_fast_tokenizer=False,
+    force_fast_tokenizer=False,
+)
+numericalizer = TransformerNumericalizer(
+    'sshleifer/bart-tiny-random', args, None, config, 'en', 'en', None, None, save_dir=save_dir
+)
+for sentence, expected in [
+    ('x a b c d', 'x param:c'),
+    ('x a b c', 'x param:a c'),
+    ('b c a b', 'param:b param:a'),
+]:
+    assert numericalizer._undo_special_token_preprocessing(sentence) == expected, sentence
+
+# the pickled tokenizer is only used as long as the tokenizer files it was made from do not change
+numericalizer.save(save_dir)
+assert numericalizer._load_tokenizer_cache(save_dir) is not None
+tokenizer_file = os.path.join(save_dir, 'tokenizer.json')
+stat = os.stat(tokenizer_file)
+os.utime(tokenizer_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+assert numericalizer._load_tokenizer_cache(save_dir) is None
+EOF
+
 i=0
 # test almond task
 for hparams in \
@@ -32,7 +74,8 @@ do
     --overwrite \
     --eval_dir $workdir/model_$i/eval_results/ \
     --data $SRCDIR/dataset/ \
-    --embeddings $EMBEDDING_DIR
+    --embeddings $EMBEDDING_DIR \
+    --report_timings
 
   # check if result file exists
   if test ! -f $workdir/model_$i/eval_results/test/almond.tsv ; then
@@ -40,21 +83,285 @@ do
     exit 1
   fi
 
+  # check that the time of each prediction stage was recorded
+  python3 -c "import json, sys; assert json.load(open(sys.argv[1]))['stages']['decoder']['calls'] > 0" \
+    $workdir/model_$i/eval_results/test/timings.json
+
   # check TransformerSeq2Seq and TransformerLSTM
   if [ $i == 0 ] || [ $i == 2 ] ; then
     echo "Testing export"
     genienlp export --path $workdir/model_$i --output $workdir/model_"$i"_exported
 
+    if [ $i == 2 ] ; then
+      # traces the encoder and a single decoder step and checks them against the model's generate
+      genienlp export --path $workdir/model_$i --output $workdir/model_"$i"_exported --torchscript
+    fi
+
     echo "Testing the server mode"
     echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}' | genienlp server --path $workdir/model_$i --stdin
   fi
 
+  if [ $i == 0 ] ; then
+    echo "Testing distributed training"
+    torchrun --standalone --nproc_per_node 2 -m genienlp train \
+      $SHARED_TRAIN_HPARAMS \
+      --train_tasks almond \
+      --train_batch_tokens 100 \
+      --val_batch_size 100 \
+      --train_iterations 4 \
+      --save $workdir/model_"$i"_ddp \
+      --data $SRCDIR/dataset/  \
+      --ddp_backend gloo \
+      $hparams
+
+    if test ! -f $workdir/model_"$i"_ddp/best.pth ; then
+      echo "File not found!"
+      exit 1
+    fi
+    rm -rf $workdir/model_"$i"_ddp
+  fi
+
   if [ $i == 2 ] ; then
     # check if predictions matches expected_results
     diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results/test/almond.tsv
+
+    # batches that run out of memory are split in halves, which must not change predictions
+    # (this run also post-processes each batch synchronously instead of in a background thread)
+    genienlp predict \
+      --tasks almond \
+      --evaluate test \
+      --path $workdir/model_$i \
+      --overwrite \
+      --eval_dir $workdir/model_$i/eval_results_split/ \
+      --data $SRCDIR/dataset/ \
+      --embeddings $EMBEDDING_DIR \
+      --split_OOM_batches \
+      --simulate_OOM_tokens 50 \
+      --postprocess_workers 0
+    diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results_split/test/almond.tsv
+
+    # sharding batches over several (CPU) devices should not change predictions either
+    genienlp predict \
+      --tasks almond \
+      --evaluate test \
+      --path $workdir/model_$i \
+      --overwrite \
+      --eval_dir $workdir/model_$i/eval_results_sharded/ \
+      --data $SRCDIR/dataset/ \
+      --embeddings $EMBEDDING_DIR \
+      --devices -1 -1
+    diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results_sharded/test/almond.tsv
+
+    # an interrupted resumable run continues from its journal, and produces the same outputs as an uninterrupted run
+    resume_args="--tasks almond --evaluate test --path $workdir/model_$i --eval_dir $workdir/model_$i/eval_results_resumed/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --resumable"
+    if genienlp predict $resume_args --simulate_interruption 1 ; then
+      echo "The simulated interruption did not stop prediction!"
+      exit 1
+    fi
+    if test ! -f $workdir/model_$i/eval_results_resumed/test/almond.journal ; then
+      echo "Journal of an interrupted run not found!"
+      exit 1
+    fi
+    # a crash can leave partially written entries and lines behind
+    truncate -s -8 $workdir/model_$i/eval_results_resumed/test/almond.journal
+    truncate -s -8 $workdir/model_$i/eval_results_resumed/test/almond.tsv
+    # a journal is not resumed by a run with different generation arguments
+    if genienlp predict $resume_args --seed 1 ; then
+      echo "Resumed the journal of a different run!"
+      exit 1
+    fi
+    genienlp predict $resume_args
+    diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results_resumed/test/almond.tsv
+    if test -f $workdir/model_$i/eval_results_resumed/test/almond.journal ; then
+      echo "Journal of a finished run was not removed!"
+      exit 1
+    fi
+    # a finished task is skipped by a run with the same arguments, but not reused by a run with different ones
+    genienlp predict $resume_args
+    diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results_resumed/test/almond.tsv
+    if genienlp predict $resume_args --seed 1 ; then
+      echo "Reused the outputs of a different run!"
+      exit 1
+    fi
+
+    # identical inputs are generated only once and their outputs copied, which must not change predictions
+    # (every example of the test set appears twice here, under another id)
+    mkdir -p $workdir/model_$i/dedupe_data/almond
+    cat $SRCDIR/dataset/almond/test.tsv <(sed 's/^/copy-/' $SRCDIR/dataset/almond/test.tsv) > $workdir/model_$i/dedupe_data/almond/test.tsv
+    genienlp predict \
+      --tasks almond \
+      --evaluate test \
+      --path $workdir/model_$i \
+      --overwrite \
+      --eval_dir $workdir/model_$i/eval_results_dedupe/ \
+      --data $workdir/model_$i/dedupe_data/ \
+      --embeddings $EMBEDDING_DIR \
+      --dedupe_inputs
+    cat $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv <(sed 's#^almond/#almond/copy-#' $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv) \
+      | diff -u - $workdir/model_$i/eval_results_dedupe/test/almond.tsv
+
+    # the same predictions written as JSON lines
+    genienlp predict \
+      --tasks almond \
+      --evaluate test \
+      --path $workdir/model_$i \
+      --overwrite \
+      --eval_dir $workdir/model_$i/eval_results_jsonl/ \
+      --data $SRCDIR/dataset/ \
+      --embeddings $EMBEDDING_DIR \
+      --output_format jsonl \
+      --resumable
+    if [ "$(wc -l < $workdir/model_$i/eval_results_jsonl/test/almond.jsonl)" != "$(wc -l < $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv)" ] ; then
+      echo "Wrong number of JSON lines!"
+      exit 1
+    fi
+    if test -f $workdir/model_$i/eval_results_jsonl/test/almond.journal ; then
+      echo "Journal of a finished run was not removed!"
+      exit 1
+    fi
+    # records that arrive out of dataset order are reordered through a spill file, which is removed once it is copied
+    if test -f $workdir/model_$i/eval_results_jsonl/test/almond.jsonl.unordered ; then
+      echo "Spill file of a finished run was not removed!"
+      exit 1
+    fi
+
+    # batch sizes chosen from the memory measured on earlier batches must not change predictions
+    genienlp predict \
+      --tasks almond \
+      --evaluate test \
+      --path $workdir/model_$i \
+      --overwrite \
+      --eval_dir $workdir/model_$i/eval_results_adaptive/ \
+      --data $SRCDIR/dataset/ \
+      --embeddings $EMBEDDING_DIR \
+      --adaptive_batch_size \
+      --cpu_memory_limit 4
+    diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results_adaptive/test/almond.tsv
+
+    # the second run reuses the outputs of the first one from the generation cache
+    for run in 1 2 ; do
+      genienlp predict \
+        --tasks almond \
+        --evaluate test \
+        --path $workdir/model_$i \
+        --overwrite \
+        --eval_dir $workdir/model_$i/eval_results_cached/ \
+        --data $SRCDIR/dataset/ \
+        --embeddings $EMBEDDING_DIR \
+        --generation_cache $workdir/model_$i/generation_cache
+      diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results_cached/test/almond.tsv
+    done
+    if [ "$(ls -d $workdir/model_$i/generation_cache/*/ | wc -l)" != "1" ] ; then
+      echo "Wrong number of generation cache entries!"
+      exit 1
+    fi
   fi
 
   rm -rf $workdir/model_$i $workdir/model_"$i"_exported
 
   i=$((i+1))
 done
+
+# packing several examples into a row must give each example the same loss as in its own row
+python3 - $EMBEDDING_DIR <<'EOF'
+import sys
+
+import torch
+from transformers import AutoModelForSeq2SeqLM
+
+from genienlp.models.packing import pack_batch, packed_seq2seq_logits, per_example_token_loss_sum
+
+model = AutoModelForSeq2SeqLM.from_pretrained('sshleifer/bart-tiny-random', cache_dir=sys.argv[1]).eval()
+pad_id = model.config.pad_token_id
+torch.manual_seed(0)
+
+
+def random_batch(lengths):
+    ids = torch.full((len(lengths), max(lengths)), pad_id)
+    for i, length in enumerate(lengths):
+        ids[i, :length] = torch.randint(4, model.config.vocab_size, (length,))
+    return ids
+
+
+# the short examples fit next to each other, but not next to the first one
+answer_lengths = [6, 2, 3, 1]
+input_ids = random_batch([8, 3, 4, 2])
+decoder_input_ids = random_batch(answer_lengths)
+labels = random_batch(answer_lengths)
+with torch.no_grad():
+    logits = model(input_ids=input_ids, attention_mask=input_ids != pad_id, decoder_input_ids=decoder_input_ids).logits
+    unpacked_loss = torch.nn.functional.cross_entropy(
+        logits.transpose(1, 2), labels, ignore_index=pad_id, reduction='none'
+    ).sum(dim=1)
+
+    packed = pack_batch(input_ids, decoder_input_ids, labels, pad_id)
+    assert packed.input_ids.size(0) < input_ids.size(0), 'no examples were packed together'
+    packed_logits = packed_seq2seq_logits(model, packed)
+    token_loss = torch.nn.functional.cross_entropy(
+        packed_logits.transpose(1, 2), packed.labels, ignore_index=pad_id, reduction='none'
+    )
+    packed_loss = per_example_token_loss_sum(token_loss, packed.decoder_segments, packed.num_examples)
+assert torch.allclose(unpacked_loss, packed_loss, atol=1e-4), (unpacked_loss, packed_loss)
+EOF
+
+# training features, each in its own run so that the configurations above keep testing the default training path
+for hparams in \
+  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --sequence_packing" \
+  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --amp_dtype bf16" \
+  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --pad_to_multiple_of 8 --max_padding_buckets 4" \
+  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --split_OOM_batches --simulate_OOM_tokens 60" \
+  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --prefetch_batches 2" \
+  "--model TransformerLSTM --pretrained_model bert-base-cased --min_output_length 2 --trainable_decoder_embeddings=50 --async_validation" \
+  "--model TransformerLSTM --pretrained_model bert-base-cased --min_output_length 2 --trainable_decoder_embeddings=50 --checkpoint_every_n_layers 2 --checkpoint_decoder_steps 4" \
+  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --telemetry --profile_iterations 2 3" ;
+do
+
+  genienlp train \
+    $SHARED_TRAIN_HPARAMS \
+    --train_tasks almond \
+    --train_batch_tokens 100 \
+    --val_batch_size 100 \
+    --train_iterations 4 \
+    --save $workdir/model_feature \
+    --data $SRCDIR/dataset/  \
+    $hparams
+
+  genienlp predict \
+    --tasks almond \
+    --evaluate test \
+    --path $workdir/model_feature \
+    --overwrite \
+    --eval_dir $workdir/model_feature/eval_results/ \
+    --data $SRCDIR/dataset/ \
+    --embeddings $EMBEDDING_DIR
+
+  if test ! -f $workdir/model_feature/eval_results/test/almond.tsv ; then
+    echo "File not found!"
+    exit 1
+  fi
+
+  if [[ $hparams == *--telemetry* ]] ; then
+    # throughput is logged every --log_every iterations, and the profiler traces the iterations in between 2 and 3
+    python3 - $workdir/model_feature <<'EOF'
+import json
+import os
+import sys
+
+save_dir = sys.argv[1]
+with open(os.path.join(save_dir, 'telemetry.jsonl')) as fp:
+    records = [json.loads(line) for line in fp]
+assert len(records) > 0, 'no telemetry records'
+for record in records:
+    assert record['task'] == 'almond', record
+    assert record['steps'] > 0 and record['examples_per_sec'] > 0 and record['tokens_per_sec'] > 0, record
+    assert 0 <= record['padding_ratio'] < 1, record
+    fractions = [record[f'{name}_fraction'] for name in ('data', 'forward_backward', 'optimizer', 'other')]
+    assert all(0 <= fraction <= 1 for fraction in fractions) and sum(fractions) >= 0.99, record
+
+with open(os.path.join(save_dir, 'profile_iteration_2-3.json')) as fp:
+    assert len(json.load(fp)['traceEvents']) > 0, 'empty profiler trace'
+EOF
+  fi
+
+  rm -rf $workdir/model_feature
+done